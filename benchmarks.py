@@ -0,0 +1,802 @@
+from contextlib import contextmanager, redirect_stdout
+from datetime import date, datetime, timedelta
+from importlib import import_module
+from importlib.util import find_spec
+import json
+import os
+from http.client import HTTPConnection
+from itertools import count as counter
+import platform
+import random
+import sqlite3
+from statistics import median
+import subprocess
+import socket
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import click
+from peewee import chunked, fn, prefetch, SqliteDatabase
+
+from fake_api import FakeApiServer, FIRST_NAMES, generate_people, \
+    LAST_NAMES, LOCATIONS, STREETS, TITLES, write_people
+from functions import birthday_ordinal, DatabaseFunctions, haversine, \
+    model_registry, next_birthday, write_rows
+import load_people
+from migrations import add_location_index
+from load_people import ApiDataDownloader, ApiDataModifier, ApiDataSave
+import people
+from models import CACHE_MODELS, Contact, Location, Login, MODELS, Person, \
+    PersonSearch
+from profiling import Profiler
+from service import percentile
+from settings import API_PAGE_SIZE, API_WORKERS, DATABASE_PROFILES, \
+    DATA_MODIFICATIONS, MODIFICATION_CHUNK_SIZE, OUTPUT_FORMATS, \
+    SAVE_BATCH_SIZE
+
+
+@click.group()
+def cli():
+    pass
+
+
+@contextmanager
+def temporary_database(pragmas=None):
+    """Bind models to a fresh database file for the time of benchmark."""
+    with tempfile.TemporaryDirectory() as directory:
+        db = SqliteDatabase(os.path.join(directory, 'benchmark.db'),
+                            pragmas=pragmas or {'foreign_keys': 1})
+        # saved people are indexed for full-text search
+        models = MODELS + CACHE_MODELS + [PersonSearch]
+        db.bind(models, bind_refs=False, bind_backrefs=False)
+        db.connect()
+        db.create_tables(models)
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+def modified_people(count, seed='abc'):
+    """Prepare already modified people data."""
+    downloader = SimpleNamespace(data={'results': list(
+        generate_people(count, seed))})
+    ApiDataModifier(downloader, DATA_MODIFICATIONS,
+                    'results').execute_modifications()
+    return downloader
+
+
+def report(name, rows, seconds):
+    """Print the benchmark result."""
+    print(f'{name:<24}{rows:>10} rows {seconds:>10.3f} s '
+          f'{rows / seconds:>12.0f} rows/s')
+
+
+@cli.command('bulk-save')
+@click.option('--count', default=1000, help='Number of people')
+@click.option('--batch-size', default=SAVE_BATCH_SIZE,
+              help='Number of people saved in a single transaction')
+def bulk_save(count, batch_size):
+    """Compare row by row and batched saving of people."""
+    downloader = modified_people(count)
+    rows = count * len(MODELS)
+
+    with temporary_database():
+        save_obj = ApiDataSave(downloader, 'results')
+        start = time.perf_counter()
+        save_obj.save_data_to_db()
+        report('row by row', rows, time.perf_counter() - start)
+
+    with temporary_database():
+        save_obj = ApiDataSave(downloader, 'results')
+        start = time.perf_counter()
+        save_obj.save_data_in_batches(batch_size)
+        report(f'batches of {batch_size}', rows, time.perf_counter() - start)
+
+
+@cli.command('incremental')
+@click.option('--count', default=20000, help='Number of people')
+@click.option('--changed', default=0.1, help='Fraction of changed people')
+@click.option('--batch-size', default=SAVE_BATCH_SIZE,
+              help='Number of people saved in a single transaction')
+def incremental(count, changed, batch_size):
+    """Compare the first load with incremental loads of the same people."""
+    downloader = modified_people(count)
+    with temporary_database(DATABASE_PROFILES['query']):
+        for name, fraction in (('first load', 0), ('unchanged', 0),
+                               (f'{changed:.0%} changed', changed)):
+            for person_dict in downloader.data['results'][
+                    :int(count * fraction)]:
+                person_dict['email'] = 'changed@example.com'
+            save_obj = ApiDataSave(downloader, 'results')
+            start = time.perf_counter()
+            save_obj.save_data_in_batches(batch_size, incremental=True)
+            report(name, count, time.perf_counter() - start)
+            print(' ' * 24 + ', '.join(f'{key} {value}' for key, value in
+                                       save_obj.counts.items()))
+
+
+@cli.command('download')
+@click.option('--count', default=10000, help='Number of people')
+@click.option('--page-size', default=API_PAGE_SIZE,
+              help='Number of people downloaded in a single request')
+@click.option('--workers', default=API_WORKERS,
+              help='Number of concurrent requests')
+@click.option('--delay', default=0.2,
+              help='Simulated API response time per 1000 people [s]')
+def download(count, page_size, workers, delay):
+    """Compare a single request with concurrent paginated requests."""
+    parameters = {'results': count, 'seed': 'abc'}
+    with FakeApiServer(delay=delay) as server:
+        downloader = ApiDataDownloader(server.url, parameters)
+        start = time.perf_counter()
+        downloader.send_request()
+        report('single request', count, time.perf_counter() - start)
+
+        downloader = ApiDataDownloader(server.url, parameters)
+        start = time.perf_counter()
+        downloader.send_paginated_requests(page_size, workers)
+        report(f'{workers} workers', count, time.perf_counter() - start)
+
+
+@cli.command('modifications')
+@click.option('--count', default=100000, help='Number of people')
+def modifications(count):
+    """Compare method lookup per modification with compiled plan."""
+    # both runs modify identical copies of the same data
+    raw_data = json.dumps(list(generate_people(count)))
+    downloader = SimpleNamespace(data=json.loads(raw_data))
+    modifier = ApiDataModifier(downloader, DATA_MODIFICATIONS)
+    start = time.perf_counter()
+    for person_dict in downloader.data:
+        for modification in DATA_MODIFICATIONS:
+            method = getattr(modifier, modification['name'])
+            method(person_dict, modification['key_path'])
+    lookup = time.perf_counter() - start
+    report('method lookup', count, lookup)
+
+    downloader = SimpleNamespace(data=json.loads(raw_data))
+    modifier = ApiDataModifier(downloader, DATA_MODIFICATIONS)
+    start = time.perf_counter()
+    modifier.execute_modifications()
+    compiled = time.perf_counter() - start
+    report('compiled plan', count, compiled)
+    print(f'Per person: {lookup / count * 1e6:.2f} us -> '
+          f'{compiled / count * 1e6:.2f} us')
+
+
+@cli.command('parallel-modifications')
+@click.option('--count', default=100000, help='Number of people')
+@click.option('--workers', default=os.cpu_count(),
+              help='Number of processes')
+@click.option('--chunk-size', default=MODIFICATION_CHUNK_SIZE,
+              help='Number of people sent to a process at once')
+def parallel_modifications(count, workers, chunk_size):
+    """Compare serial and parallel modification of data."""
+    raw_data = json.dumps(list(generate_people(count)))
+    for name, processes in (('serial', 1), (f'{workers} processes', workers)):
+        downloader = SimpleNamespace(data=json.loads(raw_data))
+        modifier = ApiDataModifier(downloader, DATA_MODIFICATIONS)
+        start = time.perf_counter()
+        modifier.execute_modifications_in_parallel(processes, chunk_size, 0)
+        report(name, count, time.perf_counter() - start)
+
+
+def run_queries(repeat):
+    """Run queries similar to the ones used by people.py commands."""
+    for _ in range(repeat):
+        Person.select().where(Person.gender == 'female').count()
+        Person.select(fn.AVG(Person.age)).scalar()
+        list(Location.select(Location.city, fn.COUNT(Location.city)).group_by(
+            Location.city))
+        list(Person.select().where(Person.date_of_birth.between(
+            '1970-01-01', '1975-12-31')))
+
+
+@cli.command('profiles')
+@click.option('--count', default=20000, help='Number of people')
+@click.option('--batch-size', default=SAVE_BATCH_SIZE,
+              help='Number of people saved in a single transaction')
+@click.option('--repeat', default=20, help='Number of query repetitions')
+def profiles(count, batch_size, repeat):
+    """Compare loading and querying data with database profiles."""
+    downloader = modified_people(count)
+    rows = count * len(MODELS)
+    pragmas = dict(DATABASE_PROFILES, baseline={'foreign_keys': 1})
+    for name in ('baseline', *DATABASE_PROFILES):
+        with temporary_database(pragmas[name]) as db:
+            save_obj = ApiDataSave(downloader, 'results')
+            start = time.perf_counter()
+            save_obj.save_data_in_batches(batch_size)
+            report(f'{name} load', rows, time.perf_counter() - start)
+            db.close()
+            start = time.perf_counter()
+            run_queries(repeat)
+            seconds = time.perf_counter() - start
+            print(f'{name + " queries":<24}{repeat:>10} runs '
+                  f'{seconds:>10.3f} s')
+
+
+@cli.command('registry')
+@click.option('--repeat', default=10000, help='Number of lookups')
+def registry(repeat):
+    """Compare resolving columns by introspection with the model registry."""
+    models = model_registry()
+
+    def probe_tables(db, column):
+        # resolution used by most_occurrences before the registry, tables
+        # without a model of the same name, e.g. cachedresult, are skipped
+        for table in db.get_tables():
+            attr = getattr(getattr(import_module('models'), table.title(),
+                                   None), column, None)
+            if attr is not None:
+                return attr
+        return None
+
+    with temporary_database() as db:
+        lookups = (
+            ('import and getattr',
+             lambda: getattr(getattr(import_module('models'), 'Location'),
+                             'city')),
+            ('registry field', lambda: models.field('Location', 'city')),
+            ('schema probing', lambda: probe_tables(db, 'password')),
+            ('registry column', lambda: models.column('password')),
+            ('probing unknown', lambda: probe_tables(db, 'unknown')),
+            ('registry unknown', lambda: models.column('unknown')),
+        )
+        for name, lookup in lookups:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                lookup()
+            seconds = time.perf_counter() - start
+            print(f'{name:<24}{seconds / repeat * 1e6:>10.2f} us per call')
+
+
+@cli.command('query-cache')
+@click.option('--count', default=100000, help='Number of people')
+@click.option('--repeat', default=100, help='Number of repetitions')
+def query_cache(count, repeat):
+    """Compare computed and cached results of people.py statistics."""
+    downloader = modified_people(count)
+    with temporary_database(DATABASE_PROFILES['query']) as db:
+        ApiDataSave(downloader, 'results').save_data_in_batches(
+            SAVE_BATCH_SIZE)
+        for name, cache_size in (('computed', 0), ('cached', 128)):
+            obj = DatabaseFunctions(db.database, lambda db_name: db,
+                                    cache_size=cache_size)
+            calls = (lambda: obj.aggregate('Person', averages=('age',)),
+                     lambda: obj.aggregate('Person', 'gender'),
+                     lambda: obj.most_occurrences('country', 10))
+            with obj.keep_connection():
+                for call in calls:
+                    call()
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    for call in calls:
+                        call()
+                seconds = time.perf_counter() - start
+            print(f'{name:<24}{seconds / repeat / len(calls) * 1e6:>10.1f} '
+                  f'us per call')
+
+
+@cli.command('output')
+@click.option('--count', default=100000, help='Number of people')
+def output(count):
+    """Compare writing rows of born-between in every output format."""
+    downloader = modified_people(count)
+    columns = (Person.title, Person.firstname, Person.lastname,
+               Person.date_of_birth)
+    with temporary_database(DATABASE_PROFILES['query']) as db, \
+            open(os.devnull, 'w') as devnull:
+        ApiDataSave(downloader, 'results').save_data_in_batches(
+            SAVE_BATCH_SIZE)
+        query = Person.select(*columns).order_by(Person.date_of_birth)
+
+        # printing every model instance, as born-between used to
+        start = time.perf_counter()
+        for p in query.iterator():
+            print(p.title, p.firstname, p.lastname, p.date_of_birth,
+                  file=devnull)
+        report('print', count, time.perf_counter() - start)
+
+        # rows converted by peewee compared with rows from the cursor
+        for name, rows in (('tuples', lambda: query.tuples().iterator()),
+                           ('cursor', lambda: db.execute(query))):
+            for output_format in OUTPUT_FORMATS:
+                start = time.perf_counter()
+                write_rows(devnull, rows(), output_format,
+                           [column.name for column in columns])
+                report(f'{name} {output_format}', count,
+                       time.perf_counter() - start)
+
+
+@cli.command('columnar')
+@click.option('--count', default=100000, help='Number of people')
+@click.option('--repeat', default=10, help='Number of repetitions')
+def columnar(count, repeat):
+    """Compare statistics computed by SQLite and from the column snapshot."""
+    downloader = modified_people(count)
+    with temporary_database(DATABASE_PROFILES['query']) as db:
+        ApiDataSave(downloader, 'results').save_data_in_batches(
+            SAVE_BATCH_SIZE)
+        obj = DatabaseFunctions(db.database, lambda db_name: db,
+                                cache_size=0)
+        start = time.perf_counter()
+        snapshot = obj.columnar().snapshot
+        report('snapshot', count, time.perf_counter() - start)
+        print(f'{"snapshot size":<24}{snapshot.size() / 2 ** 20:>10.1f} MB')
+
+        calls = {
+            'average age': lambda engine: engine.aggregate(
+                'Person', averages=('age',)),
+            'gender percentage': lambda engine: engine.aggregate(
+                'Person', 'gender'),
+            'most common city': lambda engine: engine.most_occurrences(
+                'city', 10),
+        }
+        for name, call in calls.items():
+            for engine, functions in (('sql', lambda: obj),
+                                      ('columnar', obj.columnar)):
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    call(functions())
+                seconds = (time.perf_counter() - start) / repeat
+                print(f'{name + " " + engine:<32}{seconds * 1000:>10.2f} ms')
+
+
+def insert_locations(db, ids, rng):
+    """Insert people with random coordinates quickly, bypassing peewee."""
+    connection = db.connection()
+    with db.atomic():
+        connection.executemany(
+            'INSERT INTO person (id, title, firstname, lastname, gender, '
+            'nationality, date_of_birth, age, days_to_birthday) '
+            "VALUES (?, 'mr', 'John', ?, 'male', 'GB', '1970-01-01', 50, 0)",
+            ((id, f'Smith{id}') for id in ids))
+        connection.executemany(
+            'INSERT INTO location (id, number, street, city, state, country, '
+            'postcode, timezone_offset, timezone_description, '
+            'coordinates_latitude, coordinates_longitude, person_id) '
+            "VALUES (?, 1, 'Street', 'City', 'State', 'Country', '00000', "
+            "'+0:00', 'UTC', ?, ?, ?)",
+            ((id, round(rng.uniform(-90, 90), 4),
+              round(rng.uniform(-180, 180), 4), id) for id in ids))
+
+
+@cli.command('near')
+@click.option('--count', default=1000000, help='Number of locations')
+@click.option('--queries', default=20, help='Number of searched points')
+@click.option('--radius', default=100.0, help='Distance searched in km')
+@click.option('--limit', default=10, help='Number of people found')
+@click.option('--inserted', default=10000,
+              help='Number of locations inserted to time the index triggers')
+def near(count, queries, radius, limit, inserted):
+    """Compare the R*Tree search of people near points with a full scan."""
+    rng = random.Random(1)
+    with temporary_database() as db:
+        start = time.perf_counter()
+        insert_locations(db, range(1, count + 1), rng)
+        report('insert', count, time.perf_counter() - start)
+        start = time.perf_counter()
+        insert_locations(db, range(count + 1, count + inserted + 1), rng)
+        report('insert unindexed', inserted, time.perf_counter() - start)
+        start = time.perf_counter()
+        add_location_index(db)
+        report('build index', count + inserted, time.perf_counter() - start)
+        start = time.perf_counter()
+        insert_locations(db, range(count + inserted + 1,
+                                   count + 2 * inserted + 1), rng)
+        report('insert indexed', inserted, time.perf_counter() - start)
+
+        obj = DatabaseFunctions(db.database, lambda db_name: db,
+                                cache_size=0)
+        scan = Location.select(
+            Location.coordinates_latitude, Location.coordinates_longitude,
+            Person.firstname, Person.lastname, Location.city,
+            Location.country).join(Person)
+        points = [(rng.uniform(-80, 80), rng.uniform(-180, 180))
+                  for _ in range(queries)]
+        durations = {'index': 0.0, 'scan': 0.0}
+        for latitude, longitude in points:
+            start = time.perf_counter()
+            found = obj.nearest(latitude, longitude, radius, limit)
+            durations['index'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            distances = ((haversine(latitude, longitude, *row[:2]), *row[2:],
+                          *row[:2]) for row in db.execute(scan))
+            expected = sorted(row for row in distances if row[0] <= radius)
+            durations['scan'] += time.perf_counter() - start
+            assert found == expected[:limit], (latitude, longitude)
+        for name, seconds in durations.items():
+            print(f'{"near " + name:<24}{seconds / queries * 1000:>10.2f} ms')
+
+
+@cli.command('export')
+@click.option('--count', default=100000, help='Number of people')
+def export(count):
+    """Compare ways of reading complete records of people.
+
+    Related rows are read by queries per person, by prefetch, or joined in
+    the single query of export-people.
+    """
+    downloader = modified_people(count)
+    with temporary_database(DATABASE_PROFILES['query']) as db:
+        ApiDataSave(downloader, 'results').save_data_in_batches(
+            SAVE_BATCH_SIZE)
+        obj = DatabaseFunctions(db.database, lambda db_name: db,
+                                cache_size=0)
+
+        def per_person():
+            for person in Person.select():
+                yield person, person.contact, person.location, person.login
+
+        def prefetched():
+            for person in prefetch(Person.select(), Contact, Location,
+                                   Login):
+                yield (person, person.contacts[0], person.locations[0],
+                       person.logins[0])
+
+        reads = (('query per person', per_person), ('prefetch', prefetched),
+                 ('join', lambda: obj.rows(obj.profiles())))
+        for name, read in reads:
+            profiler = Profiler()
+            with profiler.profile(db):
+                records = sum(1 for _ in read())
+            seconds = profiler.timings['total']
+            print(f'{name:<24}{records:>10} people {profiler.statements:>8} '
+                  f'queries {seconds:>8.3f} s')
+
+
+@cli.command('birthdays')
+@click.option('--count', default=1000000, help='Number of people')
+@click.option('--days', default=7, help='Number of days after today')
+@click.option('--repeat', default=10, help='Number of runs of every query')
+def birthdays(count, days, repeat):
+    """Compare finding upcoming birthdays by the index with alternatives."""
+    rng = random.Random(1)
+    with temporary_database() as db:
+        born = [date(1950, 1, 1) + timedelta(days=rng.randrange(25000))
+                for _ in range(count)]
+        with db.atomic():
+            db.connection().executemany(
+                'INSERT INTO person (title, firstname, lastname, gender, '
+                'nationality, date_of_birth, age, days_to_birthday, '
+                "birthday) VALUES ('mr', 'John', 'Smith', 'male', 'GB', ?, "
+                '50, 0, ?)',
+                ((day.isoformat(), birthday_ordinal(day)) for day in born))
+        today = date.today()
+        obj = DatabaseFunctions(db.database, lambda db_name: db,
+                                cache_size=0)
+        scan = Person.select(Person.date_of_birth).tuples()
+
+        def indexed():
+            return len(list(obj.rows(obj.upcoming_birthdays(days, today))))
+
+        def scanned():
+            return sum((next_birthday(date.fromisoformat(born), today) -
+                        today).days <= days for born, in db.execute(scan))
+
+        def rewrite():
+            # the stored counter of days has to be rewritten every day
+            people = db.execute(Person.select(Person.id,
+                                              Person.date_of_birth).tuples())
+            with db.atomic():
+                db.connection().executemany(
+                    'UPDATE person SET days_to_birthday = ? WHERE id = ?',
+                    [((next_birthday(date.fromisoformat(born), today) -
+                       today).days, id) for id, born in people])
+
+        for name, query in (('index range', indexed), ('full scan', scanned),
+                            ('daily rewrite', rewrite)):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                found = query()
+            seconds = (time.perf_counter() - start) / repeat
+            print(f'{name:<24}{seconds * 1000:>10.2f} ms '
+                  f'{found if found is not None else "":>10}')
+
+
+def search_rows(count, rng):
+    """Generate text of people indexed for full-text search."""
+    for id in range(1, count + 1):
+        gender = rng.choice(('male', 'female'))
+        first = rng.choice(FIRST_NAMES[gender])
+        last = rng.choice(LAST_NAMES)
+        _, country, state, city, _ = rng.choice(LOCATIONS)
+        number = rng.randint(100000, 999999)
+        yield (id, f'{rng.choice(TITLES[gender])} {first} {last}',
+               f'{first.lower()}.{last.lower()}{number}@example.com',
+               f'{first.lower()}{last.lower()}{number}',
+               f'{rng.randint(1, 9999)} {rng.choice(STREETS)}, {city}, '
+               f'{state}, {country}, {rng.randint(10000, 99999)}')
+
+
+@cli.command('search')
+@click.option('--count', default=2000000, help='Number of people')
+@click.option('--repeat', default=10, help='Number of runs of every search')
+def search(count, repeat):
+    """Compare full-text searches with LIKE scans of the same text."""
+    rng = random.Random(1)
+    with temporary_database() as db:
+        connection = db.connection()
+        connection.execute('CREATE TABLE plain (id INTEGER PRIMARY KEY, '
+                           'name, email, username, address)')
+        start = time.perf_counter()
+        with db.atomic():
+            for rows in chunked(search_rows(count, rng), 10000):
+                for table in ('personsearch', 'plain'):
+                    connection.executemany(
+                        f'INSERT INTO {table} (rowid, name, email, username, '
+                        f'address) VALUES (?, ?, ?, ?, ?)', rows)
+        report('index', count, time.perf_counter() - start)
+
+        obj = DatabaseFunctions(db.database, lambda db_name: db,
+                                cache_size=0)
+        username = connection.execute(
+            'SELECT username FROM plain WHERE id = ?',
+            (count // 2,)).fetchone()[0]
+        searches = {
+            'username': ([username], True),
+            'username prefix': ([username[:-2]], True),
+            'full name': (['alice', 'muller'], False),
+            'name prefix': (['mul'], True),
+            'street': (['bahnhofstrasse'], False),
+        }
+        for name, (words, prefix) in searches.items():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                found = list(obj.rows(obj.search(words, 10, prefix)))
+            fts = (time.perf_counter() - start) / repeat
+
+            # every word has to be found in any of the columns
+            condition = ' AND '.join(
+                '(name LIKE ? OR email LIKE ? OR username LIKE ? OR '
+                'address LIKE ?)' for _ in words)
+            params = [f'%{word}%' for word in words for _ in range(4)]
+            start = time.perf_counter()
+            matches = connection.execute(
+                f'SELECT count(*) FROM plain WHERE {condition}',
+                params).fetchone()[0]
+            like = time.perf_counter() - start
+            print(f'{name:<24}{len(found):>4} of {matches:>8} matches '
+                  f'{fts * 1000:>10.2f} ms {like * 1000:>10.2f} ms LIKE')
+
+
+@cli.command('startup')
+@click.option('--repeat', default=20, help='Number of runs')
+def startup(repeat):
+    """Measure the time people.py takes to start, compared with Python."""
+    for name, args in (('python', ['-c', 'pass']),
+                       ('people.py --help', ['people.py', '--help'])):
+        durations = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, *args], check=True,
+                           stdout=subprocess.DEVNULL)
+            durations.append(time.perf_counter() - start)
+        print(f'{name:<24}{median(durations) * 1000:>10.1f} ms')
+
+
+# Requests sent by the load test in turns
+LOAD_TEST_PATHS = (
+    '/gender-percentage',
+    '/average-age?gender=female',
+    '/most-common?category=city&limit=10',
+    '/born-between?lower=1970-01-01&upper=1970-01-31',
+    '/password-security?top=10',
+)
+
+
+@cli.command('load-test')
+@click.option('--url', help='Address of a running people.py serve, a server '
+                            'on the database from settings is started if '
+                            'it is not given')
+@click.option('--clients', default=8, help='Number of concurrent clients')
+@click.option('--requests', 'count', default=5000,
+              help='Number of requests sent by all clients')
+@click.option('--path', 'paths', multiple=True, type=str,
+              default=LOAD_TEST_PATHS,
+              help='Path of a request, may be repeated')
+def load_test(url, clients, count, paths):
+    """Measure requests per second and latency of the JSON service."""
+    server = None
+    if url is None:
+        with socket.socket() as free:
+            free.bind(('127.0.0.1', 0))
+            port = free.getsockname()[1]
+        server = subprocess.Popen([sys.executable, 'people.py', 'serve',
+                                   '--port', str(port)])
+        url = f'http://127.0.0.1:{port}'
+    host, port = url.split('://')[-1].rstrip('/').split(':')
+    try:
+        wait_for_server(host, int(port))
+        requests = counter()
+        durations = {path: [] for path in paths}
+        errors = []
+
+        def client():
+            # every client keeps its connection open, as a service would
+            connection = HTTPConnection(host, int(port))
+            for index in requests:
+                if index >= count:
+                    break
+                path = paths[index % len(paths)]
+                start = time.perf_counter()
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                durations[path].append(time.perf_counter() - start)
+                if response.status != 200:
+                    errors.append(path)
+            connection.close()
+
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print(f'{"Path":<52}{"Requests":>10}{"p50 ms":>10}{"p99 ms":>10}')
+    for path, times in (*durations.items(),
+                        ('all', sum(durations.values(), []))):
+        times = [duration * 1000 for duration in times]
+        print(f'{path:<52}{len(times):>10}{percentile(times, 0.5):>10.2f}'
+              f'{percentile(times, 0.99):>10.2f}')
+    print(f'{count} requests of {clients} clients in {seconds:.2f} s '
+          f'({count / seconds:.0f} requests/s), errors: {len(errors)}')
+
+
+def wait_for_server(host, port, timeout=10):
+    """Wait until the server accepts connections."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+# people.py commands timed by the suite, those of the columnar engine only if
+# NumPy is installed
+SUITE_COMMANDS = (
+    ('gender-percentage',),
+    ('average-age',),
+    ('average-age', '--gender', 'female'),
+    ('most-common', 'city', '--limit', '10'),
+    ('most-common', 'password', '--limit', '10'),
+    ('born-between', '1970-01-01', '1979-12-31'),
+    ('born-between', '1970-01-01', '1979-12-31', '--format', 'csv'),
+    ('password-security', '--top', '10'),
+    ('gender-percentage', '--engine', 'columnar'),
+    ('average-age', '--engine', 'columnar'),
+    ('most-common', 'city', '--limit', '10', '--engine', 'columnar'),
+    ('near', '52.2297', '21.0122', '--radius', '1000', '--limit', '10'),
+    ('search', 'oliver', 'austin', '--limit', '10'),
+    ('upcoming-birthdays', '--days', '30'),
+    ('export-people',),
+)
+
+
+@cli.command('suite')
+@click.option('--sizes', default='1000,10000,100000',
+              help='Comma separated numbers of people')
+@click.option('--output', default='benchmark.json',
+              type=click.Path(dir_okay=False),
+              help='File the results are written to')
+@click.option('--repeat', default=5,
+              help='Number of runs of every command, the median is kept')
+@click.option('--stream', is_flag=True, help='Load people on the fly')
+@click.option('--workers', default=1,
+              help='Number of processes generating people')
+def suite(sizes, output, repeat, stream, workers):
+    """Time loading people and people.py commands at several sizes."""
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'stream': stream,
+        'sizes': {},
+    }
+    for count in map(int, sizes.split(',')):
+        results['sizes'][count] = suite_size(count, repeat, stream, workers)
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+    print(f'Results written to {output}')
+
+
+def suite_size(count, repeat, stream, workers):
+    """Time generating, loading and querying the number of people."""
+    result = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'people.json')
+        start = time.perf_counter()
+        with open(path, 'w') as file:
+            write_people(file, count, workers=workers)
+        result['generate'] = time.perf_counter() - start
+        report('generate', count, result['generate'])
+
+        with temporary_database(DATABASE_PROFILES['query']) as db:
+            timings = {}
+            start = time.perf_counter()
+            load_people.main(stream, path, timings=timings)
+            timings['total'] = time.perf_counter() - start
+            result['load'] = timings
+            report('load', count, timings['total'])
+
+            result['commands'] = {}
+            for args in SUITE_COMMANDS:
+                if 'columnar' in args and find_spec('numpy') is None:
+                    continue
+                command = ' '.join(args)
+                result['commands'][command] = timings = {
+                    name: time_command(db, args, repeat, cache_size)
+                    for name, cache_size in (('computed', 0), ('cached', 128))
+                }
+                print(f'{command:<48}{timings["computed"]:>10.4f} s '
+                      f'{timings["cached"]:>10.4f} s cached')
+    return result
+
+
+def time_command(db, args, repeat, cache_size):
+    """Run the people.py command repeatedly, return the median duration."""
+    obj = DatabaseFunctions(db.database, lambda db_name: db,
+                            cache_size=cache_size)
+    durations = []
+    with obj.keep_connection(), open(os.devnull, 'w') as devnull, \
+            redirect_stdout(devnull):
+        # the first run fills the cache, it is not measured
+        people.cli.main(args, standalone_mode=False, obj=obj)
+        for _ in range(repeat):
+            start = time.perf_counter()
+            people.cli.main(args, standalone_mode=False, obj=obj)
+            durations.append(time.perf_counter() - start)
+    return median(durations)
+
+
+@cli.command('compare')
+@click.argument('old', type=click.File('r'))
+@click.argument('new', type=click.File('r'))
+@click.option('--threshold', default=1.2,
+              help='Ratio of durations reported as a regression')
+def compare(old, new, threshold):
+    """Compare durations of two suite results."""
+    old = flatten(json.load(old)['sizes'])
+    new = flatten(json.load(new)['sizes'])
+    regressions = 0
+    for name in sorted(old.keys() & new.keys(), key=list(new).index):
+        ratio = new[name] / old[name] if old[name] else float('inf')
+        mark = ''
+        if ratio > threshold:
+            mark = ' regression'
+            regressions += 1
+        print(f'{name:<72}{old[name]:>10.4f} s {new[name]:>10.4f} s '
+              f'{ratio:>8.2f}x{mark}')
+    print(f'Regressions: {regressions}')
+
+
+def flatten(results, prefix=''):
+    """Turn nested results into a dictionary of durations by their path."""
+    flat = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{name} '))
+        else:
+            flat[f'{prefix}{name}'] = value
+    return flat
+
+
+if __name__ == '__main__':
+    cli()
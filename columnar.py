@@ -0,0 +1,346 @@
+from functools import lru_cache
+import json
+import math
+import os
+import shutil
+
+import numpy as np
+from peewee import fn, JOIN
+
+from functions import QueryCache
+from models import Location, Login, Person
+from settings import COLUMNAR_CHUNK_SIZE, COLUMNAR_SNAPSHOT_SUFFIX
+
+# Columns written to the snapshot and their types. Text is replaced with
+# codes of values kept in a dictionary, dates with numbers of days since
+# 1970-01-01 and decimals with integers in units of their last place.
+SNAPSHOT_COLUMNS = (
+    (Person.age, 'int16'),
+    (Person.gender, 'text'),
+    (Person.nationality, 'text'),
+    (Person.date_of_birth, 'date'),
+    (Location.city, 'text'),
+    (Location.country, 'text'),
+    (Location.coordinates_latitude, 'decimal'),
+    (Location.coordinates_longitude, 'decimal'),
+    (Login.password, 'text'),
+    (Login.password_score, 'int8'),
+)
+# Julian day number of 1970-01-01
+UNIX_EPOCH_JULIAN_DAY = 2440587.5
+
+
+def column_name(field):
+    """Name of the field's column in the snapshot, e.g. person.age."""
+    return f'{field.model.__name__.lower()}.{field.name}'
+
+
+def load_snapshot(database):
+    """Open the snapshot of the current data, building it if it is stale.
+
+    Snapshots are kept next to the database file, in directories named after
+    the token of the database and the version of data they were built from.
+    """
+    root = database.database + COLUMNAR_SNAPSHOT_SUFFIX
+    # the version is read in the same transaction the data is exported in
+    with database.atomic():
+        state = QueryCache.identify(database)
+        data_version = state.data_version
+        directory = os.path.join(root, f'{state.token}-{data_version}')
+        if not os.path.exists(os.path.join(directory, 'snapshot.json')):
+            build_snapshot(database, directory, data_version)
+    return open_snapshot(directory)
+
+
+def build_snapshot(database, directory, data_version):
+    """Write columns of all people to typed column files in the directory.
+
+    Rows are read in chunks straight into memory-mapped files, so the data is
+    never held in memory at once. Snapshots of other versions are removed.
+    """
+    columns = [(column_name(field), field, kind)
+               for field, kind in SNAPSHOT_COLUMNS]
+    selection = [(fn.julianday(field) - UNIX_EPOCH_JULIAN_DAY).cast('INTEGER')
+                 if kind == 'date' else field
+                 for _, field, kind in columns]
+    query = (Person.select(*selection)
+             .join(Location, JOIN.LEFT_OUTER)
+             .switch(Person).join(Login, JOIN.LEFT_OUTER)
+             .order_by(Person.id))
+    count = Person.select().bind(database).count()
+
+    # the snapshot is complete once it is renamed, a concurrent build of the
+    # same version may have finished first
+    building = f'{directory}.{os.getpid()}.tmp'
+    os.makedirs(building, exist_ok=True)
+    try:
+        nulls = write_columns(database.execute(query), building, columns,
+                              count)
+        with open(os.path.join(building, 'snapshot.json'), 'w') as file:
+            json.dump({'data_version': data_version, 'count': count,
+                       'columns': {name: kind for name, _, kind in columns},
+                       'nulls': nulls,
+                       'scales': {name: 10 ** field.decimal_places
+                                  for name, field, kind in columns
+                                  if kind == 'decimal'}}, file)
+        os.rename(building, directory)
+    except OSError:
+        shutil.rmtree(building)
+        if not os.path.exists(os.path.join(directory, 'snapshot.json')):
+            raise
+    except BaseException:
+        shutil.rmtree(building)
+        raise
+    root = os.path.dirname(directory)
+    for name in os.listdir(root):
+        if name != os.path.basename(directory) and not name.endswith('.tmp'):
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def write_columns(cursor, directory, columns, count):
+    """Write rows read from the cursor to files of their columns.
+
+    Numbers of NULL values in the columns are returned.
+    """
+    arrays = [np.lib.format.open_memmap(
+        os.path.join(directory, f'{name}.npy'), mode='w+',
+        dtype=column_dtype(kind), shape=(count,))
+        for name, _, kind in columns]
+    dictionaries = {name: {} for name, _, kind in columns if kind == 'text'}
+    nulls = dict.fromkeys((name for name, _, _ in columns), 0)
+    start = 0
+    for rows in iter(lambda: cursor.fetchmany(COLUMNAR_CHUNK_SIZE), []):
+        for (name, field, kind), array, values in zip(columns, arrays,
+                                                      zip(*rows)):
+            nulls[name] += values.count(None)
+            if kind == 'text':
+                codes = dictionaries[name]
+                values = [codes.setdefault(value, len(codes))
+                          for value in values]
+            elif kind == 'decimal':
+                values = np.array([math.nan if value is None else value
+                                   for value in values]) * 10 ** \
+                    field.decimal_places
+                values = np.where(np.isnan(values), null_value(array.dtype),
+                                  np.rint(values))
+            elif None in values:
+                values = [null_value(array.dtype) if value is None else value
+                          for value in values]
+            array[start:start + len(rows)] = values
+        start += len(rows)
+    for array in arrays:
+        array.flush()
+    del arrays
+
+    for name, codes in dictionaries.items():
+        with open(os.path.join(directory, f'{name}.json'), 'w') as file:
+            json.dump(list(codes), file)
+        narrow_codes(os.path.join(directory, f'{name}.npy'), len(codes))
+    return nulls
+
+
+def column_dtype(kind):
+    """Type of values stored in the column file."""
+    if kind == 'text':
+        return np.uint32
+    if kind in ('date', 'decimal'):
+        return np.int32
+    return np.dtype(kind)
+
+
+def null_value(dtype):
+    """Value standing for NULL in a column of the type."""
+    return np.iinfo(dtype).min
+
+
+def narrow_codes(path, values):
+    """Store codes of text in the smallest type holding all of them."""
+    for dtype in (np.uint8, np.uint16):
+        if values <= np.iinfo(dtype).max + 1:
+            np.save(path, np.load(path).astype(dtype))
+            return
+
+
+@lru_cache(maxsize=8)
+def open_snapshot(directory):
+    """Open the snapshot once, its files never change after it is built."""
+    return Snapshot(directory)
+
+
+class Snapshot:
+    """Columns of people memory-mapped as NumPy arrays."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'snapshot.json')) as file:
+            metadata = json.load(file)
+        self.data_version = metadata['data_version']
+        self.count = metadata['count']
+        self.kinds = metadata['columns']
+        self.scales = metadata['scales']
+        self.nulls = metadata['nulls']
+        self.__columns = {}
+        self.__dictionaries = {}
+
+    def column(self, name):
+        """Get values, or codes of text values, of the column."""
+        if name not in self.__columns:
+            self.__columns[name] = np.load(
+                os.path.join(self.directory, f'{name}.npy'), mmap_mode='r')
+        return self.__columns[name]
+
+    def dictionary(self, name):
+        """Get text values of the column, indexed by their codes."""
+        if name not in self.__dictionaries:
+            with open(os.path.join(self.directory, f'{name}.json')) as file:
+                self.__dictionaries[name] = json.load(file)
+        return self.__dictionaries[name]
+
+    def valid(self, name):
+        """Get the mask of values which are not NULL, None if all are."""
+        if not self.nulls[name]:
+            return None
+        values = self.column(name)
+        if self.kinds[name] == 'text':
+            return values != self.dictionary(name).index(None)
+        return values != null_value(values.dtype)
+
+    def size(self):
+        """Total size of the snapshot files in bytes."""
+        return sum(entry.stat().st_size
+                   for entry in os.scandir(self.directory))
+
+
+class ColumnarFunctions:
+    """Compute statistics of DatabaseFunctions with vectorized operations.
+
+    Results have the same form as results of DatabaseFunctions, but they are
+    computed from the snapshot instead of the database.
+    """
+
+    def __init__(self, snapshot, models):
+        self.snapshot = snapshot
+        self.__models = models
+
+    def __name(self, field):
+        """Get the snapshot column of the field."""
+        name = column_name(field)
+        if name not in self.snapshot.kinds:
+            raise ValueError(f'Column not in the columnar snapshot: {name}')
+        return name
+
+    def aggregate(self, table, column=None, averages=(), condition=None,
+                  cond_value=None):
+        """Count entries and calculate averages, optionally grouped."""
+        snapshot = self.snapshot
+        selected = None
+        if condition:
+            selected = self.__equal(
+                self.__name(self.__models.field(table, condition)),
+                cond_value)
+        if column:
+            name = self.__name(self.__models.field(table, column))
+            codes, values = self.__groups(name)
+        else:
+            codes, values = np.zeros(snapshot.count, dtype=np.intp), [None]
+        counts = np.bincount(masked(codes, selected), minlength=len(values))
+
+        sums, value_counts, scales = {}, {}, {}
+        for average in averages:
+            name = self.__name(self.__models.field(table, average))
+            scales[average] = snapshot.scales.get(name, 1)
+            mask = both(selected, snapshot.valid(name))
+            sums[average] = np.bincount(
+                masked(codes, mask), weights=masked(snapshot.column(name),
+                                                    mask),
+                minlength=len(values))
+            value_counts[average] = (counts if mask is selected else
+                                     np.bincount(masked(codes, mask),
+                                                 minlength=len(values)))
+
+        def row(index=None):
+            def total(array):
+                return array.sum() if index is None else array[index]
+
+            result = {'count': int(total(counts))}
+            for average in averages:
+                count = int(total(value_counts[average]))
+                result[f'avg_{average}'] = (
+                    float(total(sums[average])) / count / scales[average]
+                    if count else None)
+            return result
+
+        result = row()
+        if not column:
+            # like SQL, a total without groups is a single row
+            result['groups'] = [row(0)]
+            return result
+        result['groups'] = []
+        for index in sort_values(values):
+            if counts[index]:
+                group = row(index)
+                group[column] = values[index]
+                result['groups'].append(group)
+        return result
+
+    def most_occurrences(self, column, limit):
+        """Find the most frequent values and their counts in the column."""
+        field = self.__models.column(column)
+        if field is None:
+            return None
+        name = self.__name(field)
+        codes, values = self.__groups(name)
+        counts = np.bincount(masked(codes, self.snapshot.valid(name)),
+                             minlength=len(values))
+        # ties are broken by the order of values
+        ranks = np.empty(len(values), dtype=np.intp)
+        ranks[sort_values(values)] = np.arange(len(values))
+        order = np.lexsort((ranks, -counts))[:limit]
+        return [(values[index], int(counts[index])) for index in order
+                if counts[index]]
+
+    def __groups(self, name):
+        """Get codes of values of the column and the values they stand for."""
+        kind = self.snapshot.kinds[name]
+        if kind == 'text':
+            return self.snapshot.column(name), self.snapshot.dictionary(name)
+        column = self.snapshot.column(name)
+        values, codes = np.unique(column, return_inverse=True)
+        nulls = values == null_value(values.dtype)
+        if kind == 'date':
+            values = values.astype('datetime64[D]').astype(str)
+        elif kind == 'decimal':
+            values = values / self.snapshot.scales[name]
+        return codes, [None if null else value
+                       for value, null in zip(values.tolist(), nulls)]
+
+    def __equal(self, name, value):
+        """Get the mask of entries equal to the value."""
+        values = self.snapshot.column(name)
+        if self.snapshot.kinds[name] == 'text':
+            dictionary = self.snapshot.dictionary(name)
+            if value not in dictionary:
+                return np.zeros(self.snapshot.count, dtype=bool)
+            return values == dictionary.index(value)
+        if self.snapshot.kinds[name] == 'date':
+            value = np.datetime64(value, 'D').astype(np.int64)
+        return values == value * self.snapshot.scales.get(name, 1)
+
+
+def masked(array, mask):
+    """Select entries of the array by the mask, all of them if it is None."""
+    return array if mask is None else array[mask]
+
+
+def both(mask, other):
+    """Combine masks, either of which may be None."""
+    if mask is None or other is None:
+        return other if mask is None else mask
+    return mask & other
+
+
+def sort_values(values):
+    """Indexes of values in the SQL order, NULL first."""
+    return sorted(range(len(values)),
+                  key=lambda index: (values[index] is not None,
+                                     values[index]))
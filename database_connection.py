@@ -1,9 +1,56 @@
+from contextlib import contextmanager
 import os
+from urllib.request import pathname2url
 
 from peewee import SqliteDatabase
+from playhouse.pool import PooledSqliteDatabase
 
+from settings import DATABASE_PROFILE, DATABASE_PROFILES, SERVE_CONNECTIONS, \
+    SERVE_POOL_TIMEOUT, SERVE_PRAGMAS
 
-def sqlite_connection(filename):
+
+def sqlite_connection(filename, profile=DATABASE_PROFILE):
     """Establish a connection to the SQLite database"""
-    cnx = SqliteDatabase(os.path.join('db', filename), pragmas={'foreign_keys': 1})
+    cnx = SqliteDatabase(os.path.join('db', filename),
+                         pragmas=DATABASE_PROFILES[profile])
     return cnx
+
+
+def read_only_pool(filename, max_connections=SERVE_CONNECTIONS):
+    """Create a pool of read-only connections to the existing database.
+
+    The database is never changed. Once migrated to the WAL journal, its
+    readers neither wait for each other nor for a writer, e.g.
+    load_people.py.
+    """
+    path = os.path.join('db', filename)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'Database not found: {path}')
+    # connections are shared by threads of the pool, one thread at a time
+    return PooledSqliteDatabase(
+        f'file:{pathname2url(os.path.abspath(path))}?mode=ro', uri=True,
+        check_same_thread=False, max_connections=max_connections,
+        timeout=SERVE_POOL_TIMEOUT, pragmas=SERVE_PRAGMAS)
+
+
+def use_profile(database, profile):
+    """Reconnect to the database using pragmas of the selected profile."""
+    database.init(database.database, pragmas=DATABASE_PROFILES[profile])
+
+
+@contextmanager
+def bulk_load(database, profile=DATABASE_PROFILE):
+    """Relax durability of the database for the time of loading data.
+
+    Safe settings of the profile are restored afterwards and statistics used
+    by the query planner are gathered for the loaded data.
+    """
+    use_profile(database, 'bulk-load')
+    try:
+        yield database
+    finally:
+        use_profile(database, profile)
+    # a failed load leaves nothing new to analyze, its connection might still
+    # hold the exclusive lock until the exception is gone
+    with database.connection_context():
+        database.execute_sql('ANALYZE')
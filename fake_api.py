@@ -0,0 +1,266 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import random
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import uuid
+
+import click
+
+FIRST_NAMES = {
+    'male': ('James', 'Lucas', 'Noah', 'Oliver', 'Mathis', 'Leon', 'Aiden',
+             'Hugo', 'Elias', 'Mario', 'Tomas', 'Jesse'),
+    'female': ('Emma', 'Olivia', 'Mia', 'Lena', 'Chloe', 'Sofia', 'Nora',
+               'Alice', 'Ella', 'Ida', 'Zoe', 'Julia'),
+}
+LAST_NAMES = ('Smith', 'Martin', 'Garcia', 'Muller', 'Nielsen', 'Lambert',
+              'Kowalski', 'Rossi', 'Jensen', 'Brown', 'Roux', 'Silva',
+              'Novak', 'Moreau', 'Schmidt', 'Wilson')
+TITLES = {'male': ('Mr', 'Monsieur'), 'female': ('Ms', 'Mrs', 'Miss')}
+PORTRAITS = {'male': 'men', 'female': 'women'}
+LOCATIONS = (
+    ('US', 'United States', 'Texas', 'Austin', 'SSN'),
+    ('GB', 'United Kingdom', 'Kent', 'Canterbury', 'NINO'),
+    ('FR', 'France', 'Gironde', 'Bordeaux', 'INSEE'),
+    ('DE', 'Germany', 'Bayern', 'Munich', ''),
+    ('DK', 'Denmark', 'Sjaelland', 'Roskilde', 'CPR'),
+    ('ES', 'Spain', 'Galicia', 'Vigo', 'DNI'),
+    ('BR', 'Brazil', 'Bahia', 'Salvador', ''),
+    ('NZ', 'New Zealand', 'Otago', 'Dunedin', ''),
+)
+STREETS = ('Main Street', 'Church Road', 'Park Avenue', 'Mill Lane',
+           'Rue de la Paix', 'Bahnhofstrasse', 'Calle Mayor', 'High Street')
+TIMEZONES = (('-5:00', 'Eastern Time (US & Canada), Bogota, Lima'),
+             ('0:00', 'Western Europe Time, London, Lisbon, Casablanca'),
+             ('+1:00', 'Brussels, Copenhagen, Madrid, Paris'),
+             ('+12:00', 'Auckland, Wellington, Fiji, Kamchatka'))
+PASSWORDS = ('password', 'qwerty', 'dragon', 'monkey', 'letmein', 'shadow',
+             'superman', 'trustno1', 'P@ssw0rd', 'iloveyou', '123456',
+             'Summer2020!', 'sunshine', 'football', 'hunter2')
+REFERENCE_DATE = datetime(2020, 9, 1)
+# Number of people generated and encoded by a worker process at once
+CHUNK_SIZE = 1000
+
+
+def generate_person(index, seed='abc'):
+    """Generate a single randomuser-shaped person dictionary."""
+    rnd = random.Random(f'{seed}-{index}')
+    gender = rnd.choice(('male', 'female'))
+    first = rnd.choice(FIRST_NAMES[gender])
+    last = rnd.choice(LAST_NAMES)
+    nat, country, state, city, id_name = rnd.choice(LOCATIONS)
+    offset, description = rnd.choice(TIMEZONES)
+    birth = REFERENCE_DATE - timedelta(days=rnd.randint(18 * 365, 80 * 365),
+                                       seconds=rnd.randint(0, 86399),
+                                       milliseconds=rnd.randint(0, 999))
+    registered = REFERENCE_DATE - timedelta(days=rnd.randint(30, 18 * 365),
+                                            seconds=rnd.randint(0, 86399))
+    password = rnd.choice(PASSWORDS)
+    salt = ''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz0123456789')
+                   for _ in range(8))
+    username = f'{first.lower()}{last.lower()}{rnd.randint(100, 999)}'
+    digest = (password + salt).encode()
+    return {
+        'gender': gender,
+        'name': {'title': rnd.choice(TITLES[gender]), 'first': first,
+                 'last': last},
+        'location': {
+            'street': {'number': rnd.randint(1, 9999),
+                       'name': rnd.choice(STREETS)},
+            'city': city,
+            'state': state,
+            'country': country,
+            'postcode': rnd.randint(10000, 99999),
+            'coordinates': {'latitude': f'{rnd.uniform(-90, 90):.4f}',
+                            'longitude': f'{rnd.uniform(-180, 180):.4f}'},
+            'timezone': {'offset': offset, 'description': description},
+        },
+        'email': f'{first.lower()}.{last.lower()}@example.com',
+        'login': {
+            'uuid': str(uuid.UUID(int=rnd.getrandbits(128), version=4)),
+            'username': username,
+            'password': password,
+            'salt': salt,
+            'md5': hashlib.md5(digest).hexdigest(),
+            'sha1': hashlib.sha1(digest).hexdigest(),
+            'sha256': hashlib.sha256(digest).hexdigest(),
+        },
+        'dob': {'date': _api_date(birth),
+                'age': (REFERENCE_DATE - birth).days // 365},
+        'registered': {'date': _api_date(registered),
+                       'age': (REFERENCE_DATE - registered).days // 365},
+        'phone': _phone_number(rnd),
+        'cell': _phone_number(rnd),
+        'id': {'name': id_name,
+               'value': str(rnd.randint(10 ** 8, 10 ** 9)) if id_name
+               else None},
+        'picture': {
+            size: f'https://randomuser.me/api/portraits/{directory}'
+                  f'{PORTRAITS[gender]}/{index % 100}.jpg'
+            for size, directory in (('large', ''), ('medium', 'med/'),
+                                    ('thumbnail', 'thumb/'))
+        },
+        'nat': nat,
+    }
+
+
+def generate_people(count, seed='abc', start=0):
+    """Generate randomuser-shaped people one at a time."""
+    for index in range(start, start + count):
+        yield generate_person(index, seed)
+
+
+def write_people(file, count, seed='abc', start=0, page=1, workers=1):
+    """Write generated people to a text file in the API response format.
+
+    People are generated and written in chunks, so any number of them can
+    be written without holding them in memory. More workers generate chunks
+    in separate processes, the written data is the same.
+    """
+    file.write('{"results": [')
+    for index, chunk in enumerate(people_chunks(count, seed, start,
+                                                workers)):
+        if index:
+            file.write(', ')
+        file.write(chunk)
+    info = {'seed': seed, 'results': count, 'page': page, 'version': '1.3'}
+    file.write(f'], "info": {json.dumps(info)}}}')
+
+
+def people_chunks(count, seed='abc', start=0, workers=1):
+    """Yield JSON encoded chunks of generated people, in their order."""
+    chunks = [(index, min(index + CHUNK_SIZE, start + count))
+              for index in range(start, start + count, CHUNK_SIZE)]
+    encode = partial(_encode_people, seed)
+    if workers == 1:
+        yield from map(encode, chunks)
+        return
+    with ProcessPoolExecutor(workers) as executor:
+        yield from executor.map(encode, chunks)
+
+
+def _encode_people(seed, chunk):
+    """Generate people with indexes in the range and encode them to JSON."""
+    return ', '.join(json.dumps(generate_person(index, seed))
+                     for index in range(*chunk))
+
+
+class FakeApiRequestHandler(BaseHTTPRequestHandler):
+    """Answer requests the same way as randomuser API does."""
+
+    def do_GET(self):
+        query = {key: value[-1] for key, value in
+                 parse_qs(urlparse(self.path).query).items()}
+        try:
+            results = int(query.get('results', 1))
+            page = int(query.get('page', 1))
+        except ValueError:
+            self.send_error(400)
+            return
+        seed = query.get('seed', 'abc')
+        if self.server.delay:
+            time.sleep(self.server.delay * results / 1000)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        # the body is streamed, its end is marked by closing the connection
+        body = io.TextIOWrapper(self.wfile, encoding='utf-8')
+        write_people(body, results, seed, (page - 1) * results, page)
+        body.flush()
+        body.detach()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    """Local stand-in for randomuser API running in a background thread."""
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0):
+        super(FakeApiServer, self).__init__((host, port),
+                                            FakeApiRequestHandler)
+        self.delay = delay
+        self.__thread = None
+
+    @property
+    def url(self):
+        """Url address to use instead of API_URL setting."""
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/api/?'
+
+    def start(self):
+        """Serve requests in a background thread."""
+        self.__thread = threading.Thread(target=self.serve_forever,
+                                         daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving requests and close the socket."""
+        self.shutdown()
+        self.server_close()
+        self.__thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command('serve')
+@click.option('--host', default='127.0.0.1', help='Host to listen on')
+@click.option('--port', default=8000, help='Port to listen on')
+@click.option('--delay', default=0.0,
+              help='Response delay per 1000 people [s]')
+def serve(host, port, delay):
+    """Serve generated people like randomuser API does."""
+    server = FakeApiServer(host, port, delay)
+    print(f'Serving fake randomuser API at {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+@cli.command('generate')
+@click.argument('file', type=click.File('w'))
+@click.option('--count', default=1000, help='Number of people')
+@click.option('--seed', default='abc', help='Seed of generated data')
+@click.option('--workers', default=1,
+              help='Number of processes generating people')
+def generate(file, count, seed, workers):
+    """Write generated people to FILE (- for stdout) in the API format."""
+    start = time.perf_counter()
+    write_people(file, count, seed, workers=workers)
+    seconds = time.perf_counter() - start
+    click.echo(f'Generated {count} people in {seconds:.1f} s', err=True)
+
+
+def _api_date(value):
+    """Format datetime the same way as randomuser API does."""
+    return (value.strftime('%Y-%m-%dT%H:%M:%S.') +
+            f'{value.microsecond // 1000:03d}Z')
+
+
+def _phone_number(rnd):
+    """Generate phone number with some non-digit characters."""
+    return (f'({rnd.randint(100, 999)})-{rnd.randint(100, 999)}-'
+            f'{rnd.randint(1000, 9999)}')
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,84 +1,496 @@
+import calendar
+from contextlib import contextmanager, nullcontext
+import csv
+from datetime import date, timedelta
+from decimal import Decimal
+from functools import lru_cache, wraps
 from importlib import import_module
-import re
+import heapq
+import json
+import math
+import string
+import sys
+import time
 
-from peewee import fn, SQL
+from peewee import ForeignKeyField, fn, JOIN, SQL
 
 from database_connection import sqlite_connection
-from settings import DATABASE
+from models import CachedResult, CacheState, Contact, Location, \
+    LocationIndex, Login, Person, PersonSearch
+from profiling import phase
+from settings import DATABASE, QUERY_CACHE_SIZE
+
+# Characters scored by password_score, each group counted once
+PASSWORD_SCORES = (
+    (frozenset(string.ascii_lowercase), 1),
+    (frozenset(string.ascii_uppercase), 2),
+    (frozenset(string.punctuation), 3),
+)
+# Points for digits, any Unicode decimal digits as matched by \d
+DIGIT_SCORE = 1
+# Passwords at least this long get LONG_PASSWORD_SCORE points
+LONG_PASSWORD = 8
+LONG_PASSWORD_SCORE = 5
+# Mean radius of the Earth, in kilometres
+EARTH_RADIUS = 6371.0088
+# Fields of complete records of people, keys of related rows and checksums
+# of the data are left out
+PROFILE_FIELDS = [Person.id] + [
+    field for model in (Person, Contact, Location, Login)
+    for field in model._meta.sorted_fields
+    if not (field.primary_key or isinstance(field, ForeignKeyField) or
+            field is Login.checksum)]
+
+
+class ModelRegistry:
+    """Map names of tables and columns to models and their fields.
+
+    Columns are found by their name alone, or qualified with the table name
+    (e.g. location.city), which is needed for names shared by tables. An
+    unqualified shared name belongs to the first model defining it.
+    """
+
+    def __init__(self, models):
+        self.__tables = {}
+        self.__columns = {}
+        for model in models:
+            self.__tables[model.__name__.lower()] = model
+            for name, field in model._meta.fields.items():
+                self.__columns.setdefault(name, field)
+                self.__columns[f'{model.__name__.lower()}.{name}'] = field
+
+    def model(self, table):
+        """Get the model of the table."""
+        try:
+            return self.__tables[table.lower()]
+        except KeyError:
+            raise ValueError(f'Unknown table: {table}') from None
+
+    @property
+    def models(self):
+        """All registered models."""
+        return list(self.__tables.values())
+
+    def field(self, table, column):
+        """Get the field of the column in the table."""
+        field = self.__columns.get(f'{table.lower()}.{column}')
+        if field is None:
+            raise ValueError(f'Unknown column: {table}.{column}')
+        return field
+
+    def column(self, column):
+        """Get the field of the column in any table, None if not found."""
+        table, _, name = column.rpartition('.')
+        return self.__columns.get(f'{table.lower()}.{name}' if table else name)
+
+
+@lru_cache(maxsize=None)
+def model_registry(models='models'):
+    """Build the registry of models listed in the module only once."""
+    return ModelRegistry(import_module(models).MODELS)
+
+
+def _encode_cached(value):
+    """Tag decimals and dates stored in the cache, so they are decoded back."""
+    if isinstance(value, Decimal):
+        return {'__decimal__': str(value)}
+    if type(value) is date:
+        return {'__date__': value.isoformat()}
+    return str(value)
+
+
+def _decode_cached(obj):
+    """Decode decimals and dates tagged by _encode_cached."""
+    if '__decimal__' in obj:
+        return Decimal(obj['__decimal__'])
+    if '__date__' in obj:
+        return date.fromisoformat(obj['__date__'])
+    return obj
+
+
+class QueryCache:
+    """Keep results of DatabaseFunctions calls in the database.
+
+    Queries run on the given database, whichever the models are bound to.
+    Results are tagged with the version of data, which is bumped whenever
+    data is saved, so a stale result is never returned. Above the size, the
+    least recently used results are evicted.
+    """
+
+    # Queries run on every call, written in SQL as building them with peewee
+    # takes longer than executing them
+    QUERIES = {
+        'lookup': 'SELECT r.result FROM cachedresult AS r '
+                  'JOIN cachestate AS s ON r.data_version = s.data_version '
+                  'WHERE r."key" = ? AND s.id = 1',
+        'touch': 'UPDATE cachedresult SET last_used = ? WHERE "key" = ?',
+        'hits': 'INSERT INTO cachestate (id, data_version, hits, misses) '
+                'VALUES (1, 0, 1, 0) '
+                'ON CONFLICT (id) DO UPDATE SET hits = hits + 1',
+        'misses': 'INSERT INTO cachestate (id, data_version, hits, misses) '
+                  'VALUES (1, 0, 0, 1) '
+                  'ON CONFLICT (id) DO UPDATE SET misses = misses + 1',
+    }
+    # Random token identifying a database, generated by SQLite when it is
+    # first needed
+    TOKEN = fn.lower(fn.hex(fn.randomblob(8)))
+
+    def __init__(self, size, database):
+        self.size = size
+        self.database = database
+
+    def execute(self, name, *params):
+        """Execute the query with values of its placeholders."""
+        return self.database.execute_sql(self.QUERIES[name], params)
+
+    def get(self, key, compute):
+        """Return the cached result or compute and cache it."""
+        if not self.size:
+            return compute()
+        with phase('cache lookup'):
+            cached = self.execute('lookup', key).fetchone()
+        if cached is not None:
+            with self.database.atomic():
+                self.execute('touch', time.time_ns(), key)
+                self.execute('hits')
+            return json.loads(cached[0], object_hook=_decode_cached)
+
+        # the result is tagged with the version read before computing it, so
+        # data saved meanwhile makes it stale
+        data_version = self.state(self.database).data_version
+        with phase('compute'):
+            result = json.dumps(compute(), default=_encode_cached)
+        with phase('cache store'), self.database.atomic():
+            self.database.execute(CachedResult.replace(
+                key=key, data_version=data_version, result=result,
+                last_used=time.time_ns()))
+            self.execute('misses')
+            self.evict()
+        return json.loads(result, object_hook=_decode_cached)
+
+    @staticmethod
+    def state(database=None):
+        """Get the version of data and cache statistics.
+
+        They are read from the database the models are bound to, unless
+        another one is given.
+        """
+        query = CacheState.select().where(CacheState.id == 1)
+        if database is not None:
+            query = query.bind(database)
+        return query.first() or CacheState(data_version=0, hits=0, misses=0)
+
+    @classmethod
+    def identify(cls, database):
+        """Get the state with the token of the database, generating it."""
+        state = cls.state(database)
+        if state.token is None:
+            database.execute(CacheState.insert(id=1, token=cls.TOKEN)
+                             .on_conflict(conflict_target=[CacheState.id],
+                                          update={CacheState.token:
+                                                  cls.TOKEN}))
+            state = cls.state(database)
+        return state
+
+    @staticmethod
+    def increment_query(name):
+        """Query increasing the data version or a counter of statistics."""
+        counter = getattr(CacheState, name)
+        return CacheState.insert(id=1, **{name: 1}).on_conflict(
+            conflict_target=[CacheState.id], update={counter: counter + 1})
+
+    @classmethod
+    def increment(cls, name):
+        """Increase the data version or a counter of cache statistics."""
+        cls.increment_query(name).execute()
+
+    def evict(self):
+        """Remove the least recently used results above the size."""
+        unused = CachedResult.select(CachedResult.key).order_by(
+            CachedResult.last_used.desc()).limit(-1).offset(self.size)
+        self.database.execute(CachedResult.delete().where(
+            CachedResult.key.in_(unused)))
+
+    def statistics(self):
+        """Summarize usage of the cache."""
+        state = self.state(self.database)
+        requests = state.hits + state.misses
+        return {'size': self.size,
+                'entries': CachedResult.select().bind(self.database).count(),
+                'data_version': state.data_version, 'hits': state.hits,
+                'misses': state.misses,
+                'hit_ratio': state.hits / requests if requests else None}
 
 
 class DatabaseFunctions:
-    """Retrieve data from the database."""
+    """Retrieve data from the database.
+
+    Queries are bound to the database of the object, models are left bound
+    to their own database, so objects never redirect each other's queries.
+    """
+
+    class _Decorators:
+        """Decorators for DatabaseFunctions class methods."""
+
+        @classmethod
+        def cached(cls, func):
+            """Reuse results computed for the current version of data."""
 
-    def __init__(self, db_name, db_connection, models='models'):
+            @wraps(func)
+            def wrapper(self, *args, **kwargs):
+                key = json.dumps([func.__name__, args, kwargs],
+                                 sort_keys=True)
+                return self.cache.get(key, lambda: func(self, *args, **kwargs))
+
+            return wrapper
+
+    def __init__(self, db_name, db_connection, models='models',
+                 cache_size=None):
         self.__db = db_connection(db_name)
-        self.__models = models
+        self.__models = model_registry(models)
+        self.__keep_open = False
+        self.cache = QueryCache(QUERY_CACHE_SIZE if cache_size is None
+                                else cache_size, self.__db)
+
+    @contextmanager
+    def keep_connection(self):
+        """Run all calls over a single connection kept open meanwhile."""
+        self.__db.connect(reuse_if_open=True)
+        self.__keep_open = True
+        try:
+            yield self
+        finally:
+            self.__keep_open = False
+            self.__db.close()
+
+    @property
+    def database(self):
+        """Database the calls are run on."""
+        return self.__db
+
+    def __connection(self):
+        """Connect for the time of a call, unless the connection is kept."""
+        return nullcontext(self.__db) if self.__keep_open else self.__db
 
     def count_entries(self, table, condition=None, cond_value=None):
         """Count number of entries in the selected table."""
-        cls = getattr(import_module(self.__models), table)
-        with self.__db:
+        cls = self.__models.model(table)
+        with self.__connection():
             if condition:
-                attr = getattr(cls, condition)
-                return cls.select().where(attr == cond_value).count()
+                attr = self.__models.field(table, condition)
+                return cls.select().where(attr == cond_value).bind(
+                    self.__db).count()
             else:
-                return cls.select().count()
+                return cls.select().bind(self.__db).count()
 
     def average_value(self, table, column, condition=None, cond_value=None):
         """Calculate the average value of the selected column."""
-        cls = getattr(import_module(self.__models), table)
-        attr = getattr(cls, column)
-        with self.__db:
+        cls = self.__models.model(table)
+        attr = self.__models.field(table, column)
+        with self.__connection():
             if condition:
-                cond_attr = getattr(cls, condition)
+                cond_attr = self.__models.field(table, condition)
                 return cls.select(fn.AVG(attr).alias('avg')).where(
-                    cond_attr == cond_value)
+                    cond_attr == cond_value).bind(self.__db)
             else:
-                return cls.select(fn.AVG(attr).alias('avg'))
+                return cls.select(fn.AVG(attr).alias('avg')).bind(self.__db)
+
+    @_Decorators.cached
+    def aggregate(self, table, column=None, averages=(), condition=None,
+                  cond_value=None):
+        """Count entries and calculate averages in a single query.
+
+        Entries are grouped by values of the column, if it is given. Totals
+        for all the entries are returned together with the groups.
+        """
+        cls = self.__models.model(table)
+        selection = [fn.COUNT(SQL('*')).alias('count')]
+        for average in averages:
+            attr = self.__models.field(table, average)
+            selection.append(fn.SUM(attr).coerce(False).alias(
+                f'sum_{average}'))
+            selection.append(fn.COUNT(attr).alias(f'count_{average}'))
+        query = cls.select(*selection)
+        if column:
+            attr = self.__models.field(table, column)
+            query = query.select_extend(attr).group_by(attr).order_by(attr)
+        if condition:
+            query = query.where(
+                self.__models.field(table, condition) == cond_value)
+        with self.__connection():
+            rows = list(query.dicts().bind(self.__db))
+
+        total = {'count': sum(row['count'] for row in rows)}
+        for average in averages:
+            total[f'sum_{average}'] = sum(
+                row[f'sum_{average}'] or 0 for row in rows)
+            total[f'count_{average}'] = sum(
+                row[f'count_{average}'] for row in rows)
+        result = self.__averages(total, averages)
+        result['groups'] = [self.__averages(row, averages) for row in rows]
+        return result
+
+    @staticmethod
+    def __averages(row, averages):
+        """Replace sums and counts of values with their averages."""
+        for average in averages:
+            total = row.pop(f'sum_{average}')
+            count = row.pop(f'count_{average}')
+            row[f'avg_{average}'] = total / count if count else None
+        return row
 
+    @_Decorators.cached
     def most_occurrences(self, column, limit):
-        """Find the most frequent values in the selected column."""
-        with self.__db:
-            tables = self.__db.get_tables()
-            for table in tables:
-                cls = getattr(import_module('models'), table.title())
-                attr = getattr(cls, column, None)
-                if attr is not None:
-                    break
-            else:
-                return None
+        """Find the most frequent values and their counts in the column."""
+        attr = self.__models.column(column)
+        if attr is None:
+            return None
+        with self.__connection():
+            return list(attr.model.select(
+                attr, fn.COUNT(attr).alias('count')).group_by(attr).order_by(
+                SQL('count').desc()).limit(limit).tuples().bind(self.__db))
+
+    def data_in_range(self, table, column, lower, upper, *columns):
+        """Collect data within the given range, ordered by the column.
+
+        Only the selected columns are collected, if any are given.
+        """
+        cls = self.__models.model(table)
+        attr = self.__models.field(table, column)
+        selection = [self.__models.field(table, name) for name in columns]
+        with self.__connection():
+            return cls.select(*selection).where(
+                attr.between(lower, upper)).order_by(attr).bind(self.__db)
+
+    def highest_values(self, table, column, limit, *columns):
+        """Get entries with the highest values of the column."""
+        cls = self.__models.model(table)
+        attr = self.__models.field(table, column)
+        selection = [self.__models.field(table, name) for name in columns]
+        with self.__connection():
+            return cls.select(*selection, attr).order_by(
+                attr.desc(), cls.id).limit(limit).bind(self.__db)
+
+    def nearest(self, latitude, longitude, radius, limit):
+        """Find people living closest to the point, within radius kilometres.
+
+        Candidates are looked up in the R*Tree of coordinates by bounding
+        boxes of the circle, only their distances are measured exactly.
+        Rows of distance, name, city, country and coordinates are returned.
+        """
+        query = (LocationIndex.select(
+            Location.coordinates_latitude, Location.coordinates_longitude,
+            Person.firstname, Person.lastname, Location.city,
+            Location.country)
+            .join(Location, on=(Location.id == LocationIndex.id))
+            .join(Person, on=(Location.person == Person.id)))
+        found = []
+        with self.__connection():
+            for min_longitude, max_longitude, min_latitude, max_latitude in \
+                    bounding_boxes(latitude, longitude, radius):
+                box = query.where(LocationIndex.min_longitude <= max_longitude,
+                                  LocationIndex.max_longitude >= min_longitude,
+                                  LocationIndex.min_latitude <= max_latitude,
+                                  LocationIndex.max_latitude >= min_latitude)
+                for row in self.__db.execute(box):
+                    distance = haversine(latitude, longitude, *row[:2])
+                    if distance <= radius:
+                        found.append((distance, *row[2:], *row[:2]))
+        return heapq.nsmallest(limit, found)
+
+    def profiles(self):
+        """Select complete records of people with PROFILE_FIELDS.
+
+        Contact, location and login of every person are joined in a single
+        query, instead of being read with a query per person and relation.
+        """
+        return (Person.select(*PROFILE_FIELDS)
+                .join(Contact, JOIN.LEFT_OUTER)
+                .switch(Person).join(Location, JOIN.LEFT_OUTER)
+                .switch(Person).join(Login, JOIN.LEFT_OUTER)
+                .order_by(Person.id)
+                .bind(self.__db))
+
+    def upcoming_birthdays(self, days, today):
+        """Find people whose birthdays are within the days after today.
+
+        People are selected by a range of birthday ordinals, split in two at
+        the end of the year, and ordered from the nearest birthday. The query
+        selects title, firstname, lastname and date_of_birth.
+        """
+        start = birthday_ordinal(today)
+        if start == 301 and not calendar.isleap(today.year):
+            # birthdays on 29 February are celebrated today
+            start = 229
+        end = today + timedelta(days=days)
+        query = Person.select(Person.title, Person.firstname,
+                              Person.lastname, Person.date_of_birth)
+        if end.year == today.year:
+            query = query.where(Person.birthday.between(
+                start, birthday_ordinal(end)))
+        elif end.year == today.year + 1:
+            query = query.where((Person.birthday >= start) |
+                                (Person.birthday <= birthday_ordinal(end)))
+        return query.order_by(Person.birthday < start, Person.birthday,
+                              Person.id).bind(self.__db)
+
+    def search(self, words, limit, prefix=True):
+        """Find people matching all words, the best matches first.
+
+        Words are matched in names, emails, usernames and addresses, as
+        prefixes of indexed words unless prefix is False. Matches are ranked
+        by BM25. The query selects id, name, email, username and address.
+        """
+        return (PersonSearch.select(
+            PersonSearch.rowid, PersonSearch.name, PersonSearch.email,
+            PersonSearch.username, PersonSearch.address)
+            .where(PersonSearch.match(match_expression(words, prefix)))
+            .order_by(PersonSearch.rank())
+            .limit(limit)
+            .bind(self.__db))
+
+    def columnar(self):
+        """Get functions computing statistics from the columnar snapshot.
+
+        The snapshot is rebuilt first, if the data has changed since.
+        """
+        from columnar import ColumnarFunctions, load_snapshot
 
-            return cls.select(attr, fn.COUNT(attr).alias('count')).group_by(
-                attr).order_by(SQL('count').desc()).limit(limit)
+        with self.__connection():
+            snapshot = load_snapshot(self.__db)
+        return ColumnarFunctions(snapshot, self.__models)
 
-    def data_in_range(self, table, column, lower, upper):
-        """Collect data within the given range."""
-        cls = getattr(import_module(self.__models), table)
-        attr = getattr(cls, column)
-        with self.__db:
-            return cls.select().where(attr.between(lower, upper))
+    def rows(self, query):
+        """Stream rows of the query straight from the database cursor.
+
+        Values are returned as they are stored, without conversion to types
+        of model fields (e.g. dates are ISO formatted strings).
+        """
+        return self.__db.execute(query)
 
     def get_data(self, table, *columns):
         """Get data from selected table."""
-        cls = getattr(import_module(self.__models), table)
+        cls = self.__models.model(table)
         attr = []
         for column in columns:
-            attr.append(getattr(cls, column))
-        return cls.select(*attr)
+            attr.append(self.__models.field(table, column))
+        return cls.select(*attr).bind(self.__db)
 
 
 class Result:
     """Display the result in the terminal."""
 
-    def __init__(self, result, prefix=None, suffix=None):
+    def __init__(self, result, prefix=None, suffix=None, columns=None):
         self.__result = result
         self.__prefix = prefix
         self.__suffix = suffix
+        self.__columns = columns
 
-    def display_multiple(self):
-        """Print multiple results."""
-        for line in self.__result:
-            print(*line)
+    def display_multiple(self, output_format='text'):
+        """Print multiple results in the selected format."""
+        with phase('output'):
+            write_rows(sys.stdout, self.__result, output_format,
+                       self.__columns)
 
     def display_single(self):
         """Format and print the result."""
@@ -88,28 +500,121 @@ class Result:
             print(result_string)
 
 
-def db_functions(func):
-    """Pass DatabaseFunction object to decorated function."""
+def write_rows(file, rows, output_format='text', columns=None):
+    """Write rows to the file in the selected format, one row per line.
+
+    Rows are consumed one at a time, so they can be streamed from a cursor.
+    Names of the columns are written in the header of CSV and TSV files and
+    used as keys of JSON objects.
+    """
+    if output_format == 'text':
+        file.writelines(' '.join(map(str, row)) + '\n' for row in rows)
+    elif output_format in ('csv', 'tsv'):
+        writer = csv.writer(file, delimiter=',' if output_format == 'csv'
+                            else '\t', lineterminator='\n')
+        if columns:
+            writer.writerow(columns)
+        writer.writerows(rows)
+    elif output_format == 'jsonl':
+        encode = json.JSONEncoder(default=_json_value).encode
+        file.writelines(encode(dict(zip(columns, row))) + '\n'
+                        for row in rows)
+    else:
+        raise ValueError(f'Unknown output format: {output_format}')
+
+
+def _json_value(value):
+    """Convert values not supported by JSON, e.g. dates and decimals."""
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+
+def database_functions():
+    """Create DatabaseFunctions object for the database from settings."""
+    return DatabaseFunctions(db_name=DATABASE, db_connection=sqlite_connection)
+
+
+def match_expression(words, prefix=True):
+    """Turn words into an FTS5 query matching all of them.
+
+    Every word is quoted, so characters such as @ or - are not taken for
+    the query syntax. A quoted word holding punctuation, e.g. an email,
+    matches a phrase of its parts.
+    """
+    terms = ['"{}"{}'.format(word.replace('"', '""'), '*' if prefix else '')
+             for word in words if word.strip()]
+    if not terms:
+        raise ValueError('Nothing to search for')
+    return ' '.join(terms)
+
+
+def haversine(latitude, longitude, other_latitude, other_longitude):
+    """Calculate the great-circle distance between points in kilometres."""
+    latitude, longitude, other_latitude, other_longitude = map(
+        math.radians, (latitude, longitude, other_latitude, other_longitude))
+    a = (math.sin((other_latitude - latitude) / 2) ** 2 +
+         math.cos(latitude) * math.cos(other_latitude) *
+         math.sin((other_longitude - longitude) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_boxes(latitude, longitude, radius):
+    """Get boxes of coordinates holding every point within the radius.
+
+    Boxes are given as (min_longitude, max_longitude, min_latitude,
+    max_latitude). A box crossing the antimeridian is split in two.
+    """
+    angle = radius / EARTH_RADIUS
+    min_latitude = latitude - math.degrees(angle)
+    max_latitude = latitude + math.degrees(angle)
+    if min_latitude <= -90 or max_latitude >= 90 or angle >= math.pi / 2:
+        # the circle covers a pole, all longitudes are within the radius
+        return [(-180, 180, max(min_latitude, -90), min(max_latitude, 90))]
+    # widest longitude span of the circle (J. Matuschek)
+    delta = math.degrees(math.asin(min(1.0, math.sin(angle) /
+                                       math.cos(math.radians(latitude)))))
+    min_longitude, max_longitude = longitude - delta, longitude + delta
+    if min_longitude < -180:
+        return [(min_longitude + 360, 180, min_latitude, max_latitude),
+                (-180, max_longitude, min_latitude, max_latitude)]
+    if max_longitude > 180:
+        return [(min_longitude, 180, min_latitude, max_latitude),
+                (-180, max_longitude - 360, min_latitude, max_latitude)]
+    return [(min_longitude, max_longitude, min_latitude, max_latitude)]
+
+
+def birthday_ordinal(day):
+    """Number ordering birthdays within a year, e.g. 1231 for 31 December.
+
+    Dates are given as dates or ISO formatted strings.
+    """
+    if isinstance(day, str):
+        return int(day[5:7]) * 100 + int(day[8:10])
+    return day.month * 100 + day.day
+
 
-    def wrapper(**kwargs):
-        obj = DatabaseFunctions(db_name=DATABASE,
-                                db_connection=sqlite_connection)
-        func(obj, **kwargs)
+def next_birthday(date_of_birth, today):
+    """Get the date of the next birthday, today included.
 
-    return wrapper
+    29 February is celebrated on 1 March in common years.
+    """
+    for year in (today.year, today.year + 1):
+        try:
+            birthday = date_of_birth.replace(year=year)
+        except ValueError:
+            birthday = date(year, 3, 1)
+        if birthday >= today:
+            return birthday
 
 
 def password_score(password):
     """Calculate the score for password security."""
-    score = 0
-    if bool(re.search(r'[a-z]', password)):
-        score += 1
-    if bool(re.search(r'[A-Z]', password)):
-        score += 2
-    if bool(re.search(r'\d', password)):
-        score += 1
-    if len(password) >= 8:
-        score += 5
-    if any(c in r"!\"#$%&'()*+,-./:;<=>?@[\]^_`{|}~" for c in password):
-        score += 3
+    characters = set(password)
+    score = LONG_PASSWORD_SCORE if len(password) >= LONG_PASSWORD else 0
+    for group, points in PASSWORD_SCORES:
+        if not characters.isdisjoint(group):
+            score += points
+    if any(character.isdecimal() for character in characters):
+        score += DIGIT_SCORE
     return score
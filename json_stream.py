@@ -0,0 +1,114 @@
+import codecs
+import json
+
+# Number of bytes read from the stream at once
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+DELIMITERS = WHITESPACE + ',:]}'
+
+_decoder = json.JSONDecoder()
+
+
+class JsonStream:
+    """Give lazy access to arrays stored in a JSON object read from stream.
+
+    The stream is closed once the array has been read, or iterating over it
+    has stopped.
+    """
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self.__stream = stream
+        self.__chunk_size = chunk_size
+
+    def __getitem__(self, key):
+        with self.__stream:
+            yield from iter_array(self.__stream, key, self.__chunk_size)
+
+
+class _JsonStreamReader:
+    """Decode JSON values from a binary stream keeping only a small buffer."""
+
+    def __init__(self, stream, chunk_size):
+        self.__stream = stream
+        self.__chunk_size = chunk_size
+        self.__decoder = codecs.getincrementaldecoder('utf-8')()
+        self.__buffer = ''
+        self.__position = 0
+        self.__eof = False
+
+    def read_chunk(self):
+        """Append next chunk of the stream to the buffer."""
+        if self.__eof:
+            return False
+        chunk = self.__stream.read(self.__chunk_size)
+        self.__eof = not chunk
+        text = self.__decoder.decode(chunk, final=self.__eof)
+        self.__buffer = self.__buffer[self.__position:] + text
+        self.__position = 0
+        return not self.__eof
+
+    def next_char(self):
+        """Skip whitespace and return next character without consuming it."""
+        while True:
+            while self.__position < len(self.__buffer):
+                char = self.__buffer[self.__position]
+                if char not in WHITESPACE:
+                    return char
+                self.__position += 1
+            if not self.read_chunk():
+                raise ValueError('Unexpected end of JSON data')
+
+    def expect(self, *chars):
+        """Consume next character, which has to be one of chars."""
+        char = self.next_char()
+        if char not in chars:
+            raise ValueError(f'Expected one of {chars!r} in JSON data, '
+                             f'found {char!r}')
+        self.__position += 1
+        return char
+
+    def value(self):
+        """Decode and consume next JSON value."""
+        self.next_char()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.__buffer,
+                                                 self.__position)
+            except json.JSONDecodeError:
+                if not self.read_chunk():
+                    raise
+                continue
+            # A number at the end of the buffer might be cut in half
+            if (end == len(self.__buffer) or self.__buffer[end] not in
+                    DELIMITERS) and self.read_chunk():
+                continue
+            self.__position = end
+            return value
+
+    def array_items(self):
+        """Decode items of the array one at a time."""
+        self.expect('[')
+        if self.next_char() == ']':
+            self.expect(']')
+            return
+        while True:
+            yield self.value()
+            if self.expect(',', ']') == ']':
+                return
+
+
+def iter_array(stream, key, chunk_size=CHUNK_SIZE):
+    """Yield items of the array stored under the key of a JSON object."""
+    reader = _JsonStreamReader(stream, chunk_size)
+    reader.expect('{')
+    if reader.next_char() == '}':
+        return
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        if name == key:
+            yield from reader.array_items()
+            return
+        reader.value()
+        if reader.expect(',', '}') == '}':
+            return
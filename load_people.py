@@ -1,26 +1,73 @@
-from datetime import datetime, date, timedelta
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date
+from functools import partial
+import hashlib
+from itertools import chain, islice
 import json
+from math import ceil
+from operator import itemgetter
+import os
+from queue import Empty, Full, Queue
 import re
+from secrets import token_hex
 import sys
+import threading
+import time
+from types import SimpleNamespace
 from urllib.error import URLError
 from urllib.parse import urlencode
 from urllib.request import urlopen
 
-from database_connection import sqlite_connection
-from models import Person, Contact, Login, Location
-from settings import DATABASE, API_URL, API_PARAMETERS, DATA_MODIFICATIONS
+import click
+from peewee import chunked, fn, IntegrityError
+
+from database_connection import bulk_load, sqlite_connection
+from functions import birthday_ordinal, next_birthday, password_score, \
+    QueryCache
+from json_stream import JsonStream
+from migrations import migrate_database
+from models import Person, Contact, Login, Location, PersonSearch
+import profiling
+from profiling import phase, Profiler, timed
+from settings import DATABASE, API_URL, API_PARAMETERS, API_PAGE_SIZE, \
+    API_WORKERS, DATA_MODIFICATIONS, MODIFICATION_WORKERS, \
+    MODIFICATION_CHUNK_SIZE, PARALLEL_MODIFICATION_THRESHOLD, \
+    PIPELINE_QUEUE_SIZE, SAVE_BATCH_SIZE
 
 db = sqlite_connection(DATABASE)
 
+# Lowest default limit of bound variables in a single SQLite statement
+SQLITE_MAX_VARIABLES = 999
 
-def main():
-    """Download data from API, modify and save to the database"""
 
-    # create downloader to handle getting data from randomuser API
-    downloader = ApiDataDownloader(API_URL, API_PARAMETERS)
+def main(stream=False, file=None, pipeline=False, incremental=False,
+         timings=None):
+    """Download data from API, modify and save to the database
+
+    Durations of loading phases in seconds are added to the timings
+    dictionary, when one is given.
+    """
+
+    # pipelined loader consumes people as they arrive
+    stream = stream or pipeline
 
-    # Send request to API and collect data
-    downloader.send_request()
+    if file:
+        # read data saved in the API format instead of downloading it
+        downloader = ApiDataFile(file)
+        with timed(timings, 'read'):
+            downloader.read_file(stream)
+    else:
+        # create downloader to handle getting data from randomuser API
+        downloader = ApiDataDownloader(API_URL, API_PARAMETERS)
+
+        # Send request to API and collect data, split large pulls into pages
+        with timed(timings, 'download'):
+            if API_PARAMETERS['results'] > API_PAGE_SIZE:
+                downloader.send_paginated_requests(API_PAGE_SIZE,
+                                                   API_WORKERS, stream)
+            else:
+                downloader.send_request(stream)
 
     # Check for API response, exit if false
     if not downloader.response:
@@ -30,15 +77,93 @@ def main():
     if downloader.data is None:
         sys.exit('Failed to get data from API')
 
+    # Bring the database schema up to date
+    with timed(timings, 'migrate'):
+        try:
+            migrate_database(Person._meta.database)
+        except ValueError as error:
+            sys.exit(str(error))
+
+    # people saved before are updated instead of being added again
+    incremental = incremental or Person.select().exists()
+
+    # Relax durability of the database while the data is being saved
+    with timed(timings, 'load'), bulk_load(Person._meta.database):
+        try:
+            save_data(downloader, stream, pipeline, incremental, timings)
+        except IntegrityError as error:
+            if incremental or 'login.uuid' not in str(error):
+                raise
+            sys.exit('People found twice in the data, '
+                     'load it with --incremental')
+        except ConnectionError as error:
+            # pages are downloaded while streamed people are saved
+            print(error)
+            sys.exit('Failed to get data from API')
+
+
+def save_data(downloader, stream, pipeline, incremental=False, timings=None):
+    """Modify downloaded data and save it to the database"""
+
+    if pipeline:
+        # download, modify and save data at the same time
+        loader = PipelinedLoader(DATA_MODIFICATIONS, SAVE_BATCH_SIZE,
+                                 PIPELINE_QUEUE_SIZE, incremental)
+        with timed(timings, 'save'):
+            loader.run(downloader.data['results'])
+        loader.print_report()
+        return
+
     # create modifier object, pass modifications to perform
     modifier = ApiDataModifier(downloader, DATA_MODIFICATIONS, 'results')
 
-    # modify data accordingly to configuration
-    modifier.execute_modifications()
+    if stream:
+        # modify and save people on the fly, one batch at a time
+        save_obj = ApiDataSave(modifier)
+    else:
+        # modify data accordingly to configuration
+        with timed(timings, 'modify'):
+            modifier.execute_modifications_in_parallel(
+                MODIFICATION_WORKERS, MODIFICATION_CHUNK_SIZE,
+                PARALLEL_MODIFICATION_THRESHOLD)
+        save_obj = ApiDataSave(downloader, 'results')
 
     # Save modified data to the database
-    save_obj = ApiDataSave(downloader, 'results')
-    save_obj.save_data_to_db()
+    with timed(timings, 'save'):
+        save_obj.save_data_in_batches(SAVE_BATCH_SIZE, incremental)
+    if incremental:
+        print_counts(save_obj.counts)
+
+
+def print_counts(counts):
+    """Print numbers of people inserted, updated and left unchanged."""
+    print(', '.join(f'{name.capitalize()}: {count}'
+                    for name, count in counts.items()))
+
+
+@click.command()
+@click.option('--stream', is_flag=True,
+              help='Process people on the fly to limit memory usage')
+@click.option('--file', type=click.Path(exists=True, dir_okay=False),
+              help='Load data saved in the API format from a file')
+@click.option('--pipeline', is_flag=True,
+              help='Download, modify and save data at the same time')
+@click.option('--incremental', is_flag=True,
+              help='Update people saved before instead of adding them again, '
+              'default when people have been saved')
+@click.option('--profile', is_flag=True,
+              help='Report time of loading phases and SQL statements')
+@click.option('--profile-stats', type=click.Path(dir_okay=False),
+              help='Also dump cProfile statistics to the file')
+def cli(stream, file, pipeline, incremental, profile, profile_stats):
+    """Download data from API, modify and save to the database"""
+    if not (profile or profile_stats):
+        sys.exit(main(stream, file, pipeline, incremental))
+    profiler = Profiler(profile_stats)
+    with profiler.profile(Person._meta.database):
+        code = main(stream, file, pipeline, incremental, profiler.timings)
+    profiler.report()
+    sys.exit(code)
 
 
 class ApiDataDownloader:
@@ -50,7 +175,7 @@ class ApiDataDownloader:
         self.response = False
         self.data = None
 
-    def send_request(self):
+    def send_request(self, stream=False):
         """Send request to API and gather data."""
         url = self.__api_url + urlencode(self.__parameters)
         try:
@@ -59,18 +184,114 @@ class ApiDataDownloader:
             print('Unable to connect to API')
         else:
             self.response = True
-            if response.status == 200:
-                self.data = json.loads(response.read())
+            if stream and response.status == 200:
+                # the response is closed once people have been read
+                self.data = JsonStream(response)
+                return
+            with response:
+                if response.status == 200:
+                    self.data = json.loads(response.read())
+
+    def send_paginated_requests(self, page_size, workers, stream=False):
+        """Send concurrent requests for consecutive pages and gather data."""
+        parameters = dict(self.__parameters)
+        # All pages have to be drawn from the same seed to be consistent
+        parameters.setdefault('seed', token_hex(8))
+        total = parameters['results']
+        pages = [dict(parameters, results=page_size, page=page)
+                 for page in range(1, ceil(total / page_size) + 1)]
+        responses = self.fetch_pages(pages, workers)
+
+        received, first_page = next(responses)
+        if not received:
+            responses.close()
+            print('Unable to connect to API')
+            return
+        self.response = True
+        if first_page is None:
+            responses.close()
+            return
+        results = islice(self.join_pages(first_page, responses), total)
+        if not stream:
+            try:
+                results = list(results)
+            except ConnectionError as error:
+                print(error)
+                return
+        info = dict(first_page['info'], results=total)
+        self.data = {'results': results, 'info': info}
+
+    def fetch_pages(self, pages, workers):
+        """Download pages concurrently, yield them in the original order.
+
+        Only a few pages more than the number of workers are kept in memory.
+        """
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for parameters in pages:
+                pending.append(executor.submit(self.fetch_page, parameters))
+                if len(pending) > workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def fetch_page(self, parameters):
+        """Send a single request to API, return response status and data."""
+        try:
+            with urlopen(self.__api_url + urlencode(parameters)) as response:
+                if response.status != 200:
+                    return True, None
+                return True, json.loads(response.read())
+        except URLError:
+            return False, None
+
+    @staticmethod
+    def join_pages(first_page, responses):
+        """Yield people from consecutive pages."""
+        for received, page_data in chain(((True, first_page),), responses):
+            if not received or page_data is None:
+                raise ConnectionError('Failed to get all pages from API')
+            yield from page_data['results']
+
+
+class ApiDataFile:
+    """Read data saved in the API format from a file."""
+
+    def __init__(self, path):
+        self.__path = path
+        self.response = False
+        self.data = None
+
+    def read_file(self, stream=False):
+        """Open the file and gather data."""
+        try:
+            file = open(self.__path, 'rb')
+        except OSError:
+            print('Unable to open data file')
+            return
+        self.response = True
+        if stream:
+            self.data = JsonStream(file)
+        else:
+            with file:
+                self.data = json.load(file)
 
 
 class ApiDataReader:
     """Read data received from API."""
 
     def __init__(self, downloader, data_location=None):
+        # Another reader can be used as a source to chain them in a pipeline
+        if isinstance(downloader, ApiDataReader):
+            self._data = iter(downloader)
+            return
         self._data = downloader.data
         if data_location:
             self._data = self._data[data_location]
 
+    def __iter__(self):
+        return iter(self._data)
+
     @staticmethod
     def get_value(dict_obj, key_path):
         """Get the value of the selected key from the dictionary."""
@@ -100,6 +321,20 @@ class ApiDataModifier(ApiDataReader):
                     return False
                 return self.set_value(dict_obj, key_path, new_value)
 
+            def compile_step(self, key_path):
+                parent = self.parent_accessor(key_path)
+                key = key_path[-1]
+
+                def step(dict_obj):
+                    container = parent(dict_obj)
+                    value = None if container is None else container.get(key)
+                    new_value = func(self, value)
+                    if new_value is not None and container is not None:
+                        container[key] = new_value
+
+                return step
+
+            wrapper.compile_step = compile_step
             return wrapper
 
         @classmethod
@@ -112,11 +347,83 @@ class ApiDataModifier(ApiDataReader):
                     return False
                 return self.set_value(dict_obj, key_path, value)
 
+            def compile_step(self, key_path):
+                parent = self.parent_accessor(key_path)
+                key = key_path[-1]
+
+                def step(dict_obj):
+                    value = func(self, dict_obj)
+                    if value is not None:
+                        container = parent(dict_obj)
+                        if container is not None:
+                            container[key] = value
+
+                return step
+
+            wrapper.compile_step = compile_step
             return wrapper
 
+        @classmethod
+        def remove_value(cls, func):
+            """Delete selected key from the dictionary."""
+
+            def compile_step(self, key_path):
+                parent = self.parent_accessor(key_path)
+                key = key_path[-1]
+
+                def step(dict_obj):
+                    container = parent(dict_obj)
+                    if container is not None:
+                        container.pop(key, None)
+
+                return step
+
+            func.compile_step = compile_step
+            return func
+
     def __init__(self, downloader, modifications, data_dict=None):
         super(ApiDataModifier, self).__init__(downloader, data_dict)
         self.__modifications = modifications
+        self.__plan = self.compile_modifications(modifications)
+
+    def compile_modifications(self, modifications):
+        """Turn modifications configuration into a list of functions.
+
+        Every function takes a single person's data and modifies it in place.
+        """
+        plan = []
+        for modification in modifications:
+            method = getattr(type(self), modification['name'], None)
+            compile_step = getattr(method, 'compile_step', None)
+            if compile_step is None:
+                raise ValueError(
+                    f"Unknown modification: {modification['name']}")
+            key_path = tuple(modification['key_path'])
+            step = compile_step(self, key_path)
+            profiler = profiling.active()
+            if profiler is not None:
+                step = profiling.timed_function(
+                    step, f"modify {modification['name']} "
+                          f"{'.'.join(key_path)}", profiler.timings)
+            plan.append(step)
+        return plan
+
+    @staticmethod
+    def parent_accessor(key_path):
+        """Create a function returning the dictionary with the last key."""
+        getters = [itemgetter(key) for key in key_path[:-1]]
+        if not getters:
+            return lambda dict_obj: dict_obj
+
+        def parent(dict_obj):
+            try:
+                for getter in getters:
+                    dict_obj = getter(dict_obj)
+            except (KeyError, TypeError):
+                return None
+            return dict_obj
+
+        return parent
 
     @staticmethod
     def set_value(dict_obj, key_path, value):
@@ -130,14 +437,45 @@ class ApiDataModifier(ApiDataReader):
         temp[key_path[-1]] = value
         return True
 
+    def __iter__(self):
+        """Modify people one at a time while iterating."""
+        for person_dict in self._data:
+            self.modify(person_dict)
+            yield person_dict
+
     def execute_modifications(self):
         """Perform all data modifications."""
+        plan = self.__plan
         for person_dict in self._data:
-            for modification in self.__modifications:
-                method = getattr(self, modification['name'])
-                method(person_dict, modification['key_path'])
+            for step in plan:
+                step(person_dict)
+
+    def execute_modifications_in_parallel(self, workers, chunk_size,
+                                          threshold):
+        """Perform all data modifications using a pool of processes.
+
+        Data is modified in chunks and put back in the original order. Small
+        amounts of data are modified in the current process, as starting the
+        pool and sending the data would take longer than modifying them.
+        """
+        workers = workers or os.cpu_count()
+        if workers == 1 or len(self._data) < threshold:
+            self.execute_modifications()
+            return
+        modify_chunk = partial(_modify_chunk, self.__modifications)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = executor.map(modify_chunk,
+                                  chunked(self._data, chunk_size))
+            self._data[:] = [person_dict for chunk in chunks
+                             for person_dict in chunk]
+
+    def modify(self, person_dict):
+        """Perform all modifications of a single person's data."""
+        for step in self.__plan:
+            step(person_dict)
 
     @staticmethod
+    @_Decorators.remove_value
     def delete_value(dict_obj, key_path):
         """Delete the value of the selected key from the dictionary."""
         temp = dict_obj
@@ -163,18 +501,61 @@ class ApiDataModifier(ApiDataReader):
         """Calculate days to next birthday."""
         today = date.today()
         birthdate = self.get_value(dict_obj, key_path=('dob', 'date'))
-        birthday = datetime.strptime(birthdate, "%Y-%m-%dT%H:%M:%S.%fZ").date()
-        birthday = birthday.replace(year=today.year)
-        if birthday < today:
-            birthday += timedelta(days=356)
+        birthday = next_birthday(date.fromisoformat(birthdate[:10]), today)
+        return (birthday - today).days
+
 
-        days_left = birthday - today
-        return days_left.days
+def _modify_chunk(modifications, chunk):
+    """Modify a chunk of people's data in a worker process."""
+    ApiDataModifier(SimpleNamespace(data=chunk),
+                    modifications).execute_modifications()
+    return chunk
 
 
 class ApiDataSave(ApiDataReader):
     """Save API data to the database."""
 
+    PERSON_DATASET = {
+        'firstname': ('name', 'first'), 'lastname': ('name', 'last'),
+        'title': ('name', 'title'), 'gender': ('gender',),
+        'nationality': ('nat',), 'id_name': ('id', 'name'),
+        'id_value': ('id', 'value'), 'date_of_birth': ('dob', 'date'),
+        'age': ('dob', 'age'),
+        'days_to_birthday': ('dob', 'days_to_birthday')
+    }
+    CONTACT_DATASET = {
+        'email': ('email',), 'phone': ('phone',), 'cell': ('cell',)
+    }
+    LOCATION_DATASET = {
+        'number': ('location', 'street', 'number'),
+        'street': ('location', 'street', 'name'),
+        'city': ('location', 'city'), 'state': ('location', 'state'),
+        'country': ('location', 'country'),
+        'postcode': ('location', 'postcode'),
+        'timezone_offset': ('location', 'timezone', 'offset'),
+        'timezone_description': ('location', 'timezone', 'description'),
+        'coordinates_latitude': ('location', 'coordinates', 'latitude'),
+        'coordinates_longitude': ('location', 'coordinates', 'longitude')
+    }
+    LOGIN_DATASET = {
+        'uuid': ('login', 'uuid'), 'username': ('login', 'username'),
+        'password': ('login', 'password'), 'salt': ('login', 'salt'),
+        'md5': ('login', 'md5'), 'sha1': ('login', 'sha1'),
+        'sha256': ('login', 'sha256'),
+        'registration_date': ('registered', 'date'),
+        'years_since_registration': ('registered', 'age')
+    }
+    # Columns calculated while loading, from the day of loading or other
+    # columns, left out of checksums so only changes of the data count
+    DERIVED_COLUMNS = {'days_to_birthday', 'birthday', 'password_score'}
+    # Columns holding dates, stored in the ISO format (YYYY-MM-DD)
+    DATE_COLUMNS = {'date_of_birth', 'registration_date'}
+
+    def __init__(self, downloader, data_location=None):
+        super(ApiDataSave, self).__init__(downloader, data_location)
+        # Number of people inserted, updated and left unchanged by upserts
+        self.counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+
     def save_data_to_db(self):
         """Save all persons' data to the database"""
         for person_dict in self._data:
@@ -182,59 +563,178 @@ class ApiDataSave(ApiDataReader):
             self.save_contact(person_dict, person)
             self.save_location(person_dict, person)
             self.save_login(person_dict, person)
+            rows = self.collect_person(person_dict)
+            self.set_person_id(rows, person.id)
+            with db:
+                self.index_people([rows])
+        with db:
+            QueryCache.increment('data_version')
+
+    def save_data_in_batches(self, batch_size, incremental=False):
+        """Save all persons' data to the database in batches."""
+        save_batch = self.upsert_batch if incremental else self.save_batch
+        saved = 0
+        for batch in chunked(self._data, batch_size):
+            saved += save_batch(batch)
+        return saved
+
+    def save_batch(self, dict_objs):
+        """Save a batch of persons' data in a single transaction."""
+        with Person._meta.database.atomic():
+            with phase('save collect'):
+                people = [self.collect_person(dict_obj)
+                          for dict_obj in dict_objs]
+            self.insert_people(people)
+            # results cached for the previous data become stale
+            QueryCache.increment('data_version')
+        return len(people)
+
+    def upsert_batch(self, dict_objs):
+        """Insert new and update changed people identified by login uuid.
+
+        People saved before are found with a single query per batch, their
+        rows are updated in bulk only if the checksum of the data differs.
+        """
+        people = {}
+        with phase('save collect'):
+            for dict_obj in dict_objs:
+                rows = self.collect_person(dict_obj)
+                # the last occurrence of a person in the batch wins
+                people[rows[Login]['uuid']] = rows
+        with Person._meta.database.atomic():
+            saved = {}
+            for uuids in chunked(people, SQLITE_MAX_VARIABLES):
+                saved.update((uuid, (person_id, checksum)) for
+                             uuid, person_id, checksum in Login.select(
+                    Login.uuid, Login.person, Login.checksum).where(
+                    Login.uuid.in_(uuids)).tuples())
+            new, changed = [], []
+            for uuid, rows in people.items():
+                if uuid not in saved:
+                    new.append(rows)
+                elif saved[uuid][1] != rows[Login]['checksum']:
+                    self.set_person_id(rows, saved[uuid][0])
+                    changed.append(rows)
+            self.insert_people(new)
+            self.insert_people(changed, update=True)
+            if new or changed:
+                QueryCache.increment('data_version')
+        self.counts['inserted'] += len(new)
+        self.counts['updated'] += len(changed)
+        self.counts['unchanged'] += len(people) - len(new) - len(changed)
+        return len(people)
+
+    def collect_person(self, dict_obj):
+        """Gather rows of all models holding the person's data."""
+        rows = {Person: self.collect_data(dict(self.PERSON_DATASET),
+                                          dict_obj)}
+        for model, dataset in ((Contact, self.CONTACT_DATASET),
+                               (Location, self.LOCATION_DATASET),
+                               (Login, self.LOGIN_DATASET)):
+            rows[model] = self.collect_data(dict(dataset), dict_obj)
+        rows[Login]['checksum'] = self.checksum(rows)
+        return rows
+
+    @classmethod
+    def checksum(cls, rows):
+        """Calculate checksum of the person's data to detect changes."""
+        data = json.dumps([{name: value for name, value in rows[model].items()
+                            if name not in cls.DERIVED_COLUMNS}
+                           for model in (Person, Contact, Location, Login)],
+                          sort_keys=True, default=str)
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    @staticmethod
+    def set_person_id(rows, person_id):
+        """Point rows of the person to the person's id."""
+        rows[Person]['id'] = person_id
+        for model in (Contact, Location, Login):
+            rows[model]['person'] = person_id
+
+    def insert_people(self, people, update=False):
+        """Insert rows of people, or update them if the people exist."""
+        if not people:
+            return
+        if not update:
+            # Person ids are assigned up front, so related rows can reference
+            # them without reading back every inserted person
+            first_id = (Person.select(fn.MAX(Person.id)).scalar() or 0) + 1
+            for person_id, rows in enumerate(people, start=first_id):
+                self.set_person_id(rows, person_id)
+        for model in (Person, Contact, Location, Login):
+            self.insert_rows(model, [rows[model] for rows in people], update)
+        self.index_people(people)
+
+    @classmethod
+    def index_people(cls, people):
+        """Index text of people for full-text search, replacing old entries.
+
+        FTS5 tables do not support upserts, entries are replaced by rowid.
+        """
+        rows = [cls.search_row(rows) for rows in people]
+        with phase('save personsearch'):
+            for chunk in chunked(rows, SQLITE_MAX_VARIABLES // len(rows[0])):
+                PersonSearch.insert_many(chunk).on_conflict_replace().execute()
+
+    @staticmethod
+    def search_row(rows):
+        """Get text of the person indexed for full-text search."""
+        person, location = rows[Person], rows[Location]
+        return {
+            'rowid': person['id'],
+            'name': f"{person['title']} {person['firstname']} "
+                    f"{person['lastname']}",
+            'email': rows[Contact]['email'],
+            'username': rows[Login]['username'],
+            'address': f"{location['number']} {location['street']}, "
+                       f"{location['city']}, {location['state']}, "
+                       f"{location['country']}, {location['postcode']}",
+        }
+
+    @staticmethod
+    def insert_rows(model, rows, update=False):
+        """Insert rows with as few statements as SQLite allows.
+
+        If update is set, existing rows of the same people are overwritten.
+        """
+        if not rows:
+            return
+        key = model.id if model is Person else model.person
+        preserve = [model._meta.fields[name] for name in rows[0]
+                    if name != key.name]
+        rows_per_query = max(1, SQLITE_MAX_VARIABLES // len(rows[0]))
+        with phase(f'save {model._meta.table_name}'):
+            for chunk in chunked(rows, rows_per_query):
+                query = model.insert_many(chunk)
+                if update:
+                    query = query.on_conflict(conflict_target=[key],
+                                              preserve=preserve)
+                query.execute()
 
     def save_person(self, dict_obj):
         """Save person to the database"""
-        dataset = {
-            'firstname': ('name', 'first'), 'lastname': ('name', 'last'),
-            'title': ('name', 'title'), 'gender': ('gender',),
-            'nationality': ('nat',), 'id_name': ('id', 'name'),
-            'id_value': ('id', 'value'), 'date_of_birth': ('dob', 'date'),
-            'age': ('dob', 'age'),
-            'days_to_birthday': ('dob', 'days_to_birthday')
-        }
-        self.collect_data(dataset, dict_obj)
+        dataset = self.collect_data(dict(self.PERSON_DATASET), dict_obj)
         with db:
             person = Person.create(**dataset)
         return person
 
     def save_contact(self, dict_obj, person):
         """Save contact data to the database"""
-        dataset = {'email': ('email',), 'phone': ('phone',), 'cell': ('cell',)}
-        self.collect_data(dataset, dict_obj)
+        dataset = self.collect_data(dict(self.CONTACT_DATASET), dict_obj)
         dataset['person'] = person
         with db:
             Contact.create(**dataset)
 
     def save_location(self, dict_obj, person):
         """Save location data to the database"""
-        dataset = {
-            'number': ('location', 'street', 'number'),
-            'street': ('location', 'street', 'name'),
-            'city': ('location', 'city'), 'state': ('location', 'state'),
-            'country': ('location', 'country'),
-            'postcode': ('location', 'postcode'),
-            'timezone_offset': ('location', 'timezone', 'offset'),
-            'timezone_description': ('location', 'timezone', 'description'),
-            'coordinates_latitude': ('location', 'coordinates', 'latitude'),
-            'coordinates_longitude': ('location', 'coordinates', 'longitude')
-        }
-        self.collect_data(dataset, dict_obj)
+        dataset = self.collect_data(dict(self.LOCATION_DATASET), dict_obj)
         dataset['person'] = person
         with db:
             Location.create(**dataset)
 
     def save_login(self, dict_obj, person):
         """Save login data to the database"""
-        dataset = {
-            'uuid': ('login', 'uuid'), 'username': ('login', 'username'),
-            'password': ('login', 'password'), 'salt': ('login', 'salt'),
-            'md5': ('login', 'md5'), 'sha1': ('login', 'sha1'),
-            'sha256': ('login', 'sha256'),
-            'registration_date': ('registered', 'date'),
-            'years_since_registration': ('registered', 'age')
-        }
-        self.collect_data(dataset, dict_obj)
+        dataset = self.collect_data(dict(self.LOGIN_DATASET), dict_obj)
         dataset['person'] = person
         with db:
             Login.create(**dataset)
@@ -243,7 +743,152 @@ class ApiDataSave(ApiDataReader):
         """Gather data defined in dataset."""
         for key in dataset:
             dataset[key] = self.get_value(dict_obj, dataset[key])
+        for key in self.DATE_COLUMNS.intersection(dataset):
+            dataset[key] = self.iso_date(dataset[key])
+        if 'password' in dataset:
+            dataset['password_score'] = password_score(dataset['password'])
+        if 'date_of_birth' in dataset:
+            dataset['birthday'] = birthday_ordinal(dataset['date_of_birth'])
+        return dataset
+
+    @staticmethod
+    def iso_date(value):
+        """Cut the time off the API timestamp, leaving ISO formatted date."""
+        if value is None:
+            return None
+        return value[:10]
+
+
+class PipelinedLoader:
+    """Download, modify and save data in concurrently working stages.
+
+    Stages are connected with bounded queues of batches, so a slow stage
+    holds back the previous ones instead of piling up data in memory. Only
+    the save stage writes to the database, using its own connection.
+    """
+
+    STAGES = ('download', 'modify', 'save')
+
+    def __init__(self, modifications, batch_size, queue_size,
+                 incremental=False):
+        self.__modifier = ApiDataModifier(SimpleNamespace(data=None),
+                                          modifications)
+        self.__save_obj = ApiDataSave(SimpleNamespace(data=None))
+        self.__save_batch = (self.__save_obj.upsert_batch if incremental
+                             else self.__save_obj.save_batch)
+        self.__incremental = incremental
+        self.__batch_size = batch_size
+        self.__queues = {'modify': Queue(queue_size),
+                         'save': Queue(queue_size)}
+        self.__stop = threading.Event()
+        self.__errors = []
+        self.stats = {stage: {'people': 0, 'busy': 0.0}
+                      for stage in self.STAGES}
+        self.queue_depths = {name: [] for name in self.__queues}
+        self.duration = 0.0
+
+    def run(self, people):
+        """Load people from iterable, return number of saved people."""
+        workers = (
+            (self.download, (people, self.__queues['modify'])),
+            (self.modify, (self.__queues['modify'], self.__queues['save'])),
+            (self.save, (self.__queues['save'],)),
+        )
+        threads = [threading.Thread(target=self.run_stage, args=worker,
+                                    daemon=True) for worker in workers]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.duration = time.perf_counter() - start
+        if self.__errors:
+            raise self.__errors[0]
+        return self.stats['save']['people']
+
+    def run_stage(self, stage, args):
+        """Run the stage, stop the other stages if it fails."""
+        try:
+            stage(*args)
+        except Exception as error:
+            self.__errors.append(error)
+            self.__stop.set()
+
+    def download(self, people, output):
+        """Collect downloaded people into batches."""
+        stats = self.stats['download']
+        people = iter(people)
+        while True:
+            start = time.perf_counter()
+            batch = list(islice(people, self.__batch_size))
+            stats['busy'] += time.perf_counter() - start
+            stats['people'] += len(batch)
+            if not batch or not self.put(output, batch):
+                break
+        self.put(output, None)
+
+    def modify(self, source, output):
+        """Perform all modifications of batches of people."""
+        stats = self.stats['modify']
+        for batch in self.batches(source, 'modify'):
+            start = time.perf_counter()
+            for person_dict in batch:
+                self.__modifier.modify(person_dict)
+            stats['busy'] += time.perf_counter() - start
+            stats['people'] += len(batch)
+            if not self.put(output, batch):
+                break
+        self.put(output, None)
+
+    def save(self, source):
+        """Save batches of people using a single database connection."""
+        stats = self.stats['save']
+        with Person._meta.database.connection_context():
+            for batch in self.batches(source, 'save'):
+                start = time.perf_counter()
+                stats['people'] += self.__save_batch(batch)
+                stats['busy'] += time.perf_counter() - start
+
+    def batches(self, source, name):
+        """Get batches from the queue until the end of data."""
+        while not self.__stop.is_set():
+            self.queue_depths[name].append(source.qsize())
+            try:
+                batch = source.get(timeout=0.1)
+            except Empty:
+                continue
+            if batch is None:
+                return
+            yield batch
+
+    def put(self, output, batch):
+        """Put batch into the queue, unless the pipeline has been stopped."""
+        while not self.__stop.is_set():
+            try:
+                output.put(batch, timeout=0.1)
+            except Full:
+                continue
+            return True
+        return False
+
+    def print_report(self):
+        """Print throughput of stages and depth of queues."""
+        print(f'Loaded {self.stats["save"]["people"]} people '
+              f'in {self.duration:.2f} s')
+        print(f'{"Stage":<10}{"People":>10}{"Busy [s]":>10}{"People/s":>12}')
+        for stage in self.STAGES:
+            people, busy = (self.stats[stage][key] for key in
+                            ('people', 'busy'))
+            rate = people / busy if busy else 0
+            print(f'{stage:<10}{people:>10}{busy:>10.2f}{rate:>12.0f}')
+        print(f'{"Queue":<10}{"Max":>10}{"Average":>10}')
+        for name, depths in self.queue_depths.items():
+            maximum = max(depths, default=0)
+            average = sum(depths) / len(depths) if depths else 0
+            print(f'{name:<10}{maximum:>10}{average:>10.1f}')
+        if self.__incremental:
+            print_counts(self.__save_obj.counts)
 
 
 if __name__ == '__main__':
-    sys.exit(main())
+    cli()
@@ -0,0 +1,305 @@
+import click
+from peewee import chunked, fn, JOIN
+from playhouse.migrate import migrate, SqliteMigrator
+
+from functions import password_score, QueryCache
+from models import db, CACHE_MODELS, CacheState, Contact, Location, \
+    LocationIndex, Login, Person, PersonSearch
+
+
+def add_query_indexes(database):
+    """Index columns filtered and grouped by people.py commands."""
+    for index in (Person.index(Person.gender, Person.age),
+                  Person.index(Person.nationality),
+                  Person.index(Person.date_of_birth),
+                  Location.index(Location.city),
+                  Location.index(Location.country),
+                  Login.index(Login.password)):
+        database.execute(index)
+
+
+def normalize_dates(database):
+    """Store dates from API timestamps in the ISO format (YYYY-MM-DD)."""
+    for model, field in ((Person, Person.date_of_birth),
+                         (Login, Login.registration_date)):
+        database.execute(model.update({field: fn.SUBSTR(field, 1, 10)}).where(
+            fn.LENGTH(field) > 10))
+
+
+def add_password_scores(database):
+    """Store scores of passwords in an indexed column."""
+    columns = {column.name for column in database.get_columns('login')}
+    if 'password_score' not in columns:
+        migrate(SqliteMigrator(database).add_column(
+            'login', 'password_score', Login.password_score))
+    database.execute(Login.index(Login.password_score.desc(), Login.id))
+    score_passwords(database)
+
+
+def score_passwords(database, rescore=False):
+    """Score passwords of logins, which have not been scored yet.
+
+    The data version is bumped in the same transaction if any login changed.
+    """
+    query = Login.select(Login.password).distinct()
+    if not rescore:
+        query = query.where(Login.password_score.is_null())
+    passwords = [password for password, in database.execute(query)]
+    updated = 0
+    with database.atomic():
+        for password in passwords:
+            score = password_score(password)
+            updated += database.execute(Login.update(
+                password_score=score).where(
+                Login.password == password,
+                Login.password_score.is_null() |
+                (Login.password_score != score))).rowcount
+        # databases from before the query cache have no data version yet
+        if updated and database.table_exists('cachestate'):
+            database.execute(QueryCache.increment_query('data_version'))
+    return len(passwords)
+
+
+def add_query_cache(database):
+    """Create tables of the query result cache."""
+    with database.bind_ctx(CACHE_MODELS):
+        database.create_tables(CACHE_MODELS)
+
+
+def add_unique_login_uuid(database):
+    """Identify people by unique login uuid.
+
+    People saved twice are never removed here, the migration fails until they
+    are removed with the dedupe-people command.
+    """
+    duplicates = len(database.execute(duplicate_people()).fetchall())
+    if duplicates:
+        raise ValueError(f'People saved twice: {duplicates}, remove them with '
+                         f'python migrations.py dedupe-people')
+
+    columns = {column.name for column in database.get_columns('login')}
+    if 'checksum' not in columns:
+        migrate(SqliteMigrator(database).add_column('login', 'checksum',
+                                                    Login.checksum))
+    database.execute(Login.index(Login.uuid, unique=True))
+
+
+def duplicate_people():
+    """Query of people whose login uuid had been saved before.
+
+    The first saved copy of every person is left out. The query selects id,
+    first and last name and login uuid.
+    """
+    first_logins = Login.select(fn.MIN(Login.id)).group_by(Login.uuid)
+    return (Person.select(Person.id, Person.firstname, Person.lastname,
+                          Login.uuid)
+            .join(Login).where(Login.id.not_in(first_logins))
+            .order_by(Person.id))
+
+
+def dedupe_people(database):
+    """Remove people saved twice, keeping the first saved copy of each.
+
+    Rows of the removed people are returned.
+    """
+    duplicates = list(database.execute(duplicate_people()))
+    for rows in chunked(duplicates, 999):
+        ids = [person_id for person_id, *_ in rows]
+        for model in (Contact, Location, Login):
+            database.execute(model.delete().where(model.person.in_(ids)))
+        database.execute(Person.delete().where(Person.id.in_(ids)))
+    # databases from before the query cache have no data version yet
+    if duplicates and database.table_exists('cachestate'):
+        database.execute(QueryCache.increment_query('data_version'))
+    return duplicates
+
+
+# Triggers copying coordinates of locations to their R*Tree. Upserts of
+# locations run the update trigger, deleted people take their locations and
+# index entries with them.
+LOCATION_INDEX_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS location_index_insert
+    AFTER INSERT ON location BEGIN
+        INSERT INTO locationindex VALUES (
+            new.id, new.coordinates_longitude, new.coordinates_longitude,
+            new.coordinates_latitude, new.coordinates_latitude);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS location_index_update
+    AFTER UPDATE OF coordinates_latitude, coordinates_longitude ON location
+    BEGIN
+        UPDATE locationindex SET
+            min_longitude = new.coordinates_longitude,
+            max_longitude = new.coordinates_longitude,
+            min_latitude = new.coordinates_latitude,
+            max_latitude = new.coordinates_latitude
+        WHERE id = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS location_index_delete
+    AFTER DELETE ON location BEGIN
+        DELETE FROM locationindex WHERE id = old.id;
+    END""",
+)
+
+
+def add_location_index(database):
+    """Index coordinates of locations in an R*Tree for proximity searches."""
+    with database.bind_ctx([LocationIndex]):
+        database.create_tables([LocationIndex])
+        database.execute(LocationIndex.insert_from(Location.select(
+            Location.id, Location.coordinates_longitude,
+            Location.coordinates_longitude, Location.coordinates_latitude,
+            Location.coordinates_latitude), fields=[
+            LocationIndex.id, LocationIndex.min_longitude,
+            LocationIndex.max_longitude, LocationIndex.min_latitude,
+            LocationIndex.max_latitude]).on_conflict_replace())
+    for trigger in LOCATION_INDEX_TRIGGERS:
+        database.execute_sql(trigger)
+
+
+def add_birthdays(database):
+    """Store birthdays as indexed month and day numbers."""
+    columns = {column.name for column in database.get_columns('person')}
+    if 'birthday' not in columns:
+        migrate(SqliteMigrator(database).add_column(
+            'person', 'birthday', Person.birthday))
+    database.execute(Person.update(birthday=fn.strftime(
+        '%m%d', Person.date_of_birth).cast('INTEGER')).where(
+        Person.birthday.is_null()))
+    database.execute(Person.index(Person.birthday))
+
+
+def add_search_index(database):
+    """Index names, emails, usernames and addresses for full-text search."""
+    with database.bind_ctx([PersonSearch]):
+        database.create_tables([PersonSearch])
+    rebuild_search_index(database)
+
+
+def rebuild_search_index(database):
+    """Fill the full-text index with the data of all people.
+
+    Text of every column is joined as in ApiDataSave.search_row, which keeps
+    the index up to date while people are loaded.
+    """
+    def text(*fields):
+        joined = fn.COALESCE(fields[0], '')
+        for separator, field in zip(fields[1::2], fields[2::2]):
+            joined = joined.concat(separator).concat(fn.COALESCE(field, ''))
+        return joined
+
+    with database.bind_ctx([PersonSearch]):
+        database.execute(PersonSearch.delete())
+        database.execute(PersonSearch.insert_from(
+            Person.select(
+                Person.id,
+                text(Person.title, ' ', Person.firstname, ' ',
+                     Person.lastname),
+                Contact.email, Login.username,
+                text(Location.number, ' ', Location.street, ', ',
+                     Location.city, ', ', Location.state, ', ',
+                     Location.country, ', ', Location.postcode))
+            .join(Contact, JOIN.LEFT_OUTER)
+            .switch(Person).join(Login, JOIN.LEFT_OUTER)
+            .switch(Person).join(Location, JOIN.LEFT_OUTER),
+            fields=[PersonSearch.rowid, PersonSearch.name,
+                    PersonSearch.email, PersonSearch.username,
+                    PersonSearch.address]))
+        return PersonSearch.select().count()
+
+
+def add_database_token(database):
+    """Identify the database by a random token stored with its data version."""
+    columns = {column.name for column in database.get_columns('cachestate')}
+    if 'token' not in columns:
+        migrate(SqliteMigrator(database).add_column(
+            'cachestate', 'token', CacheState.token))
+    database.execute(CacheState.update(token=QueryCache.TOKEN).where(
+        CacheState.token.is_null()))
+
+
+def use_wal_journal(database):
+    """Keep the journal in a write-ahead log, stored in the database file.
+
+    Readers and a writer, e.g. load_people.py, do not wait for each other.
+    """
+    database.pragma('journal_mode', 'wal')
+
+
+# Migrations applied in order, the number of applied migrations is stored in
+# the user_version of the database. Every migration has to be safe to run on
+# a database created from the current models.
+MIGRATIONS = (
+    add_query_indexes,
+    normalize_dates,
+    add_password_scores,
+    add_query_cache,
+    add_unique_login_uuid,
+    add_location_index,
+    add_search_index,
+    add_birthdays,
+    add_database_token,
+    use_wal_journal,
+)
+# Migrations run outside of a transaction, as the journal mode cannot be
+# changed within one
+NON_TRANSACTIONAL_MIGRATIONS = (use_wal_journal,)
+
+
+def migrate_database(database):
+    """Apply migrations the database has not gone through yet."""
+    version = database.pragma('user_version')
+    for number, migration in enumerate(MIGRATIONS[version:],
+                                       start=version + 1):
+        if migration in NON_TRANSACTIONAL_MIGRATIONS:
+            migration(database)
+            database.pragma('user_version', number)
+            continue
+        with database.atomic():
+            migration(database)
+            database.pragma('user_version', number)
+    return len(MIGRATIONS) - version
+
+
+@click.group(invoke_without_command=True)
+@click.pass_context
+def cli(ctx):
+    """Bring the schema of an existing database up to date."""
+    if ctx.invoked_subcommand is None:
+        try:
+            with db.connection_context():
+                applied = migrate_database(db)
+        except ValueError as error:
+            raise click.ClickException(str(error))
+        print(f'Migrations applied: {applied}')
+
+
+@cli.command('score-passwords')
+@click.option('--rescore', is_flag=True,
+              help='Score all passwords again, e.g. after scoring has changed')
+def score_passwords_command(rescore):
+    """Fill in missing password scores."""
+    with db.connection_context(), db.atomic():
+        scored = score_passwords(db, rescore)
+    print(f'Passwords scored: {scored}')
+
+
+@cli.command('dedupe-people')
+def dedupe_people_command():
+    """Remove people saved twice, keeping the first saved copy."""
+    with db.connection_context(), db.atomic():
+        removed = dedupe_people(db)
+    for person_id, firstname, lastname, uuid in removed:
+        print(f'Removed {person_id} {firstname} {lastname} {uuid}')
+    print(f'People removed: {len(removed)}')
+
+
+@cli.command('rebuild-search')
+def rebuild_search_command():
+    """Index all people for full-text search again."""
+    with db.connection_context(), db.atomic():
+        indexed = rebuild_search_index(db)
+    print(f'People indexed: {indexed}')
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,4 +1,5 @@
 from peewee import *
+from playhouse.sqlite_ext import FTS5Model, SearchField, VirtualModel
 
 from database_connection import sqlite_connection
 from settings import DATABASE
@@ -12,15 +13,20 @@ class Person(Model):
     firstname = TextField()
     lastname = TextField()
     gender = TextField()
-    nationality = TextField()
+    nationality = TextField(index=True)
     id_name = TextField(null=True)
     id_value = TextField(null=True)
-    date_of_birth = DateField()
+    date_of_birth = DateField(index=True)
     age = IntegerField()
     days_to_birthday = IntegerField()
+    # month and day of birth as a number, e.g. 1231 for 31 December
+    birthday = IntegerField(null=True, index=True)
 
     class Meta:
         database = db
+        indexes = (
+            (('gender', 'age'), False),
+        )
 
     @property
     def contact(self):
@@ -54,9 +60,9 @@ class Location(Model):
     """Represent a person's location data."""
     number = IntegerField()
     street = TextField()
-    city = TextField()
+    city = TextField(index=True)
     state = TextField()
-    country = TextField()
+    country = TextField(index=True)
     postcode = TextField()
     timezone_offset = TextField()
     timezone_description = TextField()
@@ -71,15 +77,17 @@ class Location(Model):
 
 class Login(Model):
     """Represent a person's login data."""
-    uuid = TextField()
+    uuid = TextField(unique=True)
     username = TextField()
-    password = TextField()
+    password = TextField(index=True)
+    password_score = IntegerField(null=True)
     salt = TextField()
     md5 = TextField()
     sha1 = TextField()
     sha256 = TextField()
     registration_date = DateField()
     years_since_registration = IntegerField()
+    checksum = TextField(null=True)
     person = ForeignKeyField(Person, backref='logins', on_delete='CASCADE',
                              unique=True)
 
@@ -87,8 +95,71 @@ class Login(Model):
         database = db
 
 
+# Ranking of passwords by score, ties in order of saving
+Login.add_index(Login.password_score.desc(), Login.id)
+
+MODELS = [Person, Contact, Location, Login]
+
+
+class CacheState(Model):
+    """Version of data and statistics of cached results, stored in one row."""
+    data_version = IntegerField(default=0)
+    # random identity of the database, versions of a recreated database
+    # start from 0 again
+    token = TextField(null=True)
+    hits = IntegerField(default=0)
+    misses = IntegerField(default=0)
+
+    class Meta:
+        database = db
+
+
+class CachedResult(Model):
+    """Result of a DatabaseFunctions call for a version of data."""
+    key = TextField(primary_key=True)
+    data_version = IntegerField()
+    result = TextField()
+    last_used = IntegerField(index=True)
+
+    class Meta:
+        database = db
+
+
+CACHE_MODELS = [CacheState, CachedResult]
+
+
+class LocationIndex(VirtualModel):
+    """R*Tree of coordinates of locations, kept up to date by triggers."""
+    id = IntegerField(primary_key=True)
+    min_longitude = FloatField()
+    max_longitude = FloatField()
+    min_latitude = FloatField()
+    max_latitude = FloatField()
+
+    class Meta:
+        database = db
+        extension_module = 'rtree'
+
+
+class PersonSearch(FTS5Model):
+    """Full-text index of people, the rowid is the id of the person."""
+    name = SearchField()
+    email = SearchField()
+    username = SearchField()
+    address = SearchField()
+
+    class Meta:
+        database = db
+        # prefixes of 2 and 3 characters are indexed, names are matched
+        # regardless of accents
+        options = {'prefix': '2 3',
+                   'tokenize': 'unicode61 remove_diacritics 2'}
+
+
+INDEX_MODELS = [LocationIndex, PersonSearch]
+
 # Initialize database and create tables based on models
 if __name__ == '__main__':
     db.connect(reuse_if_open=True)
-    db.create_tables([Person, Contact, Location, Login])
+    db.create_tables(MODELS + CACHE_MODELS + INDEX_MODELS)
     db.close()
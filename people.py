@@ -1,27 +1,110 @@
-from datetime import datetime
-import decimal
+from contextlib import ExitStack
+from functools import wraps
+import time
 
 import click
 
-from functions import db_functions, password_score, Result
+from settings import DATABASE, OUTPUT_FORMATS, SERVE_CONNECTIONS, SERVE_HOST, \
+    SERVE_PORT
+
+# Modules used by commands, e.g. peewee and the models, are imported when a
+# command runs, so --help and mistyped commands do not wait for them
 
 
 @click.group()
-def cli():
-    pass
+@click.option('--profile', is_flag=True,
+              help='Report time of phases and SQL statements of the command')
+@click.option('--profile-stats', type=click.Path(dir_okay=False),
+              help='Also dump cProfile statistics to the file')
+@click.pass_context
+def cli(ctx, profile, profile_stats):
+    if not (profile or profile_stats):
+        return
+    from functions import database_functions
+    from profiling import Profiler
+
+    # the command runs on the profiled database, the report is printed when
+    # the command is finished
+    if ctx.obj is None:
+        ctx.obj = database_functions()
+    profiler = Profiler(profile_stats)
+    stack = ExitStack()
+    stack.callback(profiler.report)
+    stack.enter_context(profiler.profile(ctx.obj.database))
+    ctx.call_on_close(stack.close)
+
+
+def format_option(func):
+    """Add the option selecting the format of results to the command."""
+    return click.option(
+        '--format', 'output_format', type=click.Choice(OUTPUT_FORMATS),
+        default='text', help='Format of results, text by default')(func)
+
+
+def engine_option(func):
+    """Add the option selecting how statistics are computed."""
+    return click.option(
+        '--engine', type=click.Choice(['sql', 'columnar']), default='sql',
+        help='Compute in SQLite (default) or from the columnar snapshot, '
+             'with vectorized NumPy operations')(func)
+
+
+def statistics_engine(obj, engine):
+    """Get the object computing statistics with the selected engine."""
+    if engine == 'sql':
+        return obj
+    try:
+        return obj.columnar()
+    except ModuleNotFoundError as error:
+        if error.name != 'numpy':
+            raise
+        raise click.ClickException('The columnar engine requires NumPy')
+
+
+def db_functions(func):
+    """Pass DatabaseFunction object to decorated function.
+
+    The object shared through the click context, e.g. by commands run in
+    a batch, is used if there is one.
+    """
+
+    @wraps(func)
+    def wrapper(**kwargs):
+        from functions import database_functions, DatabaseFunctions
+
+        ctx = click.get_current_context(silent=True)
+        obj = ctx.find_object(DatabaseFunctions) if ctx else None
+        func(obj or database_functions(), **kwargs)
+
+    return wrapper
 
 
 @cli.command('gender-percentage')
+@format_option
+@engine_option
 @db_functions
-def man_women_percentage(obj):
-    """Calculate man and women percentage in database"""
+def man_women_percentage(obj, output_format, engine):
+    """Calculate percentage of each gender in database"""
+    import decimal
+    from functions import Result
+
     decimal.getcontext().prec = 4
-    male = decimal.Decimal(obj.count_entries('Person', 'gender', 'male'))
-    female = decimal.Decimal(obj.count_entries('Person', 'gender', 'female'))
-    people = decimal.Decimal(obj.count_entries('Person'))
-    female_perc = female / people * 100
-    male_perc = male / people * 100
-    r = Result((female_perc, male_perc), ('Female', 'Male'), ('%', '%'))
+    result = statistics_engine(obj, engine).aggregate('Person', 'gender')
+    people = decimal.Decimal(result['count'])
+    genders = result['groups']
+    percentages = tuple(decimal.Decimal(group['count']) / people * 100
+                        for group in genders)
+    if output_format != 'text':
+        r = Result(zip((group['gender'] for group in genders), percentages),
+                   columns=('gender', 'percentage'))
+        r.display_multiple(output_format)
+        return None
+    if not result['count']:
+        print('There are no people in the database')
+        return None
+    r = Result(percentages,
+               tuple(group['gender'].capitalize() for group in genders),
+               ('%',) * len(genders))
     r.display_single()
 
 
@@ -29,16 +112,24 @@ def man_women_percentage(obj):
 @click.option('--gender',
               type=click.Choice(['male', 'female'], case_sensitive=False),
               default=None, help='Specify gender')
+@format_option
+@engine_option
 @db_functions
-def average_age(obj, gender):
+def average_age(obj, gender, output_format, engine):
     """Calculate the average age of people."""
-    kwargs = {'table': 'Person', 'column': 'age'}
+    from functions import Result
+
+    kwargs = {'table': 'Person', 'averages': ('age',)}
     description = ''
     if gender is not None:
         kwargs['condition'] = 'gender'
         kwargs['cond_value'] = gender
         description += f'{gender} '
-    avg_value = obj.average_value(**kwargs)[0].avg
+    avg_value = statistics_engine(obj, engine).aggregate(**kwargs)['avg_age']
+    if output_format != 'text':
+        r = Result(((gender, avg_value),), columns=('gender', 'average_age'))
+        r.display_multiple(output_format)
+        return None
     description += 'average age:'
     r = Result((avg_value,), (description.capitalize(),))
     r.display_single()
@@ -46,42 +137,262 @@ def average_age(obj, gender):
 
 @cli.command('most-common')
 @click.argument('category')
-@click.option('--limit', default=1, help='Number of results')
+@click.option('--limit', default=1, type=click.IntRange(1),
+              help='Number of results')
+@format_option
+@engine_option
 @db_functions
-def most_common(obj, limit, category):
+def most_common(obj, limit, category, output_format, engine):
     """Find the most common entries in the selected category."""
-    result = obj.most_occurrences(category, limit)
+    from functions import Result
+
+    try:
+        result = statistics_engine(obj, engine).most_occurrences(category,
+                                                                 limit)
+    except ValueError as error:
+        raise click.UsageError(str(error))
     if result is None:
         print(f'There is no information about {category}')
         return None
-    r = Result(((getattr(row, category), row.count) for row in result))
-    r.display_multiple()
+    r = Result(result, columns=(category, 'count'))
+    r.display_multiple(output_format)
 
 
 @cli.command('born-between')
 @click.argument('lower')
 @click.argument('upper')
+@format_option
 @db_functions
-def born_between(obj, lower, upper):
+def born_between(obj, lower, upper, output_format):
     """Find all people born between two dates."""
-    result = obj.data_in_range('Person', 'date_of_birth', lower, upper)
-    result_sorted = sorted(result, key=lambda x: x.date_of_birth)
-    r = Result(
-        ((p.title, p.firstname, p.lastname,
-          datetime.strptime(p.date_of_birth, "%Y-%m-%dT%H:%M:%S.%fZ").date())
-         for p in result_sorted))
-    r.display_multiple()
+    from functions import Result
+
+    columns = ('title', 'firstname', 'lastname', 'date_of_birth')
+    result = obj.data_in_range('Person', 'date_of_birth', lower, upper,
+                               *columns)
+    r = Result(obj.rows(result), columns=columns)
+    r.display_multiple(output_format)
+
+
+@cli.command('export-people')
+@click.option('--format', 'output_format', type=click.Choice(OUTPUT_FORMATS),
+              default='jsonl', help='Format of records, jsonl by default')
+@db_functions
+def export_people(obj, output_format):
+    """Write complete records of all people, one per line."""
+    from functions import PROFILE_FIELDS, Result
+
+    r = Result(obj.rows(obj.profiles()),
+               columns=tuple(field.name for field in PROFILE_FIELDS))
+    r.display_multiple(output_format)
+
+
+@cli.command('upcoming-birthdays')
+@click.option('--days', default=7, type=click.IntRange(0),
+              help='Number of days after today, 7 by default')
+@format_option
+@db_functions
+def upcoming_birthdays(obj, days, output_format):
+    """Find people whose birthdays are coming, today included."""
+    from datetime import date
+    from functions import next_birthday, Result
+
+    today = date.today()
+
+    def rows(people):
+        for *person, date_of_birth in people:
+            born = date.fromisoformat(date_of_birth)
+            birthday = next_birthday(born, today)
+            yield ((birthday - today).days, *person, date_of_birth,
+                   birthday.year - born.year)
+
+    result = obj.upcoming_birthdays(days, today)
+    r = Result(rows(obj.rows(result)),
+               columns=('days', 'title', 'firstname', 'lastname',
+                        'date_of_birth', 'turns'))
+    r.display_multiple(output_format)
+
+
+# negative coordinates are not taken for options
+@cli.command('near', context_settings={'ignore_unknown_options': True})
+@click.argument('latitude', type=click.FloatRange(-90, 90))
+@click.argument('longitude', type=click.FloatRange(-180, 180))
+@click.option('--radius', default=100.0, type=click.FloatRange(0),
+              help='Distance from the point in kilometres, 100 by default')
+@click.option('--limit', default=10, type=click.IntRange(1),
+              help='Number of people')
+@format_option
+@db_functions
+def near(obj, latitude, longitude, radius, limit, output_format):
+    """Find people living closest to the point."""
+    from functions import Result
+
+    rows = ((round(distance, 2), *row) for distance, *row in
+            obj.nearest(latitude, longitude, radius, limit))
+    r = Result(rows, columns=('distance_km', 'firstname', 'lastname', 'city',
+                              'country', 'latitude', 'longitude'))
+    r.display_multiple(output_format)
+
+
+@cli.command('search')
+@click.argument('words', nargs=-1, required=True)
+@click.option('--limit', default=10, type=click.IntRange(1),
+              help='Number of people')
+@click.option('--exact', is_flag=True,
+              help='Match whole words only, not their beginnings')
+@format_option
+@db_functions
+def search(obj, words, limit, exact, output_format):
+    """Find people by words of their names, emails, usernames or addresses."""
+    from functions import Result
+
+    try:
+        result = obj.search(words, limit, prefix=not exact)
+    except ValueError as error:
+        raise click.UsageError(str(error))
+    r = Result(obj.rows(result),
+               columns=('id', 'name', 'email', 'username', 'address'))
+    r.display_multiple(output_format)
 
 
 @cli.command('password-security')
+@click.option('--top', default=1, type=click.IntRange(1),
+              help='Number of passwords')
+@format_option
+@db_functions
+def password_security(obj, top, output_format):
+    """Find the most secure passwords."""
+    from functions import Result
+
+    result = obj.highest_values('Login', 'password_score', top, 'password')
+    if output_format != 'text':
+        r = Result(obj.rows(result), columns=('password', 'score'))
+        r.display_multiple(output_format)
+        return None
+    result = list(result.tuples())
+    if not result:
+        print('There are no passwords in the database')
+        return None
+    if top == 1:
+        r = Result((result[0][0],), ('The most secure password:',))
+        r.display_single()
+    else:
+        r = Result(result)
+        r.display_multiple()
+
+
+@cli.command('cache-stats')
 @db_functions
-def password_security(obj):
-    """Find the most secure password."""
-    result = obj.get_data('Login', 'password')
-    password = max((i.password for i in result), key=password_score)
-    r = Result((password,), ('The most secure password:',))
+def cache_stats(obj):
+    """Display statistics of the query result cache."""
+    from functions import Result
+
+    statistics = obj.cache.statistics()
+    if statistics['hit_ratio'] is not None:
+        statistics['hit_ratio'] = round(statistics['hit_ratio'], 3)
+    r = Result(tuple(statistics.values()),
+               tuple(f'{name.replace("_", " ").capitalize()}:'
+                     for name in statistics))
     r.display_single()
 
 
+@cli.command('columnar-snapshot')
+@db_functions
+def columnar_snapshot(obj):
+    """Export columns used by --engine columnar, unless they are current."""
+    from functions import Result
+
+    snapshot = statistics_engine(obj, 'columnar').snapshot
+    r = Result((snapshot.directory, snapshot.data_version, snapshot.count,
+                round(snapshot.size() / 2 ** 20, 2)),
+               ('Directory:', 'Data version:', 'People:', 'Size:'),
+               ('', '', '', 'MB'))
+    r.display_single()
+
+
+@cli.command('serve')
+@click.option('--host', default=SERVE_HOST, help='Address to listen on')
+@click.option('--port', default=SERVE_PORT, help='Port to listen on')
+@click.option('--connections', default=SERVE_CONNECTIONS,
+              type=click.IntRange(1),
+              help='Number of read-only database connections')
+def serve(host, port, connections):
+    """Answer statistics queries with JSON over HTTP, until interrupted."""
+    from database_connection import read_only_pool
+    from functions import DatabaseFunctions
+    from service import ENDPOINTS, QueryServer
+
+    try:
+        pool = read_only_pool(DATABASE, connections)
+    except FileNotFoundError as error:
+        raise click.ClickException(str(error))
+    # cached results are stored in the database, which is read-only here
+    obj = DatabaseFunctions(DATABASE, lambda db_name: pool, cache_size=0)
+    server = QueryServer(obj, host, port)
+    click.echo(f'Serving {", ".join(ENDPOINTS)} and /metrics at '
+               f'{server.url}', err=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close_all()
+
+
+@cli.command('batch')
+@click.argument('file', type=click.File('r'), default='-')
+def batch(file):
+    """Run commands read from FILE (or stdin), one per line."""
+    run_commands(file)
+
+
+@cli.command('shell')
+def shell():
+    """Run commands typed in, until exit or end of input."""
+    run_commands(prompt_lines('people> '))
+
+
+def run_commands(lines):
+    """Run command lines over a single database connection."""
+    import shlex
+    from functions import database_functions, DatabaseFunctions
+
+    obj = click.get_current_context().find_object(DatabaseFunctions) or \
+        database_functions()
+    commands = 0
+    start = time.perf_counter()
+    with obj.keep_connection():
+        for line in lines:
+            args = shlex.split(line, comments=True)
+            if not args:
+                continue
+            if args[0] in ('batch', 'shell'):
+                click.echo(f'Error: {args[0]} cannot be nested', err=True)
+                continue
+            try:
+                cli.main(args, prog_name='people.py', standalone_mode=False,
+                         obj=obj)
+            except click.ClickException as error:
+                error.show()
+            commands += 1
+    seconds = time.perf_counter() - start
+    click.echo(f'{commands} commands in {seconds:.3f} s '
+               f'({commands / seconds:.1f} commands/s)', err=True)
+
+
+def prompt_lines(prompt):
+    """Yield lines typed in by the user."""
+    while True:
+        try:
+            line = input(prompt)
+        except EOFError:
+            print()
+            return
+        if line.strip() in ('exit', 'quit'):
+            return
+        yield line
+
+
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,144 @@
+from contextlib import contextmanager, nullcontext
+import heapq
+import threading
+import time
+
+import click
+
+from settings import PROFILE_SLOWEST_STATEMENTS
+
+# Profiler of the running command, None when the command is not profiled
+_active = None
+# Timings are updated by threads of the pipelined loader at the same time
+_timings_lock = threading.Lock()
+
+
+def active():
+    """Get the profiler of the running command, if it is profiled."""
+    return _active
+
+
+@contextmanager
+def timed(timings, phase):
+    """Add the duration of the phase to timings, unless they are None."""
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(timings, phase, time.perf_counter() - start)
+
+
+def add_time(timings, phase, seconds):
+    """Add the seconds to the duration of the phase in timings."""
+    with _timings_lock:
+        timings[phase] = timings.get(phase, 0) + seconds
+
+
+def phase(name):
+    """Time the phase of the profiled command, do nothing otherwise."""
+    if _active is None:
+        return nullcontext()
+    return timed(_active.timings, name)
+
+
+def timed_function(func, phase, timings):
+    """Wrap the function adding the duration of every call to timings."""
+
+    def timed_func(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            add_time(timings, phase, time.perf_counter() - start)
+
+    return timed_func
+
+
+class Profiler:
+    """Collect durations of phases and of SQL statements run by peewee.
+
+    Statements are timed until SQLite returns the first row, rows fetched
+    later are included in the phases fetching them. If stats_file is given,
+    cProfile statistics of the profiled code are dumped to it.
+    """
+
+    def __init__(self, stats_file=None, slowest=PROFILE_SLOWEST_STATEMENTS):
+        self.stats_file = stats_file
+        self.timings = {}
+        self.statements = 0
+        self.statements_time = 0.0
+        # heap of the slowest statements, as (seconds, sql) pairs
+        self.slowest = []
+        self.__slowest_count = slowest
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def profile(self, database):
+        """Profile the code run inside, tracing statements of the database."""
+        global _active
+        previous = _active, database.__dict__.get('execute_sql')
+        execute_sql = database.execute_sql
+
+        def traced_execute_sql(sql, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return execute_sql(sql, *args, **kwargs)
+            finally:
+                self.record_statement(sql, time.perf_counter() - start)
+
+        database.execute_sql = traced_execute_sql
+        profile = None
+        if self.stats_file:
+            import cProfile
+            profile = cProfile.Profile()
+        _active = self
+        start = time.perf_counter()
+        if profile:
+            profile.enable()
+        try:
+            yield self
+        finally:
+            if profile:
+                profile.disable()
+                profile.dump_stats(self.stats_file)
+            self.timings['total'] = time.perf_counter() - start
+            _active = previous[0]
+            if previous[1] is None:
+                del database.execute_sql
+            else:
+                database.execute_sql = previous[1]
+
+    def record_statement(self, sql, seconds):
+        """Count the statement and keep it, if it is one of the slowest."""
+        with self.__lock:
+            self.statements += 1
+            self.statements_time += seconds
+            if len(self.slowest) < self.__slowest_count:
+                heapq.heappush(self.slowest, (seconds, sql))
+            elif self.slowest and seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (seconds, sql))
+
+    def report(self, file=None):
+        """Print durations of phases and statistics of SQL statements.
+
+        The report is printed to stderr, unless another file is given.
+        """
+        lines = [f'{"Phase":<48}{"Seconds":>10}']
+        lines.extend(f'{name:<48}{seconds:>10.4f}'
+                     for name, seconds in self.timings.items())
+        lines.append(f'SQL statements: {self.statements} '
+                     f'in {self.statements_time:.4f} s')
+        lines.extend(f'{seconds:>10.4f} s  {shorten(sql)}'
+                     for seconds, sql in sorted(self.slowest, reverse=True))
+        if self.stats_file:
+            lines.append(f'cProfile statistics written to {self.stats_file}')
+        click.echo('\n'.join(lines), file=file, err=True)
+
+
+def shorten(sql, width=100):
+    """Cut long statements, e.g. multi-row inserts, to a single line."""
+    sql = ' '.join(sql.split())
+    return sql if len(sql) <= width else sql[:width - 3] + '...'
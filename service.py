@@ -0,0 +1,227 @@
+from collections import deque
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from math import ceil
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from peewee import DatabaseError
+
+from settings import SERVE_HOST, SERVE_LATENCY_WINDOW, SERVE_PORT
+
+
+def gender_percentage(obj, params):
+    """Percentage of each gender."""
+    result = obj.aggregate('Person', 'gender')
+    if not result['count']:
+        return []
+    return [{'gender': group['gender'],
+             'percentage': group['count'] * 100 / result['count']}
+            for group in result['groups']]
+
+
+def average_age(obj, params):
+    """Average age of people, optionally of a single gender."""
+    kwargs = {'table': 'Person', 'averages': ('age',)}
+    gender = params.get('gender')
+    if gender is not None:
+        gender = gender.lower()
+        if gender not in ('male', 'female'):
+            raise ValueError('Gender has to be male or female')
+        kwargs['condition'] = 'gender'
+        kwargs['cond_value'] = gender
+    return {'gender': gender,
+            'average_age': obj.aggregate(**kwargs)['avg_age']}
+
+
+def most_common(obj, params):
+    """The most common values of the category and their counts."""
+    category = required(params, 'category')
+    result = obj.most_occurrences(category, integer(params, 'limit', 1))
+    if result is None:
+        raise ValueError(f'There is no information about {category}')
+    return [{category: value, 'count': count} for value, count in result]
+
+
+def born_between(obj, params):
+    """People born between two dates, both included, the oldest first."""
+    lower, upper = (iso_date(required(params, name))
+                    for name in ('lower', 'upper'))
+    columns = ('title', 'firstname', 'lastname', 'date_of_birth')
+    result = obj.data_in_range('Person', 'date_of_birth', lower, upper,
+                               *columns)
+    return [dict(zip(columns, row)) for row in obj.rows(result)]
+
+
+def password_security(obj, params):
+    """The most secure passwords and their scores."""
+    result = obj.highest_values('Login', 'password_score',
+                                integer(params, 'top', 1), 'password')
+    return [{'password': password, 'score': score}
+            for password, score in obj.rows(result)]
+
+
+# Endpoints of the service and functions answering them with JSON values
+ENDPOINTS = {
+    '/gender-percentage': gender_percentage,
+    '/average-age': average_age,
+    '/most-common': most_common,
+    '/born-between': born_between,
+    '/password-security': password_security,
+}
+
+
+def required(params, name):
+    """Get the value of the required query parameter."""
+    if name not in params:
+        raise ValueError(f'Missing parameter: {name}')
+    return params[name]
+
+
+def integer(params, name, default):
+    """Get the value of the query parameter as a positive integer."""
+    try:
+        value = int(params.get(name, default))
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise ValueError(f'{name} has to be a positive integer')
+    return value
+
+
+def iso_date(value):
+    """Check the date is given in the ISO format (YYYY-MM-DD)."""
+    date.fromisoformat(value)
+    return value
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of the values, None if there are none."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, ceil(fraction * len(values)) - 1)]
+
+
+class Metrics:
+    """Count requests of endpoints and keep their latest durations."""
+
+    def __init__(self, window=SERVE_LATENCY_WINDOW):
+        self.__window = window
+        self.__endpoints = {}
+        self.__lock = threading.Lock()
+
+    def record(self, endpoint, status, seconds):
+        """Add the request to statistics of the endpoint."""
+        with self.__lock:
+            metrics = self.__endpoints.setdefault(endpoint, {
+                'requests': 0, 'errors': 0, 'seconds': 0.0,
+                'durations': deque(maxlen=self.__window)})
+            metrics['requests'] += 1
+            metrics['errors'] += status >= 400
+            metrics['seconds'] += seconds
+            metrics['durations'].append(seconds)
+
+    def summary(self):
+        """Get numbers of requests and errors and latencies in ms."""
+        with self.__lock:
+            endpoints = {name: dict(metrics,
+                                    durations=list(metrics['durations']))
+                         for name, metrics in self.__endpoints.items()}
+        summary = {}
+        for name, metrics in endpoints.items():
+            durations = [seconds * 1000 for seconds in metrics['durations']]
+            summary[name] = {
+                'requests': metrics['requests'],
+                'errors': metrics['errors'],
+                'mean_ms': metrics['seconds'] * 1000 / metrics['requests'],
+                'p50_ms': percentile(durations, 0.5),
+                'p99_ms': percentile(durations, 0.99),
+                'max_ms': max(durations),
+            }
+        return summary
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    """Answer GET requests of endpoints with JSON."""
+
+    # connections are kept open between requests of a client, responses are
+    # sent without waiting for acknowledgement of the previous packets
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        endpoint = url.path.rstrip('/')
+        params = {key: value[-1] for key, value in
+                  parse_qs(url.query).items()}
+        status = 200
+        try:
+            if endpoint == '/metrics':
+                body = self.server.metrics.summary()
+            elif endpoint in ENDPOINTS:
+                with self.server.functions.database.connection_context():
+                    body = ENDPOINTS[endpoint](self.server.functions, params)
+            else:
+                status, body = 404, {'error': f'Unknown endpoint: {endpoint}'}
+                endpoint = 'unknown'
+        except ValueError as error:
+            status, body = 400, {'error': str(error)}
+        except DatabaseError as error:
+            status, body = 500, {'error': f'Database error: {error}'}
+        data = json.dumps(body, default=str).encode()
+        seconds = time.perf_counter() - start
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Server-Timing', f'app;dur={seconds * 1000:.3f}')
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.metrics.record(endpoint, status, seconds)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class QueryServer(ThreadingHTTPServer):
+    """Serve DatabaseFunctions statistics, a thread per client connection.
+
+    Threads share the functions object, its database should be a pool of
+    connections, e.g. database_connection.read_only_pool.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, functions, host=SERVE_HOST, port=SERVE_PORT):
+        super(QueryServer, self).__init__((host, port), QueryRequestHandler)
+        self.functions = functions
+        self.metrics = Metrics()
+        self.__thread = None
+
+    @property
+    def url(self):
+        """Url address of the service."""
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """Serve requests in a background thread."""
+        self.__thread = threading.Thread(target=self.serve_forever,
+                                         daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving requests and close the socket."""
+        self.shutdown()
+        self.server_close()
+        self.__thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
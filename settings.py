@@ -1,12 +1,38 @@
 # Name of the database file
 DATABASE = 'people.db'
 
+# Pragmas set on every connection to the database, grouped in profiles. The
+# "query" profile is used by default, "bulk-load" only while loading data.
+# The WAL journal is set once by the use_wal_journal migration.
+DATABASE_PROFILES = {
+    'query': {
+        'foreign_keys': 1,
+        'synchronous': 'normal',
+        'locking_mode': 'normal',
+        'cache_size': -64000,
+        'mmap_size': 268435456,
+    },
+    'bulk-load': {
+        'foreign_keys': 1,
+        'synchronous': 'off',
+        'locking_mode': 'exclusive',
+        'cache_size': -256000,
+        'mmap_size': 268435456,
+    },
+}
+DATABASE_PROFILE = 'query'
+
 # Url address to the randomuser API
 API_URL = 'https://randomuser.me/api/?'
 
 # Parameters used when a request is made to the randomuser API
 API_PARAMETERS = {'results': 1000, 'seed': 'abc'}
 
+# Maximum number of people downloaded in a single request, larger pulls are
+# split into pages downloaded concurrently by API_WORKERS threads
+API_PAGE_SIZE = 5000
+API_WORKERS = 4
+
 # Configuration of data modification to be performed
 DATA_MODIFICATIONS = (
     {'name': 'remove_non_digit', 'key_path': ('phone',)},
@@ -14,3 +40,52 @@ DATA_MODIFICATIONS = (
     {'name': 'days_to_birthday', 'key_path': ('dob', 'days_to_birthday',)},
     {'name': 'delete_value', 'key_path': ('picture',)},
 )
+
+# Number of processes modifying data (None means number of processors), the
+# size of data chunk sent to a single process and the minimal number of people
+# for which modifications are performed in parallel
+MODIFICATION_WORKERS = None
+MODIFICATION_CHUNK_SIZE = 2000
+PARALLEL_MODIFICATION_THRESHOLD = 20000
+
+# Number of people saved to the database in a single transaction
+SAVE_BATCH_SIZE = 1000
+
+# Number of batches waiting between stages of the pipelined loader
+PIPELINE_QUEUE_SIZE = 4
+
+# Maximum number of results of people.py statistics kept in the database,
+# the least recently used are evicted first (0 turns the cache off)
+QUERY_CACHE_SIZE = 128
+
+# Formats of results written by people.py query commands, text is meant for
+# people
+OUTPUT_FORMATS = ('text', 'csv', 'tsv', 'jsonl')
+
+# Columns used by --engine columnar are exported next to the database file,
+# to a directory named after it with the suffix, reading the given number of
+# rows at once
+COLUMNAR_SNAPSHOT_SUFFIX = '.columns'
+COLUMNAR_CHUNK_SIZE = 100000
+
+# Number of the slowest SQL statements listed by --profile
+PROFILE_SLOWEST_STATEMENTS = 5
+
+# Address of the people.py serve JSON service, the number of read-only
+# connections in its pool and the seconds a request waits for a connection
+# when all of them are in use
+SERVE_HOST = '127.0.0.1'
+SERVE_PORT = 8000
+SERVE_CONNECTIONS = 8
+SERVE_POOL_TIMEOUT = 10
+
+# Pragmas set on read-only connections of the service
+SERVE_PRAGMAS = {
+    'cache_size': -64000,
+    'mmap_size': 268435456,
+    'query_only': 1,
+}
+
+# Number of the latest request durations of every endpoint the percentiles
+# reported by the service are calculated from
+SERVE_LATENCY_WINDOW = 10000
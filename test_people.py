@@ -1,24 +1,58 @@
+import csv
+import datetime
+import decimal
+import io
+import json
+import random
 import re
+import shlex
+import subprocess
+import sys
+import threading
+from types import SimpleNamespace
+from urllib.error import HTTPError
+from urllib.request import urlopen
 
+from click.testing import CliRunner
+import peewee
 from peewee import SqliteDatabase
 import pytest
 
-from functions import password_score
+from database_connection import bulk_load, read_only_pool
+from fake_api import FakeApiServer, generate_people, write_people
+import functions
+from functions import bounding_boxes, haversine, next_birthday, \
+    password_score
+from json_stream import iter_array, JsonStream
+import load_people
 from load_people import ApiDataDownloader, ApiDataReader, ApiDataModifier, \
-    ApiDataSave
-from models import Person, Login, Location, Contact
-from settings import API_URL, DATA_MODIFICATIONS
+    ApiDataSave, PipelinedLoader
+import migrations
+from migrations import migrate_database, MIGRATIONS
+from models import CachedResult, CacheState, Contact, Location, \
+    LocationIndex, Login, Person, PersonSearch
+import people
+from profiling import add_time, Profiler
+from service import QueryServer
+from settings import DATA_MODIFICATIONS
 
-MODELS = [Person, Login, Location, Contact]
+MODELS = [Person, Login, Location, Contact, CacheState, CachedResult,
+          PersonSearch]
 API_PERSONS = 2
 
 db = SqliteDatabase(':memory:')
 
 
+@pytest.fixture(scope='module')
+def api_url():
+    with FakeApiServer() as server:
+        yield server.url
+
+
 @pytest.fixture
-def downloader_obj():
+def downloader_obj(api_url):
     api_param = {'results': API_PERSONS, 'seed': 'abc', }
-    downloader = ApiDataDownloader(API_URL, api_param)
+    downloader = ApiDataDownloader(api_url, api_param)
     return downloader
 
 
@@ -55,6 +89,44 @@ class TestApiDataDownloader:
         assert 'results' in downloader_obj.data, 'Data saved incorrectly'
         assert 'info' in downloader_obj.data, 'Data saved incorrectly'
 
+    def test_api_data_downloader_send_paginated_requests(self, api_url):
+        api_param = {'results': 7, 'seed': 'abc'}
+        single = ApiDataDownloader(api_url, api_param)
+        single.send_request()
+        paginated = ApiDataDownloader(api_url, api_param)
+        paginated.send_paginated_requests(page_size=3, workers=3)
+        error = 'Pages joined in the wrong order'
+        assert paginated.response is True, 'response attribute not True'
+        assert len(paginated.data['results']) == 7, 'Incorrect number of data'
+        assert paginated.data['results'] == single.data['results'], error
+
+    def test_api_data_downloader_stream(self, downloader_obj, api_url):
+        downloader_obj.send_request(stream=True)
+        streamed = list(downloader_obj.data['results'])
+        downloader = ApiDataDownloader(api_url, {'results': API_PERSONS,
+                                                 'seed': 'abc'})
+        downloader.send_request()
+        error = 'Streamed data differs from downloaded data'
+        assert streamed == downloader.data['results'], error
+
+    def test_api_data_downloader_paginated_stream(self, api_url):
+        api_param = {'results': 7, 'seed': 'abc'}
+        single = ApiDataDownloader(api_url, api_param)
+        single.send_request()
+        paginated = ApiDataDownloader(api_url, api_param)
+        paginated.send_paginated_requests(page_size=2, workers=2,
+                                          stream=True)
+        error = 'Streamed pages joined in the wrong order'
+        assert list(paginated.data['results']) == single.data[
+            'results'], error
+
+    def test_api_data_downloader_paginated_no_connection(self):
+        downloader = ApiDataDownloader('http://127.0.0.1:9/api/?',
+                                       {'results': 4, 'seed': 'abc'})
+        downloader.send_paginated_requests(page_size=2, workers=2)
+        assert downloader.response is False, 'response attribute not False'
+        assert downloader.data is None, 'data attribute not None'
+
 
 class TestApiDataReader:
 
@@ -155,17 +227,54 @@ class TestApiDataModifier:
         assert bool(re.search(r'\D', dict_obj['phone'])) is False, error_change
         assert bool(re.search(r'\D', dict_obj['cell'])) is False, error_change
 
+    def test_execute_modifications_in_parallel(self, api_url):
+        api_param = {'results': 6, 'seed': 'abc'}
+        serial = ApiDataDownloader(api_url, api_param)
+        serial.send_request()
+        ApiDataModifier(serial, DATA_MODIFICATIONS,
+                        'results').execute_modifications()
+        parallel = ApiDataDownloader(api_url, api_param)
+        parallel.send_request()
+        people = parallel.data['results']
+        ApiDataModifier(parallel, DATA_MODIFICATIONS,
+                        'results').execute_modifications_in_parallel(
+            workers=2, chunk_size=4, threshold=0)
+        error = 'Data modified in parallel differs from serial modification'
+        assert parallel.data == serial.data, error
+        assert parallel.data['results'] is people, 'Data not modified in place'
+
+    def test_compile_modifications_unknown(self, downloader_obj):
+        downloader_obj.send_request()
+        for name in ('non_existent_method', 'get_value', 'set_value'):
+            with pytest.raises(ValueError):
+                ApiDataModifier(downloader_obj,
+                                ({'name': name, 'key_path': ('phone',)},),
+                                data_dict='results')
+
+    def test_compiled_plan_missing_keys(self, modifier_obj):
+        dict_obj = modifier_obj._data[0]
+        modifications = (
+            {'name': 'remove_non_digit', 'key_path': ('non-existent', 'a')},
+            {'name': 'remove_non_digit', 'key_path': ('non-existent',)},
+            {'name': 'delete_value', 'key_path': ('non-existent', 'a')},
+            {'name': 'delete_value', 'key_path': ('location', 'city')},
+        )
+        expected = json.loads(json.dumps(dict_obj))
+        del expected['location']['city']
+        plan = modifier_obj.compile_modifications(modifications)
+        for step in plan:
+            step(dict_obj)
+        assert dict_obj == expected, 'Unexpected modification of data'
+
 
 class TestApiDataSave:
 
-    @classmethod
-    def setup_class(cls):
+    def setup_method(self):
         db.bind(MODELS, bind_refs=False, bind_backrefs=False)
         db.connect()
         db.create_tables(MODELS)
 
-    @classmethod
-    def teardown_class(cls):
+    def teardown_method(self):
         db.drop_tables(MODELS)
         db.close()
 
@@ -185,7 +294,8 @@ class TestApiDataSave:
         assert person.nationality == dict_obj['nat'], error
         assert person.id_name == dict_obj['id']['name'], error
         assert person.id_value == dict_obj['id']['value'], error
-        assert person.date_of_birth == dict_obj['dob']['date'], error
+        assert str(person.date_of_birth) == dict_obj['dob']['date'][
+            :10], error
         assert person.age == dict_obj['dob']['age'], error
         assert person.days_to_birthday == dict_obj['dob'][
             'days_to_birthday'], error
@@ -206,9 +316,12 @@ class TestApiDataSave:
         assert login.md5 == dict_obj['login']['md5'], error
         assert login.sha1 == dict_obj['login']['sha1'], error
         assert login.sha256 == dict_obj['login']['sha256'], error
-        assert login.registration_date == dict_obj['registered']['date'], error
+        assert str(login.registration_date) == dict_obj['registered'][
+            'date'][:10], error
         assert login.years_since_registration == dict_obj[
             'registered']['age'], error
+        assert login.password_score == password_score(
+            dict_obj['login']['password']), error
         assert login.person == p, error
 
     def test_save_location(self, downloader_obj, modifier_obj):
@@ -268,12 +381,1130 @@ class TestApiDataSave:
         assert len(Login.select()) == logins + API_PERSONS, error
         assert len(Location.select()) == localizations + API_PERSONS, error
 
+    def test_save_data_in_batches(self, downloader_obj, modifier_obj):
+        persons = len(Person.select())
+        contacts = len(Contact.select())
+        modifier_obj.execute_modifications()
+        save_obj = ApiDataSave(downloader_obj, 'results')
+        saved = save_obj.save_data_in_batches(batch_size=1)
+        error = 'Incorrect number of objects saved in the database'
+        assert saved == API_PERSONS, error
+        assert len(Person.select()) == persons + API_PERSONS, error
+        assert len(Contact.select()) == contacts + API_PERSONS, error
+        person = Person.select().order_by(Person.id.desc())[0]
+        dict_obj = modifier_obj._data[-1]
+        error_relation = 'Related data assigned to the wrong person'
+        assert person.firstname == dict_obj['name']['first'], error_relation
+        assert person.contact.email == dict_obj['email'], error_relation
+        assert person.login.uuid == dict_obj['login']['uuid'], error_relation
+        assert person.location.city == dict_obj[
+            'location']['city'], error_relation
+
+    def test_upsert_batch(self):
+        people = list(generate_people(3))
+        ApiDataModifier(SimpleNamespace(data=people),
+                        DATA_MODIFICATIONS).execute_modifications()
+        save_obj = ApiDataSave(SimpleNamespace(data=people))
+        save_obj.save_data_in_batches(2, incremental=True)
+        save_obj.save_data_in_batches(2, incremental=True)
+        people[1]['location']['city'] = 'Springfield'
+        people[1]['email'] = 'moved@example.com'
+        save_obj.save_data_in_batches(2, incremental=True)
+        assert save_obj.counts == {'inserted': 3, 'updated': 1,
+                                   'unchanged': 5}, 'Incorrect counts'
+        error = 'Incorrect data saved'
+        assert Person.select().count() == 3, error
+        person = Login.get(Login.uuid == people[1]['login']['uuid']).person
+        assert person.location.city == 'Springfield', error
+        assert person.contact.email == 'moved@example.com', error
+        assert Location.select().count() == 3, error
+
+    def test_upsert_next_day(self, monkeypatch):
+        people = list(generate_people(5))
+        save_obj = ApiDataSave(SimpleNamespace(data=people))
+        modifier = ApiDataModifier(SimpleNamespace(data=people),
+                                   DATA_MODIFICATIONS)
+        modifier.execute_modifications()
+        save_obj.save_data_in_batches(5, incremental=True)
+
+        class NextDay(datetime.date):
+            @classmethod
+            def today(cls):
+                return datetime.date.today() + datetime.timedelta(days=1)
+
+        monkeypatch.setattr(load_people, 'date', NextDay)
+        modifier.execute_modifications()
+        save_obj.save_data_in_batches(5, incremental=True)
+        assert save_obj.counts == {'inserted': 5, 'updated': 0,
+                                   'unchanged': 5}, 'Unchanged people updated'
+
+    def test_upsert_duplicates_in_batch(self):
+        people = [*generate_people(2), *generate_people(2)]
+        ApiDataModifier(SimpleNamespace(data=people),
+                        DATA_MODIFICATIONS).execute_modifications()
+        save_obj = ApiDataSave(SimpleNamespace(data=people))
+        save_obj.save_data_in_batches(10, incremental=True)
+        assert save_obj.counts['inserted'] == 2, 'Duplicates inserted'
+        assert Login.select().count() == 2, 'Duplicates inserted'
+
+    def test_save_batch_duplicates_rejected(self):
+        downloader = SimpleNamespace(data=list(generate_people(2)))
+        ApiDataModifier(downloader, DATA_MODIFICATIONS).execute_modifications()
+        save_obj = ApiDataSave(downloader)
+        save_obj.save_data_in_batches(2)
+        with pytest.raises(peewee.IntegrityError):
+            save_obj.save_data_in_batches(2)
+        assert Person.select().count() == 2, 'Batch not rolled back'
+
+
+class TestJsonStream:
+
+    def test_iter_array(self):
+        document = {'info': {'seed': 'abc', 'values': [1, -2.5e3, None]},
+                    'results': [{'name': 'Zo\u00eb'}, 12345, -1.5e3, 'x',
+                                True, [1, [2]], {}],
+                    'other': 1}
+        raw = json.dumps(document, ensure_ascii=False).encode()
+        for chunk_size in (1, 3, 7, 1024):
+            items = list(iter_array(io.BytesIO(raw), 'results', chunk_size))
+            assert items == document['results'], 'Incorrect items decoded'
+
+    def test_iter_array_missing_or_empty(self):
+        error = 'Items returned for missing or empty array'
+        assert list(iter_array(io.BytesIO(b'{}'), 'results')) == [], error
+        assert list(iter_array(
+            io.BytesIO(b'{"info": 1}'), 'results')) == [], error
+        assert list(iter_array(
+            io.BytesIO(b' {"results" : [ ] } '), 'results')) == [], error
+
+    def test_stream_closed(self):
+        stream = io.BytesIO(b'{"results": [1, 2]}')
+        assert list(JsonStream(stream)['results']) == [1, 2]
+        assert stream.closed, 'Stream not closed after reading the array'
+        stream = io.BytesIO(b'{"results": [1, 2]}')
+        items = JsonStream(stream)['results']
+        next(items)
+        items.close()
+        assert stream.closed, 'Stream not closed when iterating stopped'
+
+    def test_iter_array_invalid(self):
+        with pytest.raises(ValueError):
+            list(iter_array(io.BytesIO(b'{"results": [1 2]}'), 'results'))
+        with pytest.raises(ValueError):
+            list(iter_array(io.BytesIO(b'{"results": [1,'), 'results'))
+
+
+class TestStreamingPipeline:
+    SCRIPT = '''
+import resource
+import sys
+
+from peewee import SqliteDatabase
+
+import load_people
+from models import CACHE_MODELS, INDEX_MODELS, MODELS
+from settings import DATABASE_PROFILES
+
+# page cache of SQLite is bounded by the profile, not by the amount of data
+DATABASE_PROFILES['bulk-load'].update(cache_size=-2000, mmap_size=0)
+db = SqliteDatabase(sys.argv[2])
+db.bind(MODELS + CACHE_MODELS + INDEX_MODELS, bind_refs=False,
+        bind_backrefs=False)
+db.create_tables(MODELS + CACHE_MODELS)
+load_people.main(stream=True, file=sys.argv[1])
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+    def peak_rss(self, tmp_path, count):
+        data_file = tmp_path / f'people_{count}.json'
+        with open(data_file, 'w') as file:
+            write_people(file, count)
+        process = subprocess.run(
+            [sys.executable, '-c', self.SCRIPT, str(data_file),
+             str(tmp_path / f'people_{count}.db')],
+            capture_output=True, text=True, check=True)
+        return int(process.stdout)
+
+    def test_pipeline_saves_modified_data(self, downloader_obj):
+        downloader_obj.send_request(stream=True)
+        modifier = ApiDataModifier(downloader_obj, DATA_MODIFICATIONS,
+                                   'results')
+        people = list(ApiDataReader(modifier))
+        error = 'Data not modified in the pipeline'
+        assert len(people) == API_PERSONS, 'Incorrect number of people'
+        assert all('picture' not in person for person in people), error
+        assert all('days_to_birthday' in person['dob']
+                   for person in people), error
+
+    def test_pipeline_peak_rss(self, tmp_path):
+        resource = pytest.importorskip('resource')
+        small = self.peak_rss(tmp_path, 1000)
+        large = self.peak_rss(tmp_path, 8000)
+        # ru_maxrss is given in kilobytes, the data of 8000 people held at
+        # once would take more than 40 MB
+        scale = 1024 if sys.platform == 'darwin' else 1
+        error = 'Peak memory usage grows with the number of people'
+        assert (large - small) / scale < 8 * 1024, error
+
+
+class TestPipelinedLoader:
+
+    @pytest.fixture
+    def file_db(self, tmp_path):
+        # the save stage opens its own connection, so the database cannot
+        # live in memory
+        file_db = SqliteDatabase(str(tmp_path / 'people.db'))
+        with file_db.bind_ctx(MODELS):
+            file_db.create_tables(MODELS)
+            yield file_db
+        file_db.close()
+
+    def test_pipelined_loader_run(self, file_db, api_url):
+        downloader = ApiDataDownloader(api_url, {'results': 25, 'seed': 'abc'})
+        downloader.send_request(stream=True)
+        loader = PipelinedLoader(DATA_MODIFICATIONS, batch_size=4,
+                                 queue_size=2)
+        saved = loader.run(downloader.data['results'])
+        error = 'Incorrect number of objects saved in the database'
+        assert saved == 25, error
+        assert Person.select().count() == 25, error
+        assert Login.select().count() == 25, error
+        assert all(stats['people'] == 25 for stats in
+                   loader.stats.values()), 'Incorrect stage statistics'
+        person = Person.select().order_by(Person.id)[3]
+        assert person.days_to_birthday is not None, 'Data not modified'
+        assert bool(re.search(r'\D', person.contact.phone)) is False
+
+    def test_pipelined_loader_error(self, file_db, api_url):
+        downloader = ApiDataDownloader(api_url, {'results': 3, 'seed': 'abc'})
+        downloader.send_request()
+
+        def people():
+            yield from downloader.data['results']
+            raise ConnectionError('Connection lost')
+
+        loader = PipelinedLoader(DATA_MODIFICATIONS, batch_size=1,
+                                 queue_size=1)
+        with pytest.raises(ConnectionError):
+            loader.run(people())
+
+
+def test_bulk_load(tmp_path):
+    file_db = SqliteDatabase(str(tmp_path / 'people.db'),
+                             pragmas={'foreign_keys': 1})
+    with file_db.bind_ctx(MODELS):
+        file_db.create_tables(MODELS)
+        with bulk_load(file_db):
+            synchronous = file_db.pragma('synchronous')
+            locking_mode = file_db.pragma('locking_mode')
+        error = 'Bulk load pragmas not set'
+        assert synchronous == 0, error
+        assert locking_mode == 'exclusive', error
+        error = 'Safe pragmas not restored'
+        assert file_db.pragma('synchronous') == 1, error
+        assert file_db.pragma('locking_mode') == 'normal', error
+        assert file_db.table_exists('sqlite_stat1'), 'Database not analyzed'
+    file_db.close()
+
+
+def test_write_people(tmp_path):
+    # more people than in one chunk, generated by one and two processes
+    count = 2500
+    with open(tmp_path / 'single.json', 'w') as file:
+        write_people(file, count)
+    with open(tmp_path / 'parallel.json', 'w') as file:
+        write_people(file, count, workers=2)
+    single = (tmp_path / 'single.json').read_text()
+    assert (tmp_path / 'parallel.json').read_text() == single, \
+        'Generated data depends on the number of workers'
+    data = json.loads(single)
+    assert data['results'] == list(generate_people(count)), \
+        'Written people differ from generated people'
+    assert data['info']['results'] == count, 'Incorrect info'
+
+
+def test_main_timings(tmp_path):
+    data_file = tmp_path / 'people.json'
+    with open(data_file, 'w') as file:
+        write_people(file, 10)
+    file_db = SqliteDatabase(str(tmp_path / 'people.db'),
+                             pragmas={'foreign_keys': 1})
+    timings = {}
+    with file_db.bind_ctx(MODELS):
+        file_db.create_tables(MODELS)
+        load_people.main(file=str(data_file), timings=timings)
+        assert Person.select().count() == 10, 'People not saved'
+    file_db.close()
+    error = 'Loading phases not timed'
+    assert set(timings) == {'read', 'migrate', 'modify', 'save', 'load'}, \
+        error
+    assert all(seconds >= 0 for seconds in timings.values()), error
+
+
+@pytest.mark.parametrize('pipeline', (False, True))
+def test_main_stream_lost_page(tmp_path, capsys, monkeypatch, api_url,
+                               pipeline):
+    fetch_page = ApiDataDownloader.fetch_page
+    monkeypatch.setattr(ApiDataDownloader, 'fetch_page', lambda self, p: (
+        False, None) if p['page'] == 3 else fetch_page(self, p))
+    monkeypatch.setattr(load_people, 'API_URL', api_url)
+    monkeypatch.setattr(load_people, 'API_PARAMETERS', {'results': 6})
+    monkeypatch.setattr(load_people, 'API_PAGE_SIZE', 2)
+    file_db = SqliteDatabase(str(tmp_path / 'people.db'),
+                             pragmas={'foreign_keys': 1})
+    with file_db.bind_ctx(MODELS):
+        file_db.create_tables(MODELS)
+        with pytest.raises(SystemExit, match='Failed to get data from API'):
+            load_people.main(stream=True, pipeline=pipeline)
+    file_db.close()
+    assert 'Failed to get all pages from API' in capsys.readouterr().out
+
+
+def test_main_reload(tmp_path, capsys):
+    data_file = tmp_path / 'people.json'
+    with open(data_file, 'w') as file:
+        write_people(file, 10)
+    file_db = SqliteDatabase(str(tmp_path / 'people.db'),
+                             pragmas={'foreign_keys': 1})
+    with file_db.bind_ctx(MODELS):
+        file_db.create_tables(MODELS)
+        load_people.main(file=str(data_file))
+        load_people.main(file=str(data_file))
+        assert Person.select().count() == 10, 'People saved twice'
+    file_db.close()
+    assert 'Unchanged: 10' in capsys.readouterr().out, \
+        'Saved people not updated incrementally'
+
+
+def test_timings_threads():
+    timings = {}
+
+    def add_times():
+        for _ in range(10000):
+            add_time(timings, 'phase', 1)
+
+    threads = [threading.Thread(target=add_times) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert timings == {'phase': 80000}, 'Durations lost'
+
+
+def test_profile_load(tmp_path):
+    data_file = tmp_path / 'people.json'
+    with open(data_file, 'w') as file:
+        write_people(file, 10)
+    file_db = SqliteDatabase(str(tmp_path / 'people.db'),
+                             pragmas={'foreign_keys': 1})
+    profiler = Profiler(str(tmp_path / 'load.prof'))
+    with file_db.bind_ctx(MODELS):
+        file_db.create_tables(MODELS)
+        with profiler.profile(file_db):
+            load_people.main(file=str(data_file), timings=profiler.timings)
+    file_db.close()
+    error = 'Phases not timed'
+    assert {'modify delete_value picture', 'save collect', 'save person',
+            'save login', 'total'} <= set(profiler.timings), error
+    assert profiler.statements > 0, 'SQL statements not traced'
+    assert 'execute_sql' not in vars(file_db), 'Tracing not removed'
+    assert (tmp_path / 'load.prof').exists(), 'cProfile statistics not saved'
+
+
+class QueryRecordingDatabase(SqliteDatabase):
+    """Remember SELECT statements and connections made to the database."""
+
+    def __init__(self, *args, **kwargs):
+        super(QueryRecordingDatabase, self).__init__(*args, **kwargs)
+        self.queries = []
+        self.connections = 0
+
+    def _connect(self):
+        self.connections += 1
+        return super(QueryRecordingDatabase, self)._connect()
+
+    def execute_sql(self, sql, params=None, commit=True):
+        if sql.startswith('SELECT'):
+            self.queries.append((sql, params))
+        return super(QueryRecordingDatabase, self).execute_sql(
+            sql, params, commit)
+
+
+@pytest.fixture
+def recording_db(monkeypatch, tmp_path):
+    recording_db = QueryRecordingDatabase(str(tmp_path / 'people.db'))
+    monkeypatch.setattr(functions, 'sqlite_connection',
+                        lambda db_name: recording_db)
+    # queries of commands are recorded, their results are not cached
+    monkeypatch.setattr(functions, 'QUERY_CACHE_SIZE', 0)
+    with recording_db.bind_ctx(MODELS):
+        recording_db.create_tables(MODELS)
+        downloader = SimpleNamespace(data=list(generate_people(20)))
+        ApiDataModifier(downloader,
+                        DATA_MODIFICATIONS).execute_modifications()
+        ApiDataSave(downloader).save_data_in_batches(20)
+        recording_db.queries.clear()
+        yield recording_db
+    recording_db.close()
+
+
+@pytest.fixture
+def db_functions_obj(recording_db):
+    return functions.DatabaseFunctions(db_name='people.db',
+                                       db_connection=lambda db_name:
+                                       recording_db)
+
+
+class TestDatabaseFunctions:
+
+    def test_databases_kept_apart(self, db_functions_obj, tmp_path):
+        other_db = SqliteDatabase(str(tmp_path / 'other.db'))
+        with other_db.bind_ctx(MODELS, bind_refs=False, bind_backrefs=False):
+            other_db.create_tables(MODELS)
+        other = functions.DatabaseFunctions('other.db',
+                                            lambda db_name: other_db)
+        error = 'Queries run on the database of another object'
+        assert db_functions_obj.count_entries('Person') == 20, error
+        assert other.count_entries('Person') == 0, error
+        assert Person._meta.database is not other_db, 'Models rebound'
+        other_db.close()
+
+    def test_aggregate(self, db_functions_obj, recording_db):
+        result = db_functions_obj.aggregate('Person', 'gender',
+                                            averages=('age',))
+        assert len(recording_db.queries) == 1, 'More than one query executed'
+        error = 'Incorrect aggregates'
+        assert result['count'] == Person.select().count(), error
+        assert result['avg_age'] == pytest.approx(Person.select(
+            peewee.fn.AVG(Person.age).coerce(False)).scalar()), error
+        for group in result['groups']:
+            people = Person.select().where(Person.gender == group['gender'])
+            assert group['count'] == people.count(), error
+            assert group['avg_age'] == pytest.approx(
+                sum(p.age for p in people) / people.count()), error
+
+    def test_aggregate_condition(self, db_functions_obj):
+        result = db_functions_obj.aggregate(
+            'Person', averages=('age',), condition='gender',
+            cond_value='female')
+        error = 'Incorrect aggregates'
+        assert result['count'] == Person.select().where(
+            Person.gender == 'female').count(), error
+        assert len(result['groups']) == 1, error
+
+    def test_aggregate_no_entries(self, db_functions_obj):
+        result = db_functions_obj.aggregate(
+            'Person', 'gender', averages=('age',), condition='gender',
+            cond_value='non-existent')
+        error = 'Incorrect aggregates of no entries'
+        assert result == {'count': 0, 'avg_age': None, 'groups': []}, error
+
+    def test_most_occurrences(self, db_functions_obj, recording_db):
+        result = db_functions_obj.most_occurrences('login.password', 3)
+        assert len(recording_db.queries) == 1, 'Schema of database queried'
+        counts = [count for value, count in result]
+        assert counts == sorted(counts, reverse=True), 'Incorrect order'
+        assert db_functions_obj.most_occurrences('unknown', 3) is None, \
+            'Unknown column not rejected'
+
+    def test_gender_percentage_any_gender(self, recording_db):
+        Person.update(gender='other').where(Person.id <= 2).execute()
+        recording_db.queries.clear()
+        result = CliRunner().invoke(people.cli, ['gender-percentage'])
+        lines = result.output.splitlines()
+        assert len(recording_db.queries) == 1, 'More than one query executed'
+        assert [line.split()[0] for line in lines] == [
+            'Female', 'Male', 'Other'], 'Incorrect genders displayed'
+        assert float(lines[2].split()[1]) == 10, 'Incorrect percentage'
+        total = sum(float(line.split()[1]) for line in lines)
+        assert total == pytest.approx(100), 'Percentages do not sum up'
+
+
+class TestQueryPlans:
+    COMMANDS = (
+        ['gender-percentage'],
+        ['average-age'],
+        ['average-age', '--gender', 'male'],
+        ['most-common', 'city'],
+        ['most-common', 'country'],
+        ['most-common', 'nationality'],
+        ['most-common', 'password', '--limit', '5'],
+        ['most-common', 'gender'],
+        ['most-common', 'location.country'],
+        ['born-between', '1990-01-01', '1995-12-31'],
+        ['password-security'],
+        ['password-security', '--top', '5'],
+        ['upcoming-birthdays', '--days', '30'],
+        ['near', '52.2297', '21.0122', '--radius', '1000'],
+        ['search', 'oliver'],
+        ['search', 'oliver', '--exact'],
+    )
+    # commands reading every person, which may scan only the first table
+    EXPORT_COMMANDS = (
+        ['export-people'],
+        ['export-people', '--format', 'csv'],
+    )
+
+    @pytest.fixture(autouse=True)
+    def migrated(self, recording_db):
+        # indexes of migrations, e.g. the R*Tree of locations, are used
+        migrate_database(recording_db)
+        recording_db.queries.clear()
+
+    def full_scans(self, recording_db, command):
+        """Run the command and get full scans of tables by its queries."""
+        result = CliRunner().invoke(people.cli, command)
+        assert result.exit_code == 0, result.output
+        assert recording_db.queries, 'No queries recorded'
+        for sql, params in recording_db.queries:
+            plan = recording_db.execute_sql(
+                'EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+            # tables are aliased in queries, schema tables are skipped
+            yield sql, [detail for detail in (row[-1] for row in plan)
+                        if re.match(r'SCAN (TABLE )?(?!sqlite_)\S+$', detail)]
+
+    @pytest.mark.parametrize('command', COMMANDS, ids=' '.join)
+    def test_no_full_table_scan(self, recording_db, command):
+        for sql, scans in self.full_scans(recording_db, command):
+            assert not scans, f'Full scan ({scans[0]}) in query: {sql}'
+
+    @pytest.mark.parametrize('command', EXPORT_COMMANDS, ids=' '.join)
+    def test_export_scans_people_only(self, recording_db, command):
+        for sql, scans in self.full_scans(recording_db, command):
+            assert len(scans) <= 1, f'Full scans ({scans}) in query: {sql}'
+
+
+class TestQueryCache:
+
+    @pytest.fixture
+    def cached_obj(self, recording_db):
+        return functions.DatabaseFunctions(
+            db_name='people.db', db_connection=lambda db_name: recording_db,
+            cache_size=2)
+
+    def test_hit(self, cached_obj, recording_db):
+        expected = cached_obj.aggregate('Person', 'gender', averages=('age',))
+        recording_db.queries.clear()
+        assert cached_obj.aggregate('Person', 'gender',
+                                    averages=('age',)) == expected
+        assert not any('"person"' in sql for sql, _ in recording_db.queries), \
+            'Result computed again'
+        statistics = cached_obj.cache.statistics()
+        assert (statistics['hits'], statistics['misses']) == (1, 1), \
+            'Incorrect statistics'
+
+    def test_placeholder_like_keys(self, cached_obj):
+        cache = cached_obj.cache
+        for key in (':key', ':last_used'):
+            assert cache.get(key, lambda: key) == key
+            assert cache.get(key, lambda: None) == key, 'Result not cached'
+        assert cache.statistics()['hits'] == 2, 'Incorrect statistics'
+
+    def test_invalidated_by_save(self, cached_obj):
+        count = cached_obj.aggregate('Person')['count']
+        downloader = SimpleNamespace(data=list(generate_people(3, 'new')))
+        ApiDataModifier(downloader,
+                        DATA_MODIFICATIONS).execute_modifications()
+        ApiDataSave(downloader).save_data_in_batches(10)
+        assert cached_obj.aggregate('Person')['count'] == count + 3, \
+            'Stale result returned'
+        assert cached_obj.cache.statistics()['data_version'] == 2
+
+    def test_lru_eviction(self, cached_obj):
+        for column in ('city', 'country', 'city', 'gender'):
+            cached_obj.most_occurrences(column, 3)
+        keys = [json.loads(entry.key)[1][0] for entry in CachedResult.select()]
+        assert sorted(keys) == ['city', 'gender'], 'Incorrect entries evicted'
+        assert cached_obj.cache.statistics()['entries'] == 2
+
+    def test_same_result_on_hit(self, cached_obj):
+        first = cached_obj.most_occurrences('coordinates_latitude', 2)
+        assert cached_obj.most_occurrences('coordinates_latitude', 2) == first
+
+    def test_typed_values_on_hit(self, cached_obj):
+        values = [decimal.Decimal('-12.3400'), datetime.date(1990, 5, 17),
+                  {'count': 2}]
+        for _ in range(2):
+            result = cached_obj.cache.get('typed', lambda: values)
+            assert result == values, 'Values decoded with other types'
+            assert str(result[0]) == '-12.3400', 'Decimal places lost'
+
+
+class TestModelRegistry:
+    registry = functions.ModelRegistry(MODELS)
+
+    def test_model(self):
+        assert self.registry.model('Location') is Location
+        assert self.registry.model('location') is Location
+        with pytest.raises(ValueError):
+            self.registry.model('Address')
+
+    def test_field(self):
+        assert self.registry.field('Login', 'password') is Login.password
+        assert self.registry.field('Contact', 'id') is Contact.id
+        with pytest.raises(ValueError):
+            self.registry.field('Person', 'city')
+
+    def test_column(self):
+        error = 'Incorrect column resolved'
+        assert self.registry.column('city') is Location.city, error
+        assert self.registry.column('Login.id') is Login.id, error
+        assert self.registry.column('contact.person') is Contact.person, error
+        # MODELS of this module start with Person
+        assert self.registry.column('id') is Person.id, error
+        assert self.registry.column('street_name') is None, error
+        assert self.registry.column('person.city') is None, error
+
+
+def test_born_between(recording_db):
+    dates = sorted(p.date_of_birth for p in Person.select())
+    lower, upper = str(dates[3]), str(dates[-4])
+    result = CliRunner().invoke(people.cli, ['born-between', lower, upper])
+    displayed = [line.split()[-1] for line in result.output.splitlines()]
+    error = 'Incorrect people displayed'
+    assert displayed == [str(d) for d in dates[3:-3]], error
+
+
+class TestBatch:
+    COMMANDS = ['gender-percentage', 'average-age --gender female',
+                'most-common city --limit 3', 'password-security --top 2']
+
+    def separate_output(self):
+        return ''.join(CliRunner().invoke(people.cli, shlex.split(
+            command)).output for command in self.COMMANDS)
+
+    def test_batch(self, recording_db, tmp_path):
+        expected = self.separate_output()
+        path = tmp_path / 'commands.txt'
+        path.write_text('\n'.join(['# statistics', *self.COMMANDS, '']))
+        recording_db.close()
+        recording_db.connections = 0
+        result = CliRunner(mix_stderr=False).invoke(people.cli,
+                                                    ['batch', str(path)])
+        assert result.exit_code == 0, result.output
+        assert result.output == expected, 'Incorrect output of commands'
+        assert result.stderr.startswith('4 commands in'), 'Missing report'
+        assert recording_db.connections == 1, 'Connection not reused'
+
+    def test_batch_errors(self, recording_db):
+        result = CliRunner(mix_stderr=False).invoke(
+            people.cli, ['batch'], input='most-common\nshell\naverage-age\n')
+        assert result.exit_code == 0, result.stderr
+        assert result.output.startswith('Average age:'), 'Batch interrupted'
+        assert 'Missing argument' in result.stderr, 'Error not displayed'
+
+    def test_shell(self, recording_db):
+        result = CliRunner().invoke(people.cli, ['shell'],
+                                    input='average-age\nexit\naverage-age\n')
+        assert result.output.count('Average age:') == 1, \
+            'Incorrect commands run'
+
+
+def test_profile_command(recording_db):
+    args = ['most-common', 'city', '--limit', '3']
+    expected = CliRunner().invoke(people.cli, args).output
+    result = CliRunner(mix_stderr=False).invoke(people.cli,
+                                                ['--profile', *args])
+    assert result.exit_code == 0, result.output
+    assert result.output == expected, 'Output changed by profiling'
+    assert re.search(r'^output +\d', result.stderr, re.M), 'Phases missing'
+    assert re.search(r'SQL statements: [1-9]\d* in', result.stderr), \
+        'Statements not counted'
+    assert 'SELECT' in result.stderr, 'Slowest statements not listed'
+    assert 'execute_sql' not in vars(recording_db), 'Tracing not removed'
+
+
+class TestColumnar:
+    COMMANDS = ['gender-percentage', 'average-age',
+                'average-age --gender female --format csv',
+                'most-common country --limit 50', 'most-common age --limit 50',
+                'most-common location.coordinates_latitude --limit 50']
+
+    @pytest.fixture(autouse=True)
+    def numpy(self):
+        return pytest.importorskip('numpy')
+
+    def output(self, command, engine):
+        result = CliRunner().invoke(people.cli, [*shlex.split(command),
+                                                 '--engine', engine])
+        assert result.exit_code == 0, result.output
+        # values counted the same number of times may come in any order
+        return sorted(result.output.splitlines())
+
+    def test_engines_agree(self, recording_db):
+        for command in self.COMMANDS:
+            assert self.output(command, 'columnar') == self.output(
+                command, 'sql'), f'Different results of {command}'
+
+    def test_unsupported_column(self, recording_db):
+        result = CliRunner().invoke(people.cli, [
+            'most-common', 'email', '--engine', 'columnar'])
+        assert result.exit_code == 2, result.output
+        assert 'not in the columnar snapshot' in result.output
+
+    def test_snapshot_rebuilt(self, db_functions_obj, recording_db, tmp_path):
+        snapshot = db_functions_obj.columnar().snapshot
+        assert db_functions_obj.columnar().snapshot is snapshot, \
+            'Current snapshot not reused'
+        downloader = SimpleNamespace(data=list(generate_people(5, 'new')))
+        ApiDataModifier(downloader,
+                        DATA_MODIFICATIONS).execute_modifications()
+        ApiDataSave(downloader).save_data_in_batches(5)
+        rebuilt = db_functions_obj.columnar().snapshot
+        error = 'Snapshot not rebuilt for new data'
+        assert rebuilt.data_version > snapshot.data_version, error
+        assert rebuilt.count == snapshot.count + 5, error
+        directories = [str(path) for path in
+                       (tmp_path / 'people.db.columns').iterdir()]
+        assert directories == [rebuilt.directory], 'Stale snapshot not removed'
+
+    def test_snapshot_of_recreated_database(self, db_functions_obj,
+                                            recording_db):
+        snapshot = db_functions_obj.columnar().snapshot
+        # versions of the recreated database start from 0 again
+        recording_db.drop_tables(MODELS)
+        recording_db.create_tables(MODELS)
+        downloader = SimpleNamespace(data=list(generate_people(10, 'new')))
+        ApiDataModifier(downloader,
+                        DATA_MODIFICATIONS).execute_modifications()
+        ApiDataSave(downloader).save_data_in_batches(20)
+        recreated = db_functions_obj.columnar().snapshot
+        assert recreated.data_version == snapshot.data_version
+        assert recreated.count == 10, 'Snapshot of the old database used'
+
+
+class TestStartup:
+    # cumulative import time of people.py in microseconds, it used to take
+    # about 50 ms with peewee and the models imported up front
+    BUDGET = 40000
+    LAZY_MODULES = {'peewee', 'functions', 'models', 'profiling', 'decimal',
+                    'shlex', 'columnar', 'numpy', 'service', 'http'}
+
+    def import_times(self):
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import people'],
+            capture_output=True, text=True, check=True)
+        times = {}
+        for line in process.stderr.splitlines()[1:]:
+            _, cumulative, name = line.split('|')
+            times[name.strip()] = int(cumulative)
+        return times
+
+    def test_lazy_imports(self):
+        imported = self.LAZY_MODULES.intersection(self.import_times())
+        assert not imported, f'Modules imported at startup: {imported}'
+
+    def test_import_time_budget(self):
+        # the fastest of a few runs, to leave out a busy machine
+        import_time = min(self.import_times()['people'] for _ in range(3))
+        assert import_time < self.BUDGET, \
+            f'people.py imported in {import_time} us'
+
+
+def test_export_people(recording_db):
+    result = CliRunner().invoke(people.cli, ['export-people'])
+    assert len(recording_db.queries) == 1, 'Query per person executed'
+    records = [json.loads(line) for line in result.output.splitlines()]
+    assert [record['id'] for record in records] == list(range(1, 21))
+    for record in records:
+        person = Person.get_by_id(record['id'])
+        assert (record['lastname'], record['email'], record['city'],
+                record['uuid']) == (person.lastname, person.contact.email,
+                                    person.location.city,
+                                    person.login.uuid), 'Incorrect record'
+    assert 'checksum' not in records[0], 'Checksum exported'
+    result = CliRunner().invoke(people.cli, ['export-people', '--format',
+                                             'csv'])
+    assert len(list(csv.DictReader(io.StringIO(result.output)))) == 20
+
+
+class TestService:
+
+    @pytest.fixture
+    def server(self, recording_db):
+        pool = read_only_pool(recording_db.database, max_connections=2)
+        obj = functions.DatabaseFunctions('people.db', lambda db_name: pool,
+                                          cache_size=0)
+        with QueryServer(obj, port=0) as server:
+            yield server
+        pool.close_all()
+
+    @staticmethod
+    def get(server, path):
+        try:
+            with urlopen(server.url + path) as response:
+                return response.status, json.load(response)
+        except HTTPError as error:
+            return error.code, json.load(error)
+
+    def test_endpoints(self, server, db_functions_obj):
+        status, genders = self.get(server, '/gender-percentage')
+        assert status == 200
+        assert sum(g['percentage'] for g in genders) == pytest.approx(100)
+        expected = db_functions_obj.aggregate(
+            'Person', averages=('age',), condition='gender',
+            cond_value='male')['avg_age']
+        assert self.get(server, '/average-age?gender=male')[1] == {
+            'gender': 'male', 'average_age': expected}
+        assert self.get(server, '/most-common?category=city&limit=2')[1] == [
+            {'city': city, 'count': count} for city, count in
+            db_functions_obj.most_occurrences('city', 2)]
+        status, born = self.get(
+            server, '/born-between?lower=1900-01-01&upper=2100-01-01')
+        assert len(born) == 20, 'Incorrect people'
+        status, passwords = self.get(server, '/password-security?top=3')
+        assert [p['score'] for p in passwords] == sorted(
+            (password_score(l.password) for l in Login.select()),
+            reverse=True)[:3]
+
+    def test_errors(self, server):
+        for path, code in (('/most-common?category=unknown', 400),
+                           ('/most-common', 400),
+                           ('/password-security?top=x', 400),
+                           ('/born-between?lower=1990&upper=2000', 400),
+                           ('/average-age?gender=other', 400),
+                           ('/people', 404)):
+            status, body = self.get(server, path)
+            assert (status, 'error' in body) == (code, True), path
+
+    def test_metrics(self, server):
+        for _ in range(3):
+            self.get(server, '/gender-percentage')
+        self.get(server, '/most-common')
+        metrics = self.get(server, '/metrics')[1]
+        assert metrics['/gender-percentage']['requests'] == 3
+        assert metrics['/gender-percentage']['p99_ms'] > 0
+        assert metrics['/most-common']['errors'] == 1
+
+    def test_read_only(self, server):
+        with server.functions.database.connection_context():
+            with pytest.raises(peewee.OperationalError):
+                server.functions.database.execute_sql('DELETE FROM person')
+
+
+class TestOutputFormats:
+
+    def test_born_between_csv(self, recording_db):
+        dates = sorted(str(p.date_of_birth) for p in Person.select())
+        result = CliRunner().invoke(people.cli, [
+            'born-between', dates[0], dates[-1], '--format', 'csv'])
+        rows = list(csv.DictReader(io.StringIO(result.output)))
+        assert [row['date_of_birth'] for row in rows] == dates, \
+            'Incorrect rows written'
+
+    def test_most_common_jsonl(self, recording_db):
+        result = CliRunner().invoke(people.cli, [
+            'most-common', 'country', '--limit', '3', '--format', 'jsonl'])
+        rows = [json.loads(line) for line in result.output.splitlines()]
+        assert len(rows) == 3, 'Incorrect number of rows'
+        assert all(set(row) == {'country', 'count'} for row in rows), \
+            'Incorrect keys'
+        assert sum(row['count'] for row in rows) <= Person.select().count()
+
+    def test_write_rows(self):
+        rows = [('a b', decimal.Decimal('1.50'), None),
+                ('c,d', 2, datetime.date(2000, 1, 2))]
+        columns = ('name', 'value', 'date')
+        expected = {
+            'text': 'a b 1.50 None\nc,d 2 2000-01-02\n',
+            'csv': 'name,value,date\na b,1.50,\n"c,d",2,2000-01-02\n',
+            'tsv': 'name\tvalue\tdate\na b\t1.50\t\nc,d\t2\t2000-01-02\n',
+            'jsonl': '{"name": "a b", "value": 1.5, "date": null}\n'
+                     '{"name": "c,d", "value": 2, "date": "2000-01-02"}\n',
+        }
+        for output_format, output in expected.items():
+            file = io.StringIO()
+            functions.write_rows(file, iter(rows), output_format, columns)
+            assert file.getvalue() == output, f'Incorrect {output_format}'
+        with pytest.raises(ValueError):
+            functions.write_rows(io.StringIO(), rows, 'xml', columns)
+
+
+def test_migrate_normalize_dates(recording_db):
+    timestamp = '1990-05-17T10:20:30.456Z'
+    Person.update(date_of_birth=timestamp).execute()
+    Login.update(registration_date=timestamp).execute()
+    recording_db.pragma('user_version', 1)
+    migrate_database(recording_db)
+    error = 'Dates not normalized'
+    assert {str(p.date_of_birth) for p in Person.select()} == {
+        '1990-05-17'}, error
+    assert {str(l.registration_date) for l in Login.select()} == {
+        '1990-05-17'}, error
+
+
+def test_password_security_top(recording_db):
+    logins = sorted(Login.select(), key=lambda l: (-password_score(
+        l.password), l.id))
+    result = CliRunner().invoke(people.cli,
+                                ['password-security', '--top', '3'])
+    error = 'Incorrect passwords displayed'
+    assert result.output.splitlines() == [
+        f'{l.password} {password_score(l.password)}'
+        for l in logins[:3]], error
+    result = CliRunner().invoke(people.cli, ['password-security'])
+    assert result.output == \
+        f'The most secure password: {logins[0].password}\n', error
+
+
+@pytest.mark.parametrize('command', (
+    ['password-security', '--top', '0'],
+    ['password-security', '--top', '-1'],
+    ['most-common', 'city', '--limit', '-1'],
+    ['near', '0', '0', '--limit', '0'],
+    ['search', 'oliver', '--limit', '-1'],
+), ids=' '.join)
+def test_positive_limits(recording_db, command):
+    result = CliRunner().invoke(people.cli, command)
+    assert result.exit_code == 2, result.output
+    assert 'minimum valid value 1' in result.output
+
+
+def test_migrate_password_scores(recording_db):
+    recording_db.execute_sql('DROP INDEX login_password_score_id')
+    recording_db.execute_sql('ALTER TABLE login DROP COLUMN password_score')
+    recording_db.pragma('user_version', 2)
+    migrate_database(recording_db)
+    error = 'Passwords not scored'
+    for login in Login.select():
+        assert login.password_score == password_score(login.password), error
+    indexes = {index.name for index in recording_db.get_indexes('login')}
+    assert 'login_password_score_id' in indexes, 'Scores not indexed'
+
+
+def test_score_passwords_data_version(recording_db):
+    Login.update(password_score=None).where(Login.id <= 5).execute()
+    data_version = CacheState.get_by_id(1).data_version
+    assert migrations.score_passwords(recording_db) > 0
+    assert CacheState.get_by_id(1).data_version == data_version + 1, \
+        'Data version not bumped'
+    migrations.score_passwords(recording_db, rescore=True)
+    assert CacheState.get_by_id(1).data_version == data_version + 1, \
+        'Data version bumped without changes'
+
+
+def test_migrate_unique_login_uuid(recording_db):
+    recording_db.execute_sql('DROP INDEX login_uuid')
+    downloader = SimpleNamespace(data=list(generate_people(5)))
+    ApiDataModifier(downloader, DATA_MODIFICATIONS).execute_modifications()
+    ApiDataSave(downloader).save_data_in_batches(5)
+    first_ids = [login.person_id for login in Login.select().order_by(
+        Login.id).limit(20)]
+    recording_db.pragma('user_version', 4)
+    with pytest.raises(ValueError, match='People saved twice: 5'):
+        migrate_database(recording_db)
+    assert Person.select().count() == 25, 'People removed by the migration'
+    removed = migrations.dedupe_people(recording_db)
+    assert [row[3] for row in removed] == [
+        person['login']['uuid'] for person in downloader.data], \
+        'Incorrect people removed'
+    migrate_database(recording_db)
+    error = 'People saved twice not removed'
+    assert [p.id for p in Person.select().order_by(Person.id)] == \
+        first_ids, error
+    for model in (Contact, Location, Login):
+        assert model.select().count() == 20, error
+    indexes = {index.name: index.unique
+               for index in recording_db.get_indexes('login')}
+    assert indexes.get('login_uuid'), 'Unique index not created'
+
+
+def test_migrate_database(tmp_path):
+    old_db = SqliteDatabase(str(tmp_path / 'people.db'))
+    with old_db.bind_ctx(MODELS):
+        # tables created before any migration had only unique indexes
+        for model in MODELS:
+            model._schema.create_table()
+            for index in model._meta.fields_to_index():
+                if index._unique:
+                    old_db.execute(index)
+        assert migrate_database(old_db) == len(MIGRATIONS)
+        assert migrate_database(old_db) == 0, 'Migrations applied twice'
+        indexes = {index.name for model in MODELS
+                   for index in old_db.get_indexes(model._meta.table_name)}
+        expected = {index._name for model in MODELS
+                    for index in model._meta.fields_to_index()}
+        assert expected <= indexes, 'Indexes of models not created'
+    old_db.close()
+
+
+def test_bounding_boxes():
+    rng = random.Random(1)
+    for _ in range(2000):
+        latitude, longitude = rng.uniform(-90, 90), rng.uniform(-180, 180)
+        other = rng.uniform(-90, 90), rng.uniform(-180, 180)
+        radius = haversine(latitude, longitude, *other)
+        assert any(min_lon <= other[1] <= max_lon and
+                   min_lat <= other[0] <= max_lat
+                   for min_lon, max_lon, min_lat, max_lat in bounding_boxes(
+                       latitude, longitude, radius * 1.0001)), \
+            f'Point {other} outside boxes of {latitude}, {longitude}'
+
+
+class TestNear:
+
+    @pytest.fixture(autouse=True)
+    def location_index(self, recording_db):
+        migrate_database(recording_db)
+        with recording_db.bind_ctx([LocationIndex]):
+            yield
+
+    def test_near(self, recording_db):
+        location = Location.select().first()
+        latitude = float(location.coordinates_latitude)
+        longitude = float(location.coordinates_longitude)
+        expected = sorted(
+            (haversine(latitude, longitude, l.coordinates_latitude,
+                       l.coordinates_longitude), l.person.lastname)
+            for l in Location.select())
+        radius = expected[5][0] + 0.01
+        result = CliRunner().invoke(people.cli, [
+            'near', str(latitude), str(longitude), '--radius', str(radius),
+            '--limit', '4', '--format', 'csv'])
+        rows = list(csv.DictReader(io.StringIO(result.output)))
+        assert [row['lastname'] for row in rows] == [
+            lastname for _, lastname in expected[:4]], 'Incorrect people'
+        result = CliRunner().invoke(people.cli, [
+            'near', str(latitude), str(longitude), '--radius', str(radius),
+            '--limit', '10'])
+        assert len(result.output.splitlines()) == 6, 'Radius not applied'
+
+    def test_index_updated(self, recording_db):
+        location = Location.select().first()
+        Location.update(coordinates_latitude=-45, coordinates_longitude=170) \
+            .where(Location.id == location.id).execute()
+        entry = LocationIndex.get_by_id(location.id)
+        assert (entry.min_latitude, entry.min_longitude) == (-45, 170), \
+            'Index not updated'
+        location.delete_instance()
+        assert LocationIndex.select().count() == Location.select().count() \
+            == 19, 'Index entry not deleted'
+
+
+class TestSearch:
+
+    def test_search(self, recording_db):
+        person = Person.select().first()
+        contact = Contact.get(Contact.person == person)
+        result = CliRunner().invoke(people.cli, [
+            'search', person.lastname[:3].lower(), person.firstname,
+            '--format', 'csv'])
+        rows = list(csv.DictReader(io.StringIO(result.output)))
+        assert str(person.id) in [row['id'] for row in rows], \
+            'Person not found by a prefix'
+        assert all(person.lastname[:3].lower() in row['name'].lower()
+                   for row in rows), 'Incorrect people found'
+        result = CliRunner().invoke(people.cli, [
+            'search', contact.email, '--exact', '--limit', '1'])
+        assert result.output.startswith(f'{person.id} '), \
+            'Person not found by email'
+        result = CliRunner().invoke(people.cli, [
+            'search', person.lastname[:3], '--exact'])
+        assert result.output == '', 'Prefix matched with --exact'
+        result = CliRunner().invoke(people.cli, ['search', ' '])
+        assert result.exit_code == 2, 'Empty search not rejected'
+
+    def test_rebuild_search_index(self, recording_db):
+        def entries():
+            return list(PersonSearch.select(
+                PersonSearch.rowid, PersonSearch.name, PersonSearch.email,
+                PersonSearch.username, PersonSearch.address)
+                .order_by(PersonSearch.rowid).tuples())
+
+        saved = entries()
+        assert len(saved) == 20, 'Saved people not indexed'
+        PersonSearch.delete().execute()
+        assert migrations.rebuild_search_index(recording_db) == 20
+        assert entries() == saved, 'Index differs from the one saved'
+
+
+def test_next_birthday():
+    today = datetime.date(2023, 12, 31)
+    assert next_birthday(datetime.date(1990, 1, 1), today) == \
+        datetime.date(2024, 1, 1)
+    assert next_birthday(datetime.date(1990, 12, 31), today) == today
+    leap_day = datetime.date(2000, 2, 29)
+    assert next_birthday(leap_day, datetime.date(2023, 3, 1)) == \
+        datetime.date(2023, 3, 1), 'Not celebrated on 1 March'
+    assert next_birthday(leap_day, datetime.date(2024, 2, 1)) == \
+        datetime.date(2024, 2, 29)
+
+
+@pytest.mark.parametrize('today, days', [
+    ('2023-06-10', 7), ('2023-12-28', 10), ('2023-03-01', 0),
+    ('2024-02-28', 1), ('2023-01-01', 365)])
+def test_upcoming_birthdays(db_functions_obj, recording_db, today, days):
+    Person.update(date_of_birth='2000-02-29', birthday=229).where(
+        Person.id <= 2).execute()
+    today = datetime.date.fromisoformat(today)
+    expected = sorted(
+        ((next_birthday(p.date_of_birth, today) - today).days, p.id)
+        for p in Person.select()
+        if (next_birthday(p.date_of_birth, today) - today).days <= days)
+    query = db_functions_obj.upcoming_birthdays(days, today)
+    found = [(next_birthday(datetime.date.fromisoformat(date_of_birth),
+                            today) - today).days
+             for *_, date_of_birth in db_functions_obj.rows(query)]
+    assert found == [days for days, _ in expected], \
+        'Incorrect people found'
+
+
+def test_migrate_birthdays(recording_db):
+    recording_db.execute_sql('DROP INDEX person_birthday')
+    recording_db.execute_sql('ALTER TABLE person DROP COLUMN birthday')
+    recording_db.pragma('user_version', MIGRATIONS.index(
+        migrations.add_birthdays))
+    migrate_database(recording_db)
+    for person in Person.select():
+        date_of_birth = person.date_of_birth
+        assert person.birthday == date_of_birth.month * 100 + \
+            date_of_birth.day, 'Birthdays not stored'
+    indexes = {index.name for index in recording_db.get_indexes('person')}
+    assert 'person_birthday' in indexes, 'Birthdays not indexed'
+
+
+def test_migrate_database_token(recording_db):
+    recording_db.execute_sql('ALTER TABLE cachestate DROP COLUMN token')
+    recording_db.pragma('user_version', MIGRATIONS.index(
+        migrations.add_database_token))
+    migrate_database(recording_db)
+    state = CacheState.get_by_id(1)
+    assert state.data_version == 1, 'Data version changed'
+    assert len(state.token) == 16, 'Database token not generated'
+
+
+def test_migrate_wal_journal(recording_db):
+    recording_db.pragma('user_version', MIGRATIONS.index(
+        migrations.use_wal_journal))
+    assert recording_db.pragma('journal_mode') == 'delete'
+    migrate_database(recording_db)
+    assert recording_db.pragma('journal_mode') == 'wal', \
+        'Journal mode not changed'
+
+
+def test_read_only_pool(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'db').mkdir()
+    file_db = SqliteDatabase(str(tmp_path / 'db' / 'people.db'))
+    with file_db.bind_ctx(MODELS):
+        file_db.create_tables(MODELS)
+    file_db.close()
+    pool = read_only_pool('people.db')
+    with pool.connection_context():
+        assert pool.pragma('journal_mode') == 'delete', \
+            'Database changed by the read-only pool'
+        with pytest.raises(peewee.OperationalError):
+            pool.execute_sql('DELETE FROM person')
+    pool.close_all()
+
 
 def test_password_score():
     assert password_score('') == 0
     assert password_score('aeqwasd') == 1
     assert password_score('sdadWd ') == 3
     assert password_score('1joewe3') == 2
+    assert password_score('\u0663joewe') == 2
+    assert password_score('\u00b2joewe') == 1
     assert password_score('r2dDt') == 4
     assert password_score('supertajne') == 6
     assert password_score('1@3$') == 4